@@ -0,0 +1,26 @@
+"""Add data_version and data_updated_at to sources
+
+Revision ID: 5c0f8e2a7d14
+Revises: fbccb14241da
+Create Date: 2024-02-20 10:12:43.118204
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '5c0f8e2a7d14'
+down_revision = 'fbccb14241da'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('sources', sa.Column('data_version', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('sources', sa.Column('data_updated_at', sa.TIMESTAMP(timezone=True), server_default=sa.func.now(),
+                                       nullable=False))
+
+
+def downgrade() -> None:
+    op.drop_column('sources', 'data_updated_at')
+    op.drop_column('sources', 'data_version')
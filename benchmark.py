@@ -0,0 +1,49 @@
+import logging
+import os
+import sys
+import tempfile
+
+import click
+
+from benchmarks.harness import Results, compare, DEFAULT_TOLERANCE
+from benchmarks.postgres import disposable_database
+from benchmarks.suite import run_suite
+
+logging.basicConfig(
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+
+@click.command()
+@click.option('--output', '-o', default='benchmark_results.json', help='File where the results are saved as JSON')
+@click.option('--baseline', '-b', default=None,
+              help='Results of a previous run to compare with: the exit code is 1 if any benchmark regressed')
+@click.option('--tolerance', default=DEFAULT_TOLERANCE, show_default=True,
+              help='Relative slowdown of the median above which a benchmark is a regression')
+@click.option('--repeat', default=5, show_default=True, help='Timed runs of each benchmark')
+@click.option('--pg-url', envvar='BENCHMARK_PG_URL', default=None,
+              help='Postgres server where the disposable database is created (BENCHMARK_PG_URL), by default a '
+                   'temporary cluster is started with initdb')
+def run(output: str, baseline: str, tolerance: float, repeat: int, pg_url: str):
+    with tempfile.TemporaryDirectory(prefix='muoversi-feeds-') as work_dir, disposable_database(pg_url) as engine:
+        results = run_suite(engine, work_dir, repeat)
+    results.save(output)
+    logger.info('results saved to %s', output)
+
+    if baseline is None:
+        for name, stats in results.benchmarks.items():
+            print(f'{name}: {stats["median"] * 1000:.2f} ms')
+        return
+
+    comparisons = compare(results, Results.load(baseline), tolerance)
+    for comparison in comparisons:
+        print(comparison.format())
+    regressions = [comparison for comparison in comparisons if comparison.regression]
+    if regressions:
+        print(f'{len(regressions)} benchmarks regressed by more than {tolerance:.0%}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,98 @@
+import json
+import platform
+import statistics
+import subprocess
+import time
+from datetime import datetime, timezone
+from typing import Callable
+
+# a benchmark is a regression when its median is this much slower than in the baseline
+DEFAULT_TOLERANCE = 0.25
+
+
+def timings_stats(timings: list[float]) -> dict:
+    ordered = sorted(timings)
+    return {
+        'runs': len(ordered),
+        'min': ordered[0],
+        'median': statistics.median(ordered),
+        'p95': ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+        'mean': statistics.fmean(ordered),
+    }
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Results:
+    """Timings of the benchmarks by name, in seconds, saved as JSON together with where they were measured."""
+
+    def __init__(self, benchmarks: dict[str, dict] = None, meta: dict = None):
+        self.benchmarks = benchmarks if benchmarks is not None else {}
+        self.meta = meta if meta is not None else {
+            'date': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+        }
+
+    def measure(self, name: str, function: Callable[[], object], repeat=5, warmup=1, rows: int = None) -> dict:
+        """Time `repeat` calls of `function` after `warmup` untimed ones. With `rows`, the number of rows handled by
+        each call, the throughput is recorded too."""
+        for _ in range(warmup):
+            function()
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            function()
+            timings.append(time.perf_counter() - start)
+
+        stats = timings_stats(timings)
+        if rows is not None:
+            stats['rows'] = rows
+            stats['rows_per_second'] = rows / stats['median'] if stats['median'] else None
+        self.benchmarks[name] = stats
+        return stats
+
+    def save(self, path: str):
+        with open(path, 'w') as f:
+            json.dump({'meta': self.meta, 'benchmarks': self.benchmarks}, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+    @classmethod
+    def load(cls, path: str) -> 'Results':
+        with open(path) as f:
+            data = json.load(f)
+        return cls(data['benchmarks'], data['meta'])
+
+
+class Comparison:
+    def __init__(self, name: str, baseline: float | None, current: float | None, tolerance: float):
+        self.name = name
+        self.baseline = baseline
+        self.current = current
+        self.ratio = current / baseline if baseline and current is not None else None
+        self.regression = self.ratio is not None and self.ratio > 1 + tolerance
+
+    def format(self) -> str:
+        if self.baseline is None:
+            return f'{self.name}: {self.current * 1000:.2f} ms (new)'
+        if self.current is None:
+            return f'{self.name}: missing, was {self.baseline * 1000:.2f} ms'
+        flag = '  REGRESSION' if self.regression else ''
+        return f'{self.name}: {self.current * 1000:.2f} ms, baseline {self.baseline * 1000:.2f} ms ' \
+               f'({self.ratio - 1:+.0%}){flag}'
+
+
+def compare(current: Results, baseline: Results, tolerance=DEFAULT_TOLERANCE, statistic='median') \
+        -> list[Comparison]:
+    """Compare the benchmarks by `statistic`: lower is better for all of them, since throughputs are recorded as the
+    time of a fixed number of rows."""
+    names = list(current.benchmarks) + [name for name in baseline.benchmarks if name not in current.benchmarks]
+    return [Comparison(name, baseline.benchmarks.get(name, {}).get(statistic),
+                       current.benchmarks.get(name, {}).get(statistic), tolerance) for name in names]
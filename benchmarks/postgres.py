@@ -0,0 +1,112 @@
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+from contextlib import contextmanager
+from typing import Iterator
+
+from sqlalchemy import create_engine, text, make_url, Engine
+
+from server.base.models import Base
+
+# stop_times as left by the migrations: partitioned by day, without a primary key
+STOP_TIMES_DDL = """
+    CREATE TABLE stop_times (
+        id SERIAL NOT NULL,
+        stop_id character varying NOT NULL REFERENCES stops(id),
+        sched_arr_dt timestamp with time zone,
+        sched_dep_dt timestamp with time zone,
+        platform character varying,
+        orig_dep_date date NOT NULL,
+        orig_id character varying NOT NULL,
+        dest_text character varying NOT NULL,
+        number integer NOT NULL,
+        route_name character varying NOT NULL,
+        source character varying REFERENCES sources(name),
+        stop_sequence integer,
+        CONSTRAINT stop_times_unique_idx
+            UNIQUE NULLS NOT DISTINCT (stop_id, number, source, orig_dep_date, stop_sequence)
+    ) PARTITION BY RANGE (orig_dep_date)
+"""
+
+
+def find_pg_binary(name: str) -> str | None:
+    path = shutil.which(name)
+    if path:
+        return path
+    # Debian and Ubuntu keep the server binaries out of the PATH
+    pg_config = shutil.which('pg_config')
+    if pg_config:
+        bindir = subprocess.run([pg_config, '--bindir'], capture_output=True, text=True).stdout.strip()
+        if os.path.isfile(os.path.join(bindir, name)):
+            return os.path.join(bindir, name)
+    return None
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@contextmanager
+def temporary_cluster() -> Iterator[str]:
+    """Start a throwaway Postgres cluster in a temporary directory, listening only on a unix socket, and yield the URL
+    of its postgres database."""
+    initdb, pg_ctl = find_pg_binary('initdb'), find_pg_binary('pg_ctl')
+    if not initdb or not pg_ctl:
+        raise RuntimeError('initdb and pg_ctl not found, install PostgreSQL or set BENCHMARK_PG_URL')
+
+    with tempfile.TemporaryDirectory(prefix='muoversi-bench-') as tmp_dir:
+        data_dir = os.path.join(tmp_dir, 'data')
+        subprocess.run([initdb, '-D', data_dir, '-U', 'postgres', '-A', 'trust', '--no-sync'], check=True,
+                       capture_output=True)
+        port = free_port()
+        subprocess.run([pg_ctl, '-D', data_dir, '-l', os.path.join(tmp_dir, 'postgres.log'), '-w',
+                        '-o', f"-p {port} -k {tmp_dir} -c listen_addresses=''", 'start'], check=True,
+                       capture_output=True)
+        try:
+            yield f'postgresql://postgres@/postgres?host={tmp_dir}&port={port}'
+        finally:
+            subprocess.run([pg_ctl, '-D', data_dir, '-m', 'immediate', 'stop'], capture_output=True)
+
+
+@contextmanager
+def disposable_database(server_url: str = None) -> Iterator[Engine]:
+    """Engine of an empty database, dropped at the end. It is created on the server of `server_url` (e.g.
+    BENCHMARK_PG_URL), or on a temporary cluster when it is not given."""
+    if server_url is None:
+        with temporary_cluster() as cluster_url, disposable_database(cluster_url) as engine:
+            yield engine
+        return
+
+    database = f'muoversi_bench_{os.getpid()}'
+    admin_engine = create_engine(server_url, isolation_level='AUTOCOMMIT')
+    with admin_engine.connect() as con:
+        con.execute(text(f'DROP DATABASE IF EXISTS {database}'))
+        con.execute(text(f'CREATE DATABASE {database}'))
+
+    engine = create_engine(make_url(server_url).set(database=database))
+    try:
+        create_schema(engine)
+        yield engine
+    finally:
+        engine.dispose()
+        with admin_engine.connect() as con:
+            con.execute(text(f'DROP DATABASE IF EXISTS {database} WITH (FORCE)'))
+        admin_engine.dispose()
+
+
+def create_schema(engine: Engine):
+    tables = [Base.metadata.tables[name] for name in ('cities', 'sources', 'stations', 'stops')]
+    Base.metadata.create_all(engine, tables=tables)
+    with engine.begin() as con:
+        con.execute(text(STOP_TIMES_DDL))
+        # the day partitions are created by the loads, as in production
+        con.execute(text('CREATE TABLE stop_times_default PARTITION OF stop_times DEFAULT'))
+        con.execute(text("INSERT INTO cities (name) VALUES ('venezia')"))
+        con.execute(text("INSERT INTO sources (name, city_name, color, icon_code) VALUES "
+                         "('venezia-aut', 'venezia', '#FF9800', 57813), "
+                         "('venezia-nav', 'venezia', '#2196F3', 57811), "
+                         "('venezia-treni', 'venezia', '#4CAF50', 58997)"))
@@ -0,0 +1,318 @@
+import asyncio
+import json
+import logging
+import random
+import socket
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from urllib.parse import urlencode, parse_qsl
+
+import httpx
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+logging.basicConfig(
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+WEBHOOK_PATH = '/tg_bot_webhook'
+# seconds the replay waits for the bot to answer an update
+BOT_REPLY_TIMEOUT = 10
+# share of the synthetic jobs by kind: bot sessions are made of several updates
+DEFAULT_MIX = {'stop_times': 0.55, 'search_stations': 0.3, 'bot_session': 0.15}
+SEARCH_NAMES = ('roma', 'rialto', 'lido', 'san marco', 'ferrovia', 'mestre', 'murano', 'zattere', 'accademia',
+                'venezia', 'padova', 'treviso')
+# Bot API methods answering a chat, i.e. the replies of the bot
+REPLY_METHODS = {'sendMessage', 'editMessageText', 'sendLocation', 'editMessageReplyMarkup', 'deleteMessage'}
+
+
+def request_kind(path: str) -> str:
+    path = path.split('?', 1)[0]
+    if path == WEBHOOK_PATH:
+        return 'webhook'
+    return {'/stop_times': 'stop_times', '/search/stations': 'search_stations',
+            '/stop_times/boards': 'boards'}.get(path, 'other')
+
+
+def update_chat_id(update: dict) -> int | None:
+    message = update.get('message') or update.get('edited_message') or \
+        (update.get('callback_query') or {}).get('message')
+    if message:
+        return message['chat']['id']
+    return None
+
+
+# Traffic is a list of jobs, each one a list of entries ({'at', 'method', 'path', 'body'}) sent one after the other:
+# an API request is a job of its own, the updates of a chat form a bot session, whose updates wait for the reply to
+# the previous one as a user would.
+
+def load_traffic(path: str) -> list[list[dict]]:
+    """Jobs of the requests recorded by server.recording.TrafficRecorder, `at` being the seconds since the first."""
+    with open(path) as f:
+        entries = [json.loads(line) for line in f if line.strip()]
+    if not entries:
+        return []
+    first_time = min(entry['time'] for entry in entries)
+
+    jobs, sessions = [], {}
+    for entry in sorted(entries, key=lambda e: e['time']):
+        entry = {'at': entry['time'] - first_time, 'method': entry['method'], 'path': entry['path'],
+                 'body': entry.get('body')}
+        chat_id = update_chat_id(entry['body']) if request_kind(entry['path']) == 'webhook' and entry['body'] else None
+        if chat_id is None:
+            jobs.append([entry])
+        elif chat_id in sessions:
+            sessions[chat_id].append(entry)
+        else:
+            sessions[chat_id] = [entry]
+            jobs.append(sessions[chat_id])
+    return jobs
+
+
+def message_update(update_id: int, chat_id: int, text: str) -> dict:
+    message = {'message_id': update_id, 'date': int(time.time()), 'text': text,
+               'chat': {'id': chat_id, 'type': 'private'},
+               'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Replay', 'language_code': 'it'}}
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return {'update_id': update_id, 'message': message}
+
+
+def synthetic_traffic(n_jobs: int, stations: list[dict], start_dt: datetime, mix: dict[str, float] = None,
+                      seed=0) -> list[list[dict]]:
+    """`n_jobs` jobs mixing departures boards (half of them between two stations), stations searches and bot
+    sessions (/fermata, a station name, /cancel), on the `stations` returned by /search/stations."""
+    rng = random.Random(seed)
+    mix = mix or DEFAULT_MIX
+    kinds = rng.choices(list(mix), weights=list(mix.values()), k=n_jobs)
+    jobs, update_id = [], 0
+
+    for i, kind in enumerate(kinds):
+        if kind == 'stop_times':
+            station = rng.choice(stations)
+            params = {'source': station['source'], 'dep_stops_ids': station['ids'],
+                      'start_dt': (start_dt + timedelta(minutes=rng.randrange(0, 12 * 60, 5))).isoformat(),
+                      'limit': 10}
+            same_source = [other for other in stations if other['source'] == station['source'] and other != station]
+            if same_source and rng.random() < 0.5:
+                params['arr_stops_ids'] = rng.choice(same_source)['ids']
+            if rng.random() < 0.2:
+                params['format'] = 'compact'
+            jobs.append([{'at': 0, 'method': 'GET', 'path': '/stop_times?' + urlencode(params), 'body': None}])
+        elif kind == 'search_stations':
+            jobs.append([{'at': 0, 'method': 'GET', 'body': None,
+                          'path': '/search/stations?' + urlencode({'q': rng.choice(SEARCH_NAMES), 'limit': 4})}])
+        else:
+            chat_id = 10 ** 9 + i
+            session = []
+            for text in ('/fermata', rng.choice(stations)['name'], '/cancel'):
+                update_id += 1
+                session.append({'at': 0, 'method': 'POST', 'path': WEBHOOK_PATH,
+                                'body': message_update(update_id, chat_id, text)})
+            jobs.append(session)
+    return jobs
+
+
+class TelegramStub:
+    """Local stand-in of the Telegram Bot API (set TG_API_BASE_URL to `base_url`, the bot then talks HTTP/1.1 to it):
+    it answers every method with a plausible result, counts the calls and lets the replay wait for the replies sent
+    to a chat."""
+
+    def __init__(self):
+        self.calls: Counter = Counter()
+        self.message_id = 0
+        self.waiters: dict[int, asyncio.Future] = {}
+        self.base_url = None
+        self.app = Starlette(routes=[Route('/bot{token}/{method}', self.handle, methods=['GET', 'POST'])])
+
+    async def params(self, request: Request) -> dict:
+        # python-telegram-bot sends the parameters url-encoded, unless files are uploaded (never by this bot)
+        content_type = request.headers.get('content-type', '')
+        if content_type.startswith('application/json'):
+            return await request.json()
+        if content_type.startswith('application/x-www-form-urlencoded'):
+            return dict(parse_qsl((await request.body()).decode()))
+        return dict(request.query_params)
+
+    async def handle(self, request: Request) -> JSONResponse:
+        method = request.path_params['method']
+        params = await self.params(request)
+        self.calls[method] += 1
+
+        chat_id = params.get('chat_id')
+        if chat_id is not None and method in REPLY_METHODS:
+            waiter = self.waiters.pop(int(chat_id), None)
+            if waiter is not None and not waiter.done():
+                waiter.set_result(time.perf_counter())
+
+        return JSONResponse({'ok': True, 'result': self.result(method, params)})
+
+    def result(self, method: str, params: dict):
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'MuoVErsi', 'username': 'MuoVErsiBot',
+                    'can_join_groups': False, 'can_read_all_group_messages': False, 'supports_inline_queries': False}
+        if method in ('sendMessage', 'sendLocation', 'editMessageText'):
+            self.message_id += 1
+            return {'message_id': self.message_id, 'date': int(time.time()), 'text': params.get('text', ''),
+                    'chat': {'id': int(params.get('chat_id') or 0), 'type': 'private'}}
+        return True
+
+    def expect_reply(self, chat_id: int) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self.waiters[chat_id] = future
+        return future
+
+
+class Report:
+    """Latencies (in seconds) and outcomes of the replayed requests by kind; bot replies are measured from the
+    webhook request to the first answer of the bot to the chat."""
+
+    def __init__(self):
+        self.latencies: dict[str, list[float]] = {}
+        self.statuses: dict[str, Counter] = {}
+        self.errors: Counter = Counter()
+        self.duration = 0.0
+
+    def record(self, kind: str, latency: float | None, status: int | str, error=False):
+        self.statuses.setdefault(kind, Counter())[status] += 1
+        if latency is not None:
+            self.latencies.setdefault(kind, []).append(latency)
+        if error:
+            self.errors[kind] += 1
+
+    def summary(self) -> dict:
+        kinds = {}
+        for kind, statuses in self.statuses.items():
+            total = sum(statuses.values())
+            latencies = self.latencies.get(kind)
+            kinds[kind] = {
+                'requests': total,
+                'throughput': total / self.duration if self.duration else None,
+                'error_rate': self.errors[kind] / total,
+                'statuses': {str(status): count for status, count in statuses.items()},
+            }
+            if latencies:
+                kinds[kind].update({'mean': sum(latencies) / len(latencies), 'p50': percentile(latencies, 0.5),
+                                    'p90': percentile(latencies, 0.9), 'p99': percentile(latencies, 0.99),
+                                    'max': max(latencies)})
+        requests = sum(kind['requests'] for name, kind in kinds.items() if name != 'bot_reply')
+        errors = sum(count for name, count in self.errors.items() if name != 'bot_reply')
+        return {'duration': self.duration, 'requests': requests,
+                'throughput': requests / self.duration if self.duration else None,
+                'error_rate': errors / requests if requests else 0.0, 'kinds': kinds}
+
+    def format(self) -> str:
+        summary = self.summary()
+        lines = [f'{summary["requests"]} requests in {summary["duration"]:.1f}s: '
+                 f'{summary["throughput"]:.1f} req/s, {summary["error_rate"]:.2%} errors']
+        for kind, stats in summary['kinds'].items():
+            line = f'  {kind}: {stats["requests"]}, {stats["error_rate"]:.2%} errors'
+            if 'p50' in stats:
+                line += f', p50 {stats["p50"] * 1000:.1f} ms, p90 {stats["p90"] * 1000:.1f} ms, ' \
+                        f'p99 {stats["p99"] * 1000:.1f} ms, max {stats["max"] * 1000:.1f} ms'
+            lines.append(line)
+        return '\n'.join(lines)
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+async def send(client: httpx.AsyncClient, entry: dict, report: Report, stub: TelegramStub | None,
+               secret_token: str | None):
+    kind = request_kind(entry['path'])
+    headers = {'Accept-Encoding': 'gzip'}
+    reply = None
+    if kind == 'webhook':
+        headers['X-Telegram-Bot-Api-Secret-Token'] = secret_token or ''
+        chat_id = update_chat_id(entry['body']) if entry['body'] else None
+        if stub is not None and chat_id is not None:
+            reply = stub.expect_reply(chat_id)
+
+    start = time.perf_counter()
+    try:
+        response = await client.request(entry['method'], entry['path'], headers=headers,
+                                        json=entry['body'] if entry['body'] is not None else None)
+        await response.aread()
+    except httpx.HTTPError as e:
+        report.record(kind, None, type(e).__name__, error=True)
+        if reply is not None:
+            reply.cancel()
+        return
+    report.record(kind, time.perf_counter() - start, response.status_code, error=response.status_code >= 500)
+
+    if reply is not None:
+        try:
+            report.record('bot_reply', await asyncio.wait_for(reply, BOT_REPLY_TIMEOUT) - start, 'replied')
+        except asyncio.TimeoutError:
+            report.record('bot_reply', None, 'timeout', error=True)
+
+
+async def replay(client: httpx.AsyncClient, jobs: list[list[dict]], concurrency=8, speed: float = None,
+                 stub: TelegramStub = None, secret_token: str = None) -> Report:
+    """Send the `jobs` with `client`, `concurrency` at a time: as fast as possible, or on the recorded timeline
+    accelerated by `speed` (still at most `concurrency` at a time)."""
+    report = Report()
+    queue = asyncio.Queue()
+    for job in jobs:
+        queue.put_nowait(job)
+    start = time.perf_counter()
+
+    async def worker():
+        while not queue.empty():
+            job = queue.get_nowait()
+            if speed:
+                await asyncio.sleep(max(0.0, start + job[0]['at'] / speed - time.perf_counter()))
+            for entry in job:
+                await send(client, entry, report, stub, secret_token)
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    report.duration = time.perf_counter() - start
+    return report
+
+
+def in_process_client(app) -> httpx.AsyncClient:
+    # requests go straight to the ASGI app, without sockets nor HTTP parsing
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url='http://replay', timeout=60)
+
+
+def socket_client(base_url: str, concurrency: int) -> httpx.AsyncClient:
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    return httpx.AsyncClient(base_url=base_url, timeout=60, limits=limits)
+
+
+async def serve_in_background(app, host='127.0.0.1', port=0) -> tuple[uvicorn.Server, asyncio.Task, str]:
+    """Serve `app` on a local socket from the current event loop, returns the server, its task and its URL."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    server = uvicorn.Server(uvicorn.Config(app=app, log_level='warning', lifespan='off'))
+    task = asyncio.create_task(server.serve(sockets=[sock]))
+    while not server.started:
+        if task.done():
+            task.result()
+        await asyncio.sleep(0.01)
+    return server, task, f'http://{host}:{sock.getsockname()[1]}'
+
+
+async def stop_server(server: uvicorn.Server, task: asyncio.Task):
+    server.should_exit = True
+    await task
+
+
+async def fetch_stations(client: httpx.AsyncClient, names=SEARCH_NAMES) -> list[dict]:
+    # the stations of the synthetic traffic are the ones found by the server itself
+    stations = {}
+    for name in names:
+        response = await client.get('/search/stations', params={'q': name, 'limit': 10})
+        response.raise_for_status()
+        for station in response.json():
+            stations[station['id']] = station
+    return list(stations.values())
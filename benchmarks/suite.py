@@ -0,0 +1,190 @@
+import logging
+import os
+import shutil
+from contextlib import closing
+from datetime import datetime, date, time
+from types import SimpleNamespace
+
+from sqlalchemy import text, Engine
+from sqlalchemy.orm import Session
+from zoneinfo import ZoneInfo
+
+from server.GTFS import GTFS, get_clusters_of_stops
+from server.typesense.helpers import ts_search_stations, get_stations_documents, search_cache
+from tgbot.formatting import NamedStopTime, Route, Direction, format_board, named_stop_time_fragment, \
+    route_fragment
+from .harness import Results
+
+logging.basicConfig(
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+DATA_DIR = os.path.join(ROOT_DIR, 'tests', 'data')
+
+# the feeds of tests/data: version 558 is in service from 2023-10-07, the benchmarks use a weekday of it
+GTFS_VERSIONS = (558, 557)
+SERVICE_DAY = date(2023, 10, 9)
+START_DT = datetime.combine(SERVICE_DAY, time(7, 0), ZoneInfo('Europe/Rome'))
+# pages of Source.LIMIT results, as reached with the "next" button of the bot and the app
+PAGE_DEPTHS = (0, 5, 20)
+ROW_BY_ROW_ROWS = 2000
+SEARCH_QUERIES = ('roma', 'p.le roma', 'rialto', 'lido', 'san marco', 'ferrovia', 'murano', 'zaccaria')
+
+
+class StandInDocuments:
+    """In-memory stand-in of a Typesense collection, answering the searches made by search_stations_typesense."""
+
+    def __init__(self, documents: list[dict]):
+        self.documents = documents
+
+    def search(self, config: dict) -> dict:
+        documents = self.documents
+        if 'filter_by' in config:
+            sources = config['filter_by'][len('source:['):-1].split(',')
+            documents = [document for document in documents if document['source'] in sources]
+        if 'hidden_hits' in config:
+            hidden = set(config['hidden_hits'].split(','))
+            documents = [document for document in documents if document['id'] not in hidden]
+
+        if config['q'] == '*':
+            lat, lon = map(float, config['sort_by'][len('location('):-len('):asc')].split(','))
+            documents = sorted(documents, key=lambda d: (d['location'][0] - lat) ** 2 + (d['location'][1] - lon) ** 2)
+        else:
+            tokens = config['q'].split()
+            documents = [document for document in documents
+                         if all(token in document['name'].lower() for token in tokens)]
+            documents = sorted(documents, key=lambda d: -d['times_count'])
+
+        start = (config['page'] - 1) * config['per_page']
+        return {'hits': [{'document': document} for document in documents[start:start + config['per_page']]],
+                'found': len(documents)}
+
+
+def stand_in_typesense(documents: list[dict]):
+    return SimpleNamespace(collections={'stations': SimpleNamespace(documents=StandInDocuments(documents))})
+
+
+def copy_feeds(work_dir: str):
+    # the databases are written to (stops clusters, upgrades), the ones in tests/data are left untouched
+    for version in GTFS_VERSIONS:
+        path = os.path.join(DATA_DIR, f'navigazione_{version}.db')
+        with open(path, 'rb') as f:
+            if not f.read(16).startswith(b'SQLite format 3'):
+                raise RuntimeError(f'{path} is not a SQLite database, fetch it with git lfs pull')
+        shutil.copy(path, work_dir)
+
+
+def read_day(source: GTFS, day: date, limit=30000) -> list:
+    # same paging as GTFS.save_data
+    stop_times, offset = [], 0
+    while True:
+        page = source.get_sqlite_stop_times(day, time(0, 0), time(23, 59), limit, offset)
+        stop_times += page
+        if len(page) < limit:
+            return stop_times
+        offset += limit
+
+
+def busiest_stops(session: Session) -> tuple[str, str]:
+    # the departure stop and the arrival stop sharing the most trips, so that the queries return full pages
+    return session.execute(text("""
+        SELECT d.stop_id, a.stop_id FROM stop_times d
+            JOIN stop_times a ON d.number = a.number AND d.orig_dep_date = a.orig_dep_date AND d.source = a.source
+                AND a.stop_sequence > d.stop_sequence
+        GROUP BY d.stop_id, a.stop_id
+        ORDER BY count(*) DESC
+        LIMIT 1
+    """)).one()
+
+
+def run_suite(engine: Engine, work_dir: str, repeat=5) -> Results:
+    results = Results()
+    copy_feeds(work_dir)
+    session = Session(engine)
+
+    # the GTFS location is relative to the repository
+    location = os.path.relpath(work_dir, ROOT_DIR)
+    source = GTFS('navigazione', 'venezia-nav', '⛴️', session, None, GTFS_VERSIONS, location,
+                  ref_dt=datetime.combine(SERVICE_DAY, time(12)), stations_index=None)
+
+    # stops clustering and synchronization of the stations, as done by save_data
+    stops = source.get_all_stops()
+    results.measure('clustering.get_clusters_of_stops', lambda: get_clusters_of_stops(stops), repeat=repeat,
+                    rows=len(stops))
+    synced = {}
+    sync_stations_db = source.sync_stations_db
+    source.sync_stations_db = lambda stations, stops_=None: synced.update(stations=stations, stops=stops_) or \
+        sync_stations_db(stations, stops_)
+    results.measure('clustering.upload_stops_clusters_to_db',
+                    lambda: source.upload_stops_clusters_to_db(force=True), repeat=repeat)
+    source.sync_stations_db = sync_stations_db
+    results.measure('sync_stations_db', lambda: source.sync_stations_db(synced['stations'], synced['stops']),
+                    repeat=repeat, rows=len(synced['stops']))
+
+    # ingestion of a full day: save_data reads the day from SQLite, then upserts it row by row or swaps it in
+    stop_times = read_day(source, SERVICE_DAY)
+    logger.info('%d stop times in %s', len(stop_times), SERVICE_DAY)
+    results.measure('save_data.read_sqlite', lambda: read_day(source, SERVICE_DAY), repeat=repeat,
+                    rows=len(stop_times))
+    results.measure('save_data.upload_atomic', lambda: source.upload_stop_times_to_postgres(stop_times, atomic=True),
+                    repeat=repeat, rows=len(stop_times))
+    sample = stop_times[:ROW_BY_ROW_ROWS]
+    results.measure('save_data.upload_row_by_row', lambda: source.upload_stop_times_to_postgres(sample),
+                    repeat=min(repeat, 3), rows=len(sample))
+    with engine.begin() as con:
+        con.execute(text('ANALYZE stop_times'))
+
+    # queries, at several page depths: by offset (the API) and by the ids already seen (the bot)
+    dep_stop_id, arr_stop_id = busiest_stops(session)
+    deepest = max(PAGE_DEPTHS) * source.LIMIT
+    seen_ids = [stop_time.id for stop_time in source.get_stop_times(dep_stop_id, '', START_DT, 0, limit=deepest)]
+    seen_trip_ids = [dep.id for dep, arr in
+                     source.get_stop_times_between_stops(dep_stop_id, arr_stop_id, '', START_DT, 0, limit=deepest)]
+    for depth in PAGE_DEPTHS:
+        offset, ids = depth * source.LIMIT, tuple(seen_ids[:depth * source.LIMIT])
+        trip_ids = tuple(seen_trip_ids[:depth * source.LIMIT])
+        results.measure(f'get_stop_times.page_{depth}',
+                        lambda: source.get_stop_times(dep_stop_id, '', START_DT, offset), repeat=repeat)
+        results.measure(f'get_stop_times.page_{depth}_by_ids',
+                        lambda: source.get_stop_times(dep_stop_id, '', START_DT, ids or 0), repeat=repeat)
+        results.measure(f'get_stop_times_between_stops.page_{depth}',
+                        lambda: source.get_stop_times_between_stops(dep_stop_id, arr_stop_id, '', START_DT, offset),
+                        repeat=repeat)
+        results.measure(f'get_stop_times_between_stops.page_{depth}_by_ids',
+                        lambda: source.get_stop_times_between_stops(dep_stop_id, arr_stop_id, '', START_DT,
+                                                                    trip_ids or 0), repeat=repeat)
+        session.rollback()
+
+    # stations search through Typesense, here a local stand-in: uncached (every query misses) and cached
+    typesense = stand_in_typesense(list(get_stations_documents(session).values()))
+
+    def search_all():
+        for query in SEARCH_QUERIES:
+            ts_search_stations(typesense, ['venezia-nav'], query)
+
+    def search_all_uncached():
+        search_cache.clear()
+        search_all()
+
+    results.measure('ts_search_stations.uncached', search_all_uncached, repeat=repeat, rows=len(SEARCH_QUERIES))
+    results.measure('ts_search_stations.cached', search_all, repeat=repeat, rows=len(SEARCH_QUERIES))
+
+    # bot boards, with the fragment caches cleared as on the first render of a board
+    departures = source.get_stop_times(dep_stop_id, '', START_DT, 0)
+    trips = source.get_stop_times_between_stops(dep_stop_id, arr_stop_id, '', START_DT, 0)
+    departures_board = [NamedStopTime(stop_time, 'A') for stop_time in departures]
+    trips_board = [Direction([Route(NamedStopTime(dep, 'A'), NamedStopTime(arr, 'B'))]) for dep, arr in trips]
+
+    def render(board):
+        named_stop_time_fragment.cache_clear()
+        route_fragment.cache_clear()
+        return format_board(board, lambda text_: text_, source.name, now=START_DT)
+
+    results.measure('bot.render_departures_board', lambda: render(departures_board), repeat=repeat * 20)
+    results.measure('bot.render_trips_board', lambda: render(trips_board), repeat=repeat * 20)
+
+    source.read_pool.close()
+    session.close()
+    return results
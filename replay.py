@@ -0,0 +1,100 @@
+import asyncio
+import json
+import logging
+from datetime import datetime
+
+import click
+
+from benchmarks.replay import TelegramStub, serve_in_background, stop_server, in_process_client, socket_client, \
+    load_traffic, synthetic_traffic, fetch_stations, replay
+from config import config
+
+logging.basicConfig(
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+
+async def set_up_app(with_bot: bool):
+    from run import warm_up_sources, create_app
+    from server.routes import routes as server_routes
+
+    warm_up_sources()
+    routes = list(server_routes)
+    application = None
+    if with_bot and config['TG_BOT_ENABLED']:
+        from tgbot.handlers import set_up_application
+        from tgbot.routes import get_routes as get_tgbot_routes, application_put_update
+        application = await set_up_application()
+        await application.initialize()
+        await application.start()
+        routes += get_tgbot_routes(application_put_update(application))
+    return create_app(routes), application
+
+
+async def run_replay(traffic: str, synthetic: int, concurrency: int, speed: float, mode: str, url: str, bot: bool,
+                     start_dt: datetime, seed: int, output: str):
+    stub = TelegramStub()
+    stub_server, stub_task, stub_url = await serve_in_background(stub.app)
+    stub.base_url = f'{stub_url}/bot'
+
+    application, server = None, None
+    if url:
+        logger.info('set TG_API_BASE_URL to %s in the config of the server to stub the Bot API', stub.base_url)
+        client = socket_client(url, concurrency)
+    else:
+        # the bot of this process talks to the stub
+        config['TG_API_BASE_URL'] = stub.base_url
+        app, application = await set_up_app(bot)
+        if mode == 'socket':
+            server, server_task, base_url = await serve_in_background(app)
+            client = socket_client(base_url, concurrency)
+        else:
+            client = in_process_client(app)
+
+    try:
+        if traffic:
+            jobs = load_traffic(traffic)
+        else:
+            jobs = synthetic_traffic(synthetic, await fetch_stations(client), start_dt or datetime.now(), seed=seed)
+        logger.info('replaying %d jobs (%d requests) with concurrency %d', len(jobs), sum(map(len, jobs)),
+                    concurrency)
+        report = await replay(client, jobs, concurrency, speed, stub, config.get('TG_SECRET_TOKEN'))
+    finally:
+        await client.aclose()
+        if server is not None:
+            await stop_server(server, server_task)
+        if application is not None:
+            await application.stop()
+            await application.shutdown()
+        await stop_server(stub_server, stub_task)
+
+    print(report.format())
+    print('Bot API calls: ' + ', '.join(f'{method} {count}' for method, count in stub.calls.most_common()))
+    if output:
+        with open(output, 'w') as f:
+            json.dump({**report.summary(), 'bot_api_calls': dict(stub.calls)}, f, indent=2)
+
+
+@click.command()
+@click.option('--traffic', '-t', default=None, help='Traffic recorded with TRAFFIC_RECORD_FILE, replayed instead of '
+                                                     'the synthetic one')
+@click.option('--synthetic', '-n', default=500, show_default=True,
+              help='Number of synthetic jobs (boards, searches and bot sessions)')
+@click.option('--concurrency', '-c', default=8, show_default=True, help='Jobs replayed at the same time')
+@click.option('--speed', type=float, default=None,
+              help='Follow the recorded timeline, accelerated by this factor, instead of sending as fast as possible')
+@click.option('--mode', type=click.Choice(['in-process', 'socket']), default='in-process', show_default=True,
+              help='Call the app directly, or serve it with uvicorn on a local socket')
+@click.option('--url', default=None, help='Load a server already running at this URL instead')
+@click.option('--bot/--no-bot', default=True, show_default=True,
+              help='Run the Telegram bot, with the Bot API stubbed, to handle the webhook updates')
+@click.option('--start-dt', type=click.DateTime(), default=None, help='Start of the synthetic boards, now by default')
+@click.option('--seed', default=0, show_default=True, help='Seed of the synthetic traffic')
+@click.option('--output', '-o', default=None, help='File where the report is saved as JSON')
+def run(traffic, synthetic, concurrency, speed, mode, url, bot, start_dt, seed, output):
+    asyncio.run(run_replay(traffic, synthetic, concurrency, speed, mode, url, bot, start_dt, seed, output))
+
+
+if __name__ == '__main__':
+    run()
@@ -1,11 +1,21 @@
 import asyncio
 import logging
+import multiprocessing
+import signal
 
 import uvicorn
 from starlette.applications import Starlette
+from starlette.middleware import Middleware
 
 from config import config
-from server.routes import routes as server_routes
+from server.partitions import PartitionManager
+from server.recording import TrafficRecorder
+from server.metrics import MetricsMiddleware
+from server.responses import CompressionMiddleware
+from server import tracing
+from server.routes import routes as server_routes, REQUEST_SECONDS
+from server.sources import engine, sources, data_versions, live_boards
+from server import workers
 
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
@@ -13,36 +23,88 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
+def install_tracing() -> None:
+    tracing_config = config.get('QUERY_TRACING')
+    if not tracing_config:
+        return
+    tracing_config = dict(tracing_config)
+    log_path = tracing_config.pop('log_path')
+    # one log per worker process, the rotation of a shared file would not be safe
+    process_name = multiprocessing.current_process().name
+    if process_name != 'MainProcess':
+        log_path = f'{log_path}.{process_name}'
+    tracing.tracer = tracing.QueryTracer(engine, log_path, **tracing_config)
+    tracing.tracer.install()
+    logger.info('query tracing enabled, logging to %s', log_path)
+
+
+def warm_up_sources() -> None:
+    install_tracing()
+    # sources are constructed before serving, so that the first requests do not wait for them
+    init_timings = sources.warm_up()
+    logger.info('sources warmed up: %s', ', '.join(f'{name} {seconds:.2f}s' for name, seconds in init_timings.items()))
+    data_versions.refresh()
+
+
+def start_background_tasks(manage_partitions=True, poll_realtime=True) -> list[asyncio.Task]:
+    background_tasks = []
+    if manage_partitions:
+        partition_manager = PartitionManager(engine, config.get('PARTITIONS_DAYS_AHEAD') or 3,
+                                             config.get('PARTITIONS_RETENTION_DAYS') or 1,
+                                             config.get('PARTITIONS_ARCHIVE_DIR'))
+        background_tasks.append(asyncio.create_task(
+            partition_manager.run_periodically(config.get('PARTITIONS_CHECK_INTERVAL') or 3600)))
+    if poll_realtime:
+        background_tasks.append(asyncio.create_task(data_versions.refresh_periodically(
+            config.get('DATA_VERSIONS_REFRESH_INTERVAL') or 30)))
+        background_tasks.append(asyncio.create_task(live_boards.run_periodically()))
+        # realtime data is kept in memory, so every process answering requests polls it
+        for source in sources.values():
+            if source.realtime is not None:
+                background_tasks.append(asyncio.create_task(source.poll_realtime_periodically(
+                    config.get('REALTIME_POLL_INTERVAL') or 60)))
+    return background_tasks
+
+
+def create_app(routes) -> Starlette:
+    middleware = [
+        Middleware(tracing.RequestIdMiddleware),
+        Middleware(MetricsMiddleware, metric=REQUEST_SECONDS),
+        Middleware(CompressionMiddleware, minimum_size=config.get('COMPRESSION_MIN_SIZE') or 500)
+    ]
+    if config.get('TRAFFIC_RECORD_FILE'):
+        # one file per worker process, like the query traces
+        path = config['TRAFFIC_RECORD_FILE']
+        if multiprocessing.current_process().name != 'MainProcess':
+            path = f'{path}.{multiprocessing.current_process().name}'
+        middleware.insert(0, Middleware(TrafficRecorder, path=path))
+    return Starlette(routes=routes, middleware=middleware)
+
+
+def get_uvicorn_kwargs() -> dict:
+    if config.get('DEV', False):
+        return {'port': 8000, 'host': '127.0.0.1'}
+    return {'port': 443, 'host': '0.0.0.0', 'ssl_keyfile': config['SSL_KEYFILE'],
+            'ssl_certfile': config['SSL_CERTFILE']}
+
+
 async def run() -> None:
+    warm_up_sources()
+
     routes = server_routes
 
     tgbot_application = None
     if config['TG_BOT_ENABLED']:
         from tgbot.handlers import set_up_application
         tgbot_application = await set_up_application()
-        from tgbot.routes import get_routes as get_tgbot_routes
-        routes += get_tgbot_routes(tgbot_application)
+        from tgbot.routes import get_routes as get_tgbot_routes, application_put_update
+        routes += get_tgbot_routes(application_put_update(tgbot_application))
 
-    starlette_app = Starlette(routes=routes)
+    starlette_app = create_app(routes)
 
-    if config.get('DEV', False):
-        webserver = uvicorn.Server(
-            config=uvicorn.Config(
-                app=starlette_app,
-                port=8000,
-                host="127.0.0.1",
-            )
-        )
-    else:
-        webserver = uvicorn.Server(
-            config=uvicorn.Config(
-                app=starlette_app,
-                port=443,
-                host="0.0.0.0",
-                ssl_keyfile=config['SSL_KEYFILE'],
-                ssl_certfile=config['SSL_CERTFILE']
-            )
-        )
+    background_tasks = start_background_tasks()
+
+    webserver = uvicorn.Server(config=uvicorn.Config(app=starlette_app, **get_uvicorn_kwargs()))
 
     if tgbot_application:
         async with tgbot_application:
@@ -52,5 +114,93 @@ async def run() -> None:
     else:
         await webserver.serve()
 
+    for task in background_tasks:
+        task.cancel()
+
+
+async def run_api_worker(sock, updates_queue) -> None:
+    """API worker process: serves the routes on the shared socket, the bot updates are put in `updates_queue`."""
+    warm_up_sources()
+
+    routes = server_routes
+    if updates_queue is not None:
+        from tgbot.routes import get_routes as get_tgbot_routes, queue_put_update
+        routes += get_tgbot_routes(queue_put_update(updates_queue))
+
+    background_tasks = start_background_tasks(manage_partitions=False)
+
+    uvicorn_kwargs = get_uvicorn_kwargs()
+    del uvicorn_kwargs['host'], uvicorn_kwargs['port']
+    await workers.serve(create_app(routes), sock, **uvicorn_kwargs)
+
+    for task in background_tasks:
+        task.cancel()
+
+
+async def run_bot_worker(updates_queue) -> None:
+    """Bot process: the only one running the Telegram application, it handles the updates received by the API
+    workers. The partitions are also managed here, once for all the processes."""
+    warm_up_sources()
+
+    from tgbot.handlers import set_up_application
+    from tgbot.routes import application_put_update
+    tgbot_application = await set_up_application()
+
+    background_tasks = start_background_tasks()
+
+    consume_task = asyncio.create_task(workers.consume_queue(updates_queue,
+                                                             application_put_update(tgbot_application)))
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, consume_task.cancel)
+
+    async with tgbot_application:
+        await tgbot_application.start()
+        try:
+            await consume_task
+        except asyncio.CancelledError:
+            pass
+        await tgbot_application.stop()
+
+    for task in background_tasks:
+        task.cancel()
+
+
+async def run_maintenance_worker() -> None:
+    """Process managing the partitions when the bot, which otherwise does it, is disabled."""
+    install_tracing()
+    background_tasks = start_background_tasks(poll_realtime=False)
+
+    stopped = asyncio.Event()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stopped.set)
+    await stopped.wait()
+
+    for task in background_tasks:
+        task.cancel()
+
+
+def run_workers(n_workers: int) -> None:
+    """Run `n_workers` API worker processes accepting connections from the same port, and the bot in a separate
+    process if enabled."""
+    uvicorn_kwargs = get_uvicorn_kwargs()
+    sock = workers.bind_socket(uvicorn_kwargs['host'], uvicorn_kwargs['port'])
+
+    processes = []
+    updates_queue = None
+    if config['TG_BOT_ENABLED']:
+        updates_queue = workers.context.Queue()
+        processes.append(workers.start_process(run_bot_worker, updates_queue, name='bot'))
+    else:
+        processes.append(workers.start_process(run_maintenance_worker, name='maintenance'))
+
+    for i in range(n_workers):
+        processes.append(workers.start_process(run_api_worker, sock, updates_queue, name=f'api-{i}'))
+
+    workers.wait_for_processes(processes)
+    sock.close()
+
+
 if __name__ == "__main__":
-    asyncio.run(run())
+    n_workers = config.get('WORKERS') or 1
+    if n_workers > 1:
+        run_workers(n_workers)
+    else:
+        asyncio.run(run())
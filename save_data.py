@@ -1,7 +1,13 @@
 import logging
+import time
 
 import click
 
+from config import config
+from server import metrics
+from server.GTFS import GTFS
+from server.base.source import INGESTED_ROWS, INGESTION_ROWS_PER_SECOND
+from server.caching import bump_data_version
 from server.sources import session, sources as all_sources
 
 logging.basicConfig(
@@ -13,7 +19,10 @@ logger = logging.getLogger(__name__)
 @click.command()
 @click.option('--source', '-s', multiple=True, default=[],
               help='Sources to update. Leave empty to update all sources')
-def run(source: list[str]):
+@click.option('--atomic', is_flag=True, default=False,
+              help='Load each day in a shadow partition and swap it in at the end, so that readers never see a '
+                   'partially loaded day')
+def run(source: list[str], atomic: bool):
     session.commit()
 
     # if a list of sources is specified, only those sources will be updated, otherwise all sources will be updated
@@ -23,10 +32,27 @@ def run(source: list[str]):
         sources = all_sources
 
     for source in sources.values():
+        # new GTFS versions are only looked for here, the other processes read them from the manifest
+        if isinstance(source, GTFS) and source.refresh_versions():
+            logger.info('%s switched to GTFS version %s', source.name, source.gtfs_version)
+
+    for source in sources.values():
+        rows, start = INGESTED_ROWS.get(source.name), time.perf_counter()
         try:
-            source.save_data()
+            source.save_data(atomic=atomic)
         except KeyboardInterrupt:
             session.rollback()
+        else:
+            # the cached responses of the server depending on this source are invalidated
+            bump_data_version(session, source.name)
+            rows = INGESTED_ROWS.get(source.name) - rows
+            INGESTION_ROWS_PER_SECOND.set(rows / (time.perf_counter() - start), source.name)
+            logger.info('%s: %d stop times saved, %.0f rows/s', source.name, rows,
+                        INGESTION_ROWS_PER_SECOND.get(source.name))
+
+    # the ingestion metrics are exposed by the server, which reads them from this file
+    if config.get('METRICS_TEXTFILE'):
+        metrics.registry.write_textfile(config['METRICS_TEXTFILE'], [INGESTED_ROWS, INGESTION_ROWS_PER_SECOND])
 
 
 if __name__ == '__main__':
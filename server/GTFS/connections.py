@@ -0,0 +1,72 @@
+import os
+import queue
+import sqlite3
+import threading
+import urllib.parse
+from contextlib import contextmanager
+from typing import Iterator
+
+# the databases are a few tens of MB: they are mapped whole, so their pages are read from the OS page cache shared by
+# every process instead of being copied in the page cache of each connection
+MMAP_SIZE = 256 * 1024 ** 2
+
+# with mmap the page cache only holds the few pages SQLite has to copy, and sorts spill to temporary files instead of
+# private memory
+READ_PRAGMAS = [
+    f'PRAGMA mmap_size = {MMAP_SIZE}',
+    'PRAGMA cache_size = -512',
+    'PRAGMA query_only = 1',
+]
+
+
+def read_only_uri(db_path: str, immutable=True) -> str:
+    uri = f'file:{urllib.parse.quote(os.path.abspath(db_path))}?mode=ro'
+    # immutable databases are opened without locks and without checking for changes made by other connections
+    return f'{uri}&immutable=1' if immutable else uri
+
+
+class ReadOnlyConnectionPool:
+    """Small pool of read-only, memory-mapped connections to a converted GTFS database.
+
+    A thread borrows a connection for the duration of a query with `connection()`: at most `size` connections are
+    opened, lazily, and threads wait for a free one when all of them are in use. With `immutable`, SQLite skips
+    locking and change detection, which is safe because the tables read through the pool are never modified once
+    the database is converted (only stops_clusters is rewritten, through a separate connection).
+    """
+
+    def __init__(self, db_path: str, size=4, immutable=True):
+        self.db_path = db_path
+        self.size = size
+        self.immutable = immutable
+        self._idle: queue.LifoQueue[sqlite3.Connection] = queue.LifoQueue()
+        self._opened: list[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+
+    def open_connection(self) -> sqlite3.Connection:
+        con = sqlite3.connect(read_only_uri(self.db_path, self.immutable), uri=True, check_same_thread=False)
+        for pragma in READ_PRAGMAS:
+            con.execute(pragma)
+        return con
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        try:
+            con = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                con = self.open_connection() if len(self._opened) < self.size else None
+                if con is not None:
+                    self._opened.append(con)
+            if con is None:
+                con = self._idle.get()
+        try:
+            yield con
+        finally:
+            self._idle.put(con)
+
+    def close(self):
+        with self._lock:
+            for con in self._opened:
+                con.close()
+            self._opened = []
+            self._idle = queue.LifoQueue()
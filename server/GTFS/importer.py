@@ -0,0 +1,185 @@
+import csv
+import io
+import logging
+import os
+import sqlite3
+import zipfile
+
+logging.basicConfig(
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+# tables and columns imported from the GTFS files, with the same names and types used by node-gtfs so that the
+# existing databases and the queries on them keep working. Other files and columns are ignored, the *_seconds
+# columns are computed from the times
+GTFS_SCHEMA: dict[str, list[tuple[str, str]]] = {
+    'agency': [('agency_id', 'TEXT'), ('agency_name', 'TEXT'), ('agency_url', 'TEXT'), ('agency_timezone', 'TEXT'),
+               ('agency_lang', 'TEXT'), ('agency_phone', 'TEXT')],
+    'calendar': [('service_id', 'TEXT'), ('monday', 'INTEGER'), ('tuesday', 'INTEGER'), ('wednesday', 'INTEGER'),
+                 ('thursday', 'INTEGER'), ('friday', 'INTEGER'), ('saturday', 'INTEGER'), ('sunday', 'INTEGER'),
+                 ('start_date', 'INTEGER'), ('end_date', 'INTEGER')],
+    'calendar_dates': [('service_id', 'TEXT'), ('date', 'INTEGER'), ('exception_type', 'INTEGER')],
+    'routes': [('route_id', 'TEXT PRIMARY KEY'), ('agency_id', 'TEXT'), ('route_short_name', 'TEXT'),
+               ('route_long_name', 'TEXT'), ('route_type', 'INTEGER'), ('route_color', 'TEXT'),
+               ('route_text_color', 'TEXT')],
+    'stops': [('stop_id', 'TEXT PRIMARY KEY'), ('stop_code', 'TEXT'), ('stop_name', 'TEXT'), ('stop_lat', 'REAL'),
+              ('stop_lon', 'REAL'), ('location_type', 'INTEGER'), ('parent_station', 'TEXT')],
+    'trips': [('trip_id', 'TEXT PRIMARY KEY'), ('route_id', 'TEXT'), ('service_id', 'TEXT'),
+              ('trip_headsign', 'TEXT'), ('direction_id', 'INTEGER'), ('block_id', 'TEXT'), ('shape_id', 'TEXT')],
+    'stop_times': [('trip_id', 'TEXT'), ('arrival_time', 'TEXT'), ('departure_time', 'TEXT'), ('stop_id', 'TEXT'),
+                   ('stop_sequence', 'INTEGER'), ('stop_headsign', 'TEXT'), ('pickup_type', 'INTEGER'),
+                   ('drop_off_type', 'INTEGER'), ('shape_dist_traveled', 'REAL'), ('arrival_seconds', 'INTEGER'),
+                   ('departure_seconds', 'INTEGER')],
+}
+
+# seconds since midnight of the service day of the times, they go beyond 86400 after midnight
+SECONDS_COLUMNS = {'arrival_seconds': 'arrival_time', 'departure_seconds': 'departure_time'}
+
+# origin stop and departure time of each trip, computed once instead of joining stop_times with itself
+TRIP_ORIGINS_TABLE = '''
+    CREATE TABLE trip_origins (
+        trip_id TEXT PRIMARY KEY,
+        orig_stop_id TEXT,
+        orig_dep_time TEXT,
+        orig_dep_seconds INTEGER
+    ) WITHOUT ROWID
+'''
+TRIP_ORIGINS_INSERT = '''
+    INSERT INTO trip_origins
+    SELECT trip_id, stop_id, departure_time, departure_seconds FROM (
+        SELECT trip_id, stop_id, departure_time, departure_seconds, min(stop_sequence) FROM stop_times GROUP BY trip_id
+    )
+'''
+
+# the indexes used by GTFS.get_sqlite_stop_times and GTFS.get_active_service_ids (trips, routes, stops and
+# trip_origins are looked up by their primary keys)
+GTFS_INDEXES = [
+    'CREATE INDEX IF NOT EXISTS idx_stop_times_departure_seconds ON stop_times (departure_seconds)',
+    'CREATE INDEX IF NOT EXISTS idx_stop_times_trip_id_stop_sequence ON stop_times (trip_id, stop_sequence)',
+    'CREATE INDEX IF NOT EXISTS idx_calendar_dates_date ON calendar_dates (date)',
+]
+
+TIME_COLUMNS = {'arrival_time', 'departure_time'}
+
+IMPORT_PRAGMAS = [
+    'PRAGMA journal_mode = OFF',
+    'PRAGMA synchronous = OFF',
+    'PRAGMA locking_mode = EXCLUSIVE',
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA cache_size = -65536',
+]
+
+
+def normalize_time(value: str) -> str | None:
+    # times after midnight of the service day go beyond 24:00, single digit hours are padded so that times compare
+    # as strings
+    if not value:
+        return None
+    return value.zfill(8) if len(value) == 7 else value
+
+
+def time_to_seconds(value: str | None) -> int | None:
+    if not value:
+        return None
+    hours, minutes, seconds = value.split(':')
+    return int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+
+
+def iter_rows(reader, header: list[str], columns: list[tuple[str, str]]):
+    names = [column for column, _ in columns]
+    positions = [header.index(column) if column in header else None for column in names]
+    time_positions = [i for i, column in enumerate(names) if column in TIME_COLUMNS]
+    seconds_positions = [(i, names.index(SECONDS_COLUMNS[column])) for i, column in enumerate(names) if
+                         column in SECONDS_COLUMNS]
+    for row in reader:
+        if not row:
+            continue
+        # values are inserted as text, the type affinity of the columns converts them
+        values = [row[position] or None if position is not None and position < len(row) else None for position in
+                  positions]
+        for i in time_positions:
+            values[i] = normalize_time(values[i])
+        for i, time_position in seconds_positions:
+            values[i] = time_to_seconds(values[time_position])
+        yield values
+
+
+def upgrade_gtfs_db(con: sqlite3.Connection) -> bool:
+    """Add the seconds columns, the trip_origins table and the indexes to a database converted by node-gtfs.
+
+    Does nothing when the database already has them, returns whether it was upgraded.
+    """
+    if con.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'trip_origins'").fetchone():
+        return False
+
+    with con:
+        columns = {row[1] for row in con.execute('PRAGMA table_info(stop_times)')}
+        for seconds_column, time_column in SECONDS_COLUMNS.items():
+            if seconds_column not in columns:
+                con.execute(f'ALTER TABLE stop_times ADD COLUMN {seconds_column} INTEGER')
+            con.execute(f'''
+                UPDATE stop_times SET {seconds_column} = substr({time_column}, 1, 2) * 3600 +
+                    substr({time_column}, 4, 2) * 60 + substr({time_column}, 7, 2)
+                WHERE {time_column} IS NOT NULL
+            ''')
+        con.execute(TRIP_ORIGINS_TABLE)
+        con.execute(TRIP_ORIGINS_INSERT)
+        for index in GTFS_INDEXES:
+            con.execute(index)
+    con.execute('ANALYZE')
+    return True
+
+
+def import_gtfs_zip(zip_path: str, db_path: str) -> dict[str, int]:
+    """Import the GTFS zip file at `zip_path` into a new SQLite database at `db_path`.
+
+    The CSV files are streamed from the zip without extracting them and loaded with executemany in a single
+    transaction; indexes are created after the rows are loaded. The database is written to a temporary file that
+    replaces `db_path` only when the import succeeds. Returns the number of rows imported per table.
+    """
+    tmp_path = f'{db_path}.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    counts = {}
+    con = sqlite3.connect(tmp_path, isolation_level=None)
+    try:
+        for pragma in IMPORT_PRAGMAS:
+            con.execute(pragma)
+        con.execute('BEGIN')
+
+        with zipfile.ZipFile(zip_path) as zip_file:
+            # members may be in a subdirectory of the zip
+            members = {os.path.splitext(os.path.basename(name))[0]: name for name in zip_file.namelist() if
+                       name.endswith('.txt')}
+            for table, columns in GTFS_SCHEMA.items():
+                con.execute(f'CREATE TABLE {table} ({", ".join(f"{column} {type_}" for column, type_ in columns)})')
+                if table not in members:
+                    counts[table] = 0
+                    continue
+
+                with zip_file.open(members[table]) as f:
+                    reader = csv.reader(io.TextIOWrapper(f, encoding='utf-8-sig', newline=''))
+                    header = [column.strip() for column in next(reader, [])]
+                    placeholders = ', '.join(['?'] * len(columns))
+                    cur = con.executemany(f'INSERT INTO {table} VALUES ({placeholders})',
+                                          iter_rows(reader, header, columns))
+                    counts[table] = cur.rowcount
+
+        con.execute(TRIP_ORIGINS_TABLE)
+        con.execute(TRIP_ORIGINS_INSERT)
+        counts['trip_origins'] = con.execute('SELECT count(*) FROM trip_origins').fetchone()[0]
+        for index in GTFS_INDEXES:
+            con.execute(index)
+        con.execute('COMMIT')
+        con.execute('ANALYZE')
+    except BaseException:
+        con.close()
+        os.remove(tmp_path)
+        raise
+    con.close()
+
+    os.replace(tmp_path, db_path)
+    logger.info('imported %s into %s: %s', zip_path, db_path, counts)
+    return counts
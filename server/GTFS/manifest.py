@@ -0,0 +1,89 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from datetime import date, datetime
+
+WEEKDAYS = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+
+
+def file_sha256(path: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def scan_calendar(db_path: str) -> dict:
+    """Service date range of a converted GTFS database and the first start date of the services of each weekday."""
+    min_start_dates = ', '.join(f'min(CASE WHEN {weekday} = 1 THEN start_date END)' for weekday in WEEKDAYS)
+    with sqlite3.connect(db_path) as con:
+        row = con.execute(f'SELECT min(start_date), max(end_date), {min_start_dates} FROM calendar').fetchone()
+
+    def to_iso(value):
+        return datetime.strptime(str(value), '%Y%m%d').date().isoformat() if value else None
+
+    return {
+        'start_date': to_iso(row[0]),
+        'end_date': to_iso(row[1]),
+        'weekday_start_dates': {weekday: to_iso(value) for weekday, value in zip(WEEKDAYS, row[2:])}
+    }
+
+
+class GTFSManifest:
+    """Persisted summary of the downloaded GTFS versions of a transport type.
+
+    For each version it stores the service date range, the first start date of the services of each weekday and
+    the hash of the published zip, together with the latest version published by ACTV. Resolving the version in
+    service only reads this file: the calendar of a version is scanned once, when it is converted or when its entry
+    is missing, and the ACTV listing is fetched only when no latest version is known.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self.data = {'latest_version': None, 'latest_checked_at': None, 'versions': {}}
+        if os.path.isfile(path):
+            with open(path) as f:
+                self.data.update(json.load(f))
+
+    @property
+    def latest_version(self) -> int | None:
+        return self.data['latest_version']
+
+    def set_latest_version(self, version: int, checked_at: datetime = None):
+        self.data['latest_version'] = version
+        self.data['latest_checked_at'] = (checked_at or datetime.now()).isoformat(timespec='seconds')
+        self.save()
+
+    def save(self):
+        # the file is replaced atomically, processes starting at the same time never read a partial manifest
+        with self._lock:
+            tmp_path = f'{self.path}.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(self.data, f, indent=2, sort_keys=True)
+            os.replace(tmp_path, self.path)
+
+    def get_version(self, version: int, db_path: str) -> dict:
+        """Entry of `version`, computed from the database at `db_path` when missing."""
+        entry = self.data['versions'].get(str(version))
+        if entry:
+            return entry
+        return self.add_version(version, db_path)
+
+    def add_version(self, version: int, db_path: str, zip_path: str = None) -> dict:
+        # the calendar of a version never changes once converted, its entry is only replaced when the version is
+        # converted again. The hash is the one of the published zip, the database is modified after the conversion
+        entry = {
+            **scan_calendar(db_path),
+            'sha256': file_sha256(zip_path) if zip_path and os.path.isfile(zip_path) else None
+        }
+        self.data['versions'][str(version)] = entry
+        self.save()
+        return entry
+
+    def service_start_date(self, version: int, db_path: str, weekday: str) -> date | None:
+        start_date = self.get_version(version, db_path)['weekday_start_dates'][weekday]
+        return date.fromisoformat(start_date) if start_date else None
@@ -0,0 +1,321 @@
+import bisect
+import struct
+import threading
+import time
+from datetime import date, datetime
+from typing import Callable, Iterator
+
+from server.base.models import StopTime
+
+# GTFS-Realtime is decoded straight from the protobuf wire format: only the few fields used here are read, the
+# others are skipped without being parsed
+WIRE_VARINT, WIRE_FIXED64, WIRE_BYTES, WIRE_FIXED32 = 0, 1, 2, 5
+
+FULL_DATASET, DIFFERENTIAL = 0, 1
+TRIP_CANCELED = 3
+STOP_SKIPPED, STOP_NO_DATA = 1, 2
+
+
+def read_varint(data: bytes, pos: int) -> tuple[int, int]:
+    result = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+
+def to_signed(value: int) -> int:
+    # negative int32/int64 values are encoded as ten bytes two's complement varints
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def iter_fields(data: bytes) -> Iterator[tuple[int, int | bytes]]:
+    """Yield the (field number, value) pairs of a protobuf message, bytes for the length-delimited fields."""
+    pos, end = 0, len(data)
+    while pos < end:
+        key, pos = read_varint(data, pos)
+        field, wire_type = key >> 3, key & 7
+        if wire_type == WIRE_VARINT:
+            value, pos = read_varint(data, pos)
+        elif wire_type == WIRE_BYTES:
+            length, pos = read_varint(data, pos)
+            value = data[pos:pos + length]
+            pos += length
+        elif wire_type == WIRE_FIXED32:
+            value = data[pos:pos + 4]
+            pos += 4
+        elif wire_type == WIRE_FIXED64:
+            value = data[pos:pos + 8]
+            pos += 8
+        else:
+            raise ValueError(f'unsupported protobuf wire type {wire_type}')
+        yield field, value
+
+
+class TripUpdate:
+    __slots__ = ('trip_id', 'start_date', 'canceled', 'delay', 'stop_sequences', 'delays', 'timestamp')
+
+    def __init__(self, trip_id: str, start_date: date | None, canceled: bool, delay: int | None,
+                 stop_delays: list[tuple[int, int | None]], timestamp: int):
+        self.trip_id = trip_id
+        self.start_date = start_date
+        self.canceled = canceled
+        # trip level delay in seconds, used for the stops before the first stop time update
+        self.delay = delay
+        stop_delays.sort()
+        self.stop_sequences = [stop_sequence for stop_sequence, _ in stop_delays]
+        self.delays = [delay for _, delay in stop_delays]
+        self.timestamp = timestamp
+
+    def stop_delay(self, stop_sequence: int) -> int | None:
+        # the delay of a stop time update applies to the following stops too, until the next update
+        i = bisect.bisect_right(self.stop_sequences, stop_sequence) - 1
+        if i < 0:
+            return self.delay
+        return self.delays[i]
+
+
+class VehiclePosition:
+    __slots__ = ('trip_id', 'lat', 'lon', 'current_stop_sequence', 'stop_id', 'timestamp')
+
+    def __init__(self, trip_id: str, lat: float | None, lon: float | None, current_stop_sequence: int | None,
+                 stop_id: str | None, timestamp: int):
+        self.trip_id = trip_id
+        self.lat = lat
+        self.lon = lon
+        self.current_stop_sequence = current_stop_sequence
+        self.stop_id = stop_id
+        self.timestamp = timestamp
+
+
+def parse_trip_descriptor(data: bytes) -> tuple[str | None, date | None, bool]:
+    trip_id, start_date, canceled = None, None, False
+    for field, value in iter_fields(data):
+        if field == 1:
+            trip_id = value.decode()
+        elif field == 3:
+            start_date = datetime.strptime(value.decode(), '%Y%m%d').date()
+        elif field == 4:
+            canceled = value == TRIP_CANCELED
+    return trip_id, start_date, canceled
+
+
+def parse_stop_time_event_delay(data: bytes) -> int | None:
+    for field, value in iter_fields(data):
+        if field == 1:
+            return to_signed(value)
+    return None
+
+
+def parse_stop_time_update(data: bytes) -> tuple[int | None, int | None]:
+    stop_sequence = arrival_delay = departure_delay = None
+    relationship = 0
+    for field, value in iter_fields(data):
+        if field == 1:
+            stop_sequence = value
+        elif field == 2:
+            arrival_delay = parse_stop_time_event_delay(value)
+        elif field == 3:
+            departure_delay = parse_stop_time_event_delay(value)
+        elif field == 5:
+            relationship = value
+    if relationship in (STOP_SKIPPED, STOP_NO_DATA):
+        return stop_sequence, None
+    return stop_sequence, departure_delay if departure_delay is not None else arrival_delay
+
+
+def parse_trip_update(data: bytes, feed_timestamp: int) -> TripUpdate | None:
+    trip_id, start_date, canceled = None, None, False
+    delay, timestamp = None, feed_timestamp
+    stop_delays = []
+    for field, value in iter_fields(data):
+        if field == 1:
+            trip_id, start_date, canceled = parse_trip_descriptor(value)
+        elif field == 2:
+            stop_sequence, stop_delay = parse_stop_time_update(value)
+            # stop time updates identified only by stop_id cannot be matched to the stop times, they are skipped
+            if stop_sequence is not None:
+                stop_delays.append((stop_sequence, stop_delay))
+        elif field == 4:
+            timestamp = value
+        elif field == 5:
+            delay = to_signed(value)
+    if trip_id is None:
+        return None
+    return TripUpdate(trip_id, start_date, canceled, delay, stop_delays, timestamp)
+
+
+def parse_position(data: bytes) -> tuple[float | None, float | None]:
+    lat = lon = None
+    for field, value in iter_fields(data):
+        if field == 1:
+            lat = struct.unpack('<f', value)[0]
+        elif field == 2:
+            lon = struct.unpack('<f', value)[0]
+    return lat, lon
+
+
+def parse_vehicle_position(data: bytes, feed_timestamp: int) -> VehiclePosition | None:
+    trip_id = lat = lon = current_stop_sequence = stop_id = None
+    timestamp = feed_timestamp
+    for field, value in iter_fields(data):
+        if field == 1:
+            trip_id, _, _ = parse_trip_descriptor(value)
+        elif field == 2:
+            lat, lon = parse_position(value)
+        elif field == 3:
+            current_stop_sequence = value
+        elif field == 5:
+            timestamp = value
+        elif field == 7:
+            stop_id = value.decode()
+    if trip_id is None:
+        return None
+    return VehiclePosition(trip_id, lat, lon, current_stop_sequence, stop_id, timestamp)
+
+
+class FeedMessage:
+    __slots__ = ('incrementality', 'timestamp', 'trip_updates', 'vehicle_positions', 'entity_trips', 'deleted_ids')
+
+    def __init__(self):
+        self.incrementality = FULL_DATASET
+        self.timestamp = 0
+        self.trip_updates: list[TripUpdate] = []
+        self.vehicle_positions: list[VehiclePosition] = []
+        # trip_id of each entity, deletions refer to entities and not to trips
+        self.entity_trips: dict[str, str] = {}
+        self.deleted_ids: list[str] = []
+
+
+def parse_feed(data: bytes) -> FeedMessage:
+    feed = FeedMessage()
+    entities = []
+    for field, value in iter_fields(data):
+        if field == 1:
+            for header_field, header_value in iter_fields(value):
+                if header_field == 2:
+                    feed.incrementality = header_value
+                elif header_field == 3:
+                    feed.timestamp = header_value
+        elif field == 2:
+            entities.append(value)
+
+    # entities are parsed after the header, whose timestamp is the default one of the updates
+    for entity in entities:
+        entity_id, is_deleted, trip_update, vehicle = None, False, None, None
+        for field, value in iter_fields(entity):
+            if field == 1:
+                entity_id = value.decode()
+            elif field == 2:
+                is_deleted = bool(value)
+            elif field == 3:
+                trip_update = value
+            elif field == 4:
+                vehicle = value
+        if is_deleted:
+            feed.deleted_ids.append(entity_id)
+            continue
+        if trip_update is not None:
+            trip_update = parse_trip_update(trip_update, feed.timestamp)
+            if trip_update:
+                feed.trip_updates.append(trip_update)
+                feed.entity_trips[entity_id] = trip_update.trip_id
+        if vehicle is not None:
+            vehicle = parse_vehicle_position(vehicle, feed.timestamp)
+            if vehicle:
+                feed.vehicle_positions.append(vehicle)
+                feed.entity_trips[entity_id] = vehicle.trip_id
+    return feed
+
+
+class GTFSRealtimeIndex:
+    """Trip updates and vehicle positions of the GTFS-Realtime feeds of a source, indexed by trip_id.
+
+    Feeds are applied incrementally: a differential feed only upserts or deletes its entities, a full dataset also
+    drops the trips it previously provided and no longer contains. A deleted entity removes both the trip update and
+    the vehicle position of its trip. Delays are looked up by (trip_id, stop_sequence)
+    and merged into the StopTime instances returned by the queries, as the Trenitalia RealtimeStore does. Trips not
+    updated for `max_age` seconds are ignored.
+    """
+
+    def __init__(self, max_age: float = 15 * 60, clock: Callable[[], float] = time.time):
+        self.max_age = max_age
+        self.clock = clock
+        self.trip_updates: dict[str, TripUpdate] = {}
+        self.vehicle_positions: dict[str, VehiclePosition] = {}
+        self._feed_trips: dict[str, set[str]] = {}
+        self._entity_trips: dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def apply_feed(self, data: bytes, feed_id: str = '') -> int:
+        feed = parse_feed(data)
+        trip_ids = {trip_update.trip_id for trip_update in feed.trip_updates} | \
+                   {vehicle.trip_id for vehicle in feed.vehicle_positions}
+
+        with self._lock:
+            if feed.incrementality == FULL_DATASET:
+                for trip_id in self._feed_trips.get(feed_id, set()) - trip_ids:
+                    self.trip_updates.pop(trip_id, None)
+                    self.vehicle_positions.pop(trip_id, None)
+                self._feed_trips[feed_id] = trip_ids
+            else:
+                self._feed_trips.setdefault(feed_id, set()).update(trip_ids)
+
+            self._entity_trips.update(feed.entity_trips)
+            for entity_id in feed.deleted_ids:
+                trip_id = self._entity_trips.pop(entity_id, entity_id)
+                self.trip_updates.pop(trip_id, None)
+                self.vehicle_positions.pop(trip_id, None)
+
+            for trip_update in feed.trip_updates:
+                current = self.trip_updates.get(trip_update.trip_id)
+                # a feed that was not refreshed by the producer does not overwrite newer data
+                if current is None or current.timestamp <= trip_update.timestamp:
+                    self.trip_updates[trip_update.trip_id] = trip_update
+            for vehicle in feed.vehicle_positions:
+                current = self.vehicle_positions.get(vehicle.trip_id)
+                if current is None or current.timestamp <= vehicle.timestamp:
+                    self.vehicle_positions[vehicle.trip_id] = vehicle
+
+        return len(feed.trip_updates) + len(feed.vehicle_positions)
+
+    def get_trip_update(self, trip_id: str, orig_dep_date: date = None) -> TripUpdate | None:
+        trip_update = self.trip_updates.get(trip_id)
+        if trip_update is None or self.clock() - trip_update.timestamp > self.max_age:
+            return None
+        if orig_dep_date and trip_update.start_date and trip_update.start_date != orig_dep_date:
+            return None
+        return trip_update
+
+    def get_vehicle_position(self, trip_id: str) -> VehiclePosition | None:
+        vehicle = self.vehicle_positions.get(trip_id)
+        if vehicle is None or self.clock() - vehicle.timestamp > self.max_age:
+            return None
+        return vehicle
+
+    def get_delay(self, trip_id: str, stop_sequence: int, orig_dep_date: date = None) -> int | None:
+        """Delay in seconds of the stop time of the trip, None when it is unknown."""
+        trip_update = self.get_trip_update(trip_id, orig_dep_date)
+        if trip_update is None or trip_update.canceled:
+            return None
+        return trip_update.stop_delay(stop_sequence)
+
+    def prune(self):
+        oldest = self.clock() - self.max_age
+        with self._lock:
+            self.trip_updates = {trip_id: trip_update for trip_id, trip_update in self.trip_updates.items() if
+                                 trip_update.timestamp >= oldest}
+            self.vehicle_positions = {trip_id: vehicle for trip_id, vehicle in self.vehicle_positions.items() if
+                                      vehicle.timestamp >= oldest}
+
+    def apply(self, stop_times: list[StopTime]):
+        for stop_time in stop_times:
+            delay = None
+            if stop_time.stop_sequence is not None:
+                delay = self.get_delay(str(stop_time.number), stop_time.stop_sequence, stop_time.orig_dep_date)
+            # stop times show delays in minutes
+            stop_time.delay = round(delay / 60) if delay is not None else None
+            stop_time.realtime_platform = None
@@ -4,10 +4,10 @@ import os
 import re
 import sqlite3
 import ssl
-import subprocess
 import urllib
 import urllib.request
 from datetime import datetime, timedelta, date, time
+from contextlib import closing
 from sqlite3 import Connection
 import arrow
 
@@ -19,7 +19,11 @@ from tqdm import tqdm
 
 from server.base import Source, Station, Stop, TripStopTime, StopTime
 from .clustering import get_clusters_of_stops, get_loc_from_stop_and_cluster
+from .connections import ReadOnlyConnectionPool
+from .importer import import_gtfs_zip, upgrade_gtfs_db
+from .manifest import GTFSManifest
 from .models import CStop
+from .realtime import GTFSRealtimeIndex
 
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
@@ -45,39 +49,83 @@ def get_latest_gtfs_version(transport_type):
 
 class GTFS(Source):
     def __init__(self, transport_type, source_name, emoji, session, typesense, gtfs_versions_range: tuple[int] = None,
-                 location='', dev=False, ref_dt: datetime = None):
-        super().__init__(source_name, emoji, session, typesense)
+                 location='', dev=False, ref_dt: datetime = None, stations_index=None, realtime_feeds: list[str] = None,
+                 read_pool_size=4):
+        super().__init__(source_name, emoji, session, typesense, stations_index)
         self.transport_type = transport_type
         self.location = location
         self.service_ids = {}
-
-        if gtfs_versions_range:
-            init_version = gtfs_versions_range[0]
+        # GTFS-Realtime feeds (TripUpdates and VehiclePositions) whose delays are merged into the stop times
+        self.realtime_feeds = realtime_feeds or []
+        self.realtime = GTFSRealtimeIndex() if self.realtime_feeds else None
+        self.gtfs_versions_range = gtfs_versions_range
+        self.read_pool_size = read_pool_size
+        self.manifest = GTFSManifest(self.file_path('json', 'manifest'))
+
+        self.select_version(ref_dt)
+
+    def select_version(self, ref_dt: datetime = None):
+        if self.gtfs_versions_range:
+            init_version = self.gtfs_versions_range[0]
         else:
-            init_version = get_latest_gtfs_version(transport_type)
+            init_version = self.manifest.latest_version
+            if init_version is None:
+                init_version = self.refresh_latest_version()
 
-        fin_version = gtfs_versions_range[1] if gtfs_versions_range else 0
+        fin_version = self.gtfs_versions_range[1] if self.gtfs_versions_range else 0
 
         if not ref_dt:
             ref_dt = datetime.today()
 
+        if hasattr(self, 'next_service_start_date'):
+            del self.next_service_start_date
+
+        gtfs_version = None
         for try_version in range(init_version, fin_version-1, -1):
             self.download_and_convert_file(try_version)
             service_start_date = self.get_service_start_date(ref_dt, try_version)
             if service_start_date and service_start_date <= ref_dt.date():
-                self.gtfs_version = try_version
+                gtfs_version = try_version
                 break
 
             self.next_service_start_date = service_start_date
 
-        if not hasattr(self, 'gtfs_version'):
-            raise Exception(f'No valid GTFS version found for {transport_type}')
+        if gtfs_version is None:
+            raise Exception(f'No valid GTFS version found for {self.transport_type}')
 
-        self.con = self.connect_to_database(self.gtfs_version)
+        self.gtfs_version = gtfs_version
+        self.service_ids = {}
+        con = self.connect_to_database(self.gtfs_version)
+        try:
+            if upgrade_gtfs_db(con):
+                logger.info('%s database %s upgraded', self.name, self.gtfs_version)
+        finally:
+            con.close()
+
+        # queries go through read-only connections, opened once the database is no longer modified
+        if hasattr(self, 'read_pool'):
+            self.read_pool.close()
+        self.read_pool = ReadOnlyConnectionPool(self.file_path('db', self.gtfs_version), self.read_pool_size)
 
         stops_clusters_uploaded = self.upload_stops_clusters_to_db()
         logger.info('%s stops clusters uploaded: %s', self.name, stops_clusters_uploaded)
 
+    def refresh_latest_version(self) -> int:
+        # the only request to the ACTV website, made when the manifest does not know the latest version yet and by
+        # save_data.py
+        latest_version = get_latest_gtfs_version(self.transport_type)
+        self.manifest.set_latest_version(latest_version)
+        return latest_version
+
+    def refresh_versions(self, ref_dt: datetime = None) -> bool:
+        """Look for a new GTFS version and switch to it if it is already in service, returns whether it did."""
+        current_latest_version = self.manifest.latest_version
+        if self.refresh_latest_version() == current_latest_version:
+            return False
+        previous_version = self.gtfs_version
+        self.select_version(ref_dt)
+        return self.gtfs_version != previous_version
+
     def file_path(self, ext, gtfs_version):
         current_dir = os.path.abspath(os.path.dirname(__file__))
         parent_dir = os.path.abspath(current_dir + f"/../../{self.location}")
@@ -95,34 +143,41 @@ class GTFS(Source):
         logger.info('Downloading %s to %s', url, file_path)
         urllib.request.urlretrieve(url, file_path)
 
-        subprocess.run(["gtfs-import", "--gtfsPath", self.file_path('zip', gtfs_version), '--sqlitePath', self.file_path('db', gtfs_version)])
+        import_gtfs_zip(file_path, self.file_path('db', gtfs_version))
+        self.manifest.add_version(gtfs_version, self.file_path('db', gtfs_version), file_path)
+
+    def poll_realtime(self) -> int:
+        updates = 0
+        for url in self.realtime_feeds:
+            try:
+                response = requests.get(url, timeout=10)
+                response.raise_for_status()
+            except requests.RequestException:
+                logger.exception('%s realtime feed %s could not be fetched', self.name, url)
+                continue
+            updates += self.realtime.apply_feed(response.content, feed_id=url)
+
+        self.realtime.prune()
+        logger.info('%s realtime: %d updates from %d feeds', self.name, updates, len(self.realtime_feeds))
+        return updates
 
     def get_service_start_date(self, ref_dt, gtfs_version) -> date:
         weekday = ref_dt.strftime('%A').lower()
-        with self.connect_to_database(gtfs_version) as con:
-            con.row_factory = sqlite3.Row
-            cur = con.cursor()
-            service = cur.execute(
-                f'SELECT start_date FROM calendar WHERE {weekday} = 1 ORDER BY start_date ASC LIMIT 1'
-            ).fetchone()
-            
-            if not service:
-                return None
-            
-            return datetime.strptime(str(service['start_date']), '%Y%m%d').date()
+        return self.manifest.service_start_date(gtfs_version, self.file_path('db', gtfs_version), weekday)
 
     def connect_to_database(self, gtfs_version) -> Connection:
+        # writable connection, only used to upgrade the database and to write the stops clusters
         return sqlite3.connect(self.file_path('db', gtfs_version))
 
     def get_all_stops(self) -> list[CStop]:
-        cur = self.con.cursor()
         query = """
         SELECT S.stop_id, stop_name, stop_lat, stop_lon, count(s.stop_id) as times_count
             FROM stop_times
                      INNER JOIN stops s on stop_times.stop_id = s.stop_id
             GROUP BY s.stop_id
         """
-        stops = cur.execute(query).fetchall()
+        with self.read_pool.connection() as con:
+            stops = con.execute(query).fetchall()
         return [CStop(*stop) for stop in stops]
     
     def get_all_stop_times(self, day) -> list[TripStopTime]:
@@ -130,7 +185,7 @@ class GTFS(Source):
         
         return stop_times
     
-    def save_data(self):
+    def save_data(self, atomic=False):
         self.upload_stops_clusters_to_db(force=True)
 
         now = datetime.now()
@@ -144,18 +199,30 @@ class GTFS(Source):
 
         limit = 30000
 
+        all_stop_times = []
+
         for params in all_params:
             offset = 0
             while True:
                 stop_times = self.get_sqlite_stop_times(*params, limit, offset)
-                for stop_time in tqdm(stop_times, desc = f'Uploading {self.name} stop_times of day {params[0]}'):
-                    self.upload_trip_stop_time_to_postgres(stop_time)
+                if atomic:
+                    all_stop_times += stop_times
+                else:
+                    for stop_time in tqdm(stop_times, desc = f'Uploading {self.name} stop_times of day {params[0]}'):
+                        self.upload_trip_stop_time_to_postgres(stop_time)
                 if len(stop_times) < limit:
                     break
                 offset += limit
 
+        if atomic:
+            self.upload_stop_times_to_postgres(all_stop_times, atomic=True)
+
     def upload_stops_clusters_to_db(self, force=False) -> bool:
-        cur = self.con.cursor()
+        with closing(self.connect_to_database(self.gtfs_version)) as con:
+            return self.write_stops_clusters(con, force)
+
+    def write_stops_clusters(self, con: Connection, force=False) -> bool:
+        cur = con.cursor()
         if not force:
             # Check if stops_clusters table does not exist
             cur.execute('SELECT name FROM sqlite_master WHERE type="table" AND name="stops_clusters"')
@@ -212,19 +279,47 @@ class GTFS(Source):
             for stop in cluster.stops:
                 cur.execute('INSERT INTO stops_stops_clusters (stop_id, stop_cluster_id) VALUES (?, ?)',
                             (stop.id, cluster_id))
-        self.con.commit()
+        con.commit()
         self.sync_stations_db(new_stations, new_stops)
         return True
 
     def get_sqlite_stop_times(self, day: date, start_time: time, end_time: time, limit: int, offset: int) -> list[TripStopTime]:
-        cur = self.con.cursor()
+        query_params = self.get_sqlite_stop_times_query(day, start_time, end_time, limit, offset)
+        if query_params is None:
+            return []
+
+        with self.read_pool.connection() as con:
+            results = con.execute(*query_params).fetchall()
 
+        stop_times = []
+        for result in results:
+            location = get_loc_from_stop_and_cluster(result[5])
+            dep_time = time(result[6], result[7])
+            dep_dt = arrow.get(datetime.combine(day, dep_time), 'Europe/Berlin').datetime
+            arr_dt = dep_dt
+            orig_dep_time = time(result[9], result[10])
+            orig_dep_date = day if orig_dep_time <= dep_time else day - timedelta(days=1)
+            headsign = result[2] if result[2] else ''
+            stop = Station(id=result[11])
+
+            if result[4] == 1:
+                arr_dt = None
+            if result[12] == 1:
+                dep_dt = None
+
+            stop_time = TripStopTime(stop, result[8], dep_dt, result[4], 0, location, headsign, result[3], result[1], arr_dt, orig_dep_date, headsign)
+            stop_times.append(stop_time)
+
+        return stop_times
+
+    def get_sqlite_stop_times_query(self, day: date, start_time: time, end_time: time, limit: int,
+                                    offset: int) -> tuple[str, tuple] | None:
         today_service_ids = self.get_active_service_ids(day)
 
         start_dt = datetime.combine(day, start_time)
         end_dt = datetime.combine(day, end_time)
 
-        today_service = f"(t.service_id in ({','.join(['?'] * len(today_service_ids))}) AND dep.departure_time >= ? AND dep.departure_time <= ?)"
+        today_service = f"(t.service_id in ({','.join(['?'] * len(today_service_ids))}) AND dep.departure_seconds >= ? AND dep.departure_seconds <= ?)"
 
         if hasattr(self, 'next_service_start_date'):
             if day >= self.next_service_start_date:
@@ -236,12 +331,12 @@ class GTFS(Source):
             yesterday_service_ids = self.get_active_service_ids(day - timedelta(days=1))
             if yesterday_service_ids:
                 or_other_service_ids = ','.join(['?'] * len(yesterday_service_ids))
-                yesterday_service = f'(dep.departure_time >= ? AND t.service_id in ({or_other_service_ids}))'
+                yesterday_service = f'(dep.departure_seconds >= ? AND t.service_id in ({or_other_service_ids}))'
             else:
                 start_dt = datetime.combine(day, time(6))
 
         if yesterday_service == '' and today_service == '':
-            return []
+            return None
 
         if yesterday_service != '' and today_service != '':
             today_service += ' OR '
@@ -253,22 +348,18 @@ class GTFS(Source):
             t.trip_id              as trip_id,
             dep.stop_sequence       as stop_sequence,
             s.stop_name          as dep_stop_name,
-            CAST(SUBSTR(dep.departure_time, 1, 2) AS INTEGER) % 24 dep_hour_normalized,
-            CAST(SUBSTR(dep.departure_time, 4, 2) AS INTEGER) dep_minute,
-            orig_stop_id           as orig_stop_id,
-            CAST(SUBSTR(orig_dep_time, 1, 2) AS INTEGER) % 24 orig_dep_hour_normalized,
-            CAST(SUBSTR(orig_dep_time, 4, 2) AS INTEGER) orig_dep_minute,
+            dep.departure_seconds / 3600 % 24 dep_hour_normalized,
+            dep.departure_seconds / 60 % 60 dep_minute,
+            orig.orig_stop_id      as orig_stop_id,
+            orig.orig_dep_seconds / 3600 % 24 orig_dep_hour_normalized,
+            orig.orig_dep_seconds / 60 % 60 orig_dep_minute,
             dep.stop_id as dep_stop_id,
             dep.pickup_type as dep_pickup_type"""
 
         query = f"""
                 SELECT {select_elements}
                 FROM stop_times dep
-                         INNER JOIN (SELECT trip_id, departure_time as orig_dep_time, stop_id as orig_stop_id
-                             FROM stop_times
-                             WHERE stop_sequence = 1
-                            )
-                         orig ON dep.trip_id = orig.trip_id
+                         INNER JOIN trip_origins orig ON dep.trip_id = orig.trip_id
                          INNER JOIN trips t ON dep.trip_id = t.trip_id
                          INNER JOIN routes r ON t.route_id = r.route_id
                          INNER JOIN stops s ON dep.stop_id = s.stop_id
@@ -278,37 +369,16 @@ class GTFS(Source):
         params = ()
 
         if today_service != '':
-            params += (*today_service_ids, start_dt.strftime('%H:%M'), end_dt.strftime('%H:%M'))
+            params += (*today_service_ids, start_dt.hour * 3600 + start_dt.minute * 60,
+                       end_dt.hour * 3600 + end_dt.minute * 60)
 
         if yesterday_service != '':
-            # in the string add 24 hours to start_dt time
-            start_time_25 = f'{start_dt.hour + 24:02}:{start_dt.minute:02}'
-            params += (start_time_25, *yesterday_service_ids)
+            # times of the service of the day before go beyond 24 hours
+            params += ((start_dt.hour + 24) * 3600 + start_dt.minute * 60, *yesterday_service_ids)
 
         params += (limit, offset)
 
-        results = cur.execute(query, params).fetchall()
-
-        stop_times = []
-        for result in results:
-            location = get_loc_from_stop_and_cluster(result[5])
-            dep_time = time(result[6], result[7])
-            dep_dt = arrow.get(datetime.combine(day, dep_time), 'Europe/Berlin').datetime
-            arr_dt = dep_dt
-            orig_dep_time = time(result[9], result[10])
-            orig_dep_date = day if orig_dep_time <= dep_time else day - timedelta(days=1)
-            headsign = result[2] if result[2] else ''
-            stop = Station(id=result[11])
-
-            if result[4] == 1:
-                arr_dt = None
-            if result[12] == 1:
-                dep_dt = None
-
-            stop_time = TripStopTime(stop, result[8], dep_dt, result[4], 0, location, headsign, result[3], result[1], arr_dt, orig_dep_date, headsign)
-            stop_times.append(stop_time)
-
-        return stop_times
+        return query, params
 
     def search_lines(self, name):
         today = date.today()
@@ -334,20 +404,16 @@ class GTFS(Source):
 
         weekday = day.strftime('%A').lower()
 
-        cur = self.con.cursor()
-        services = cur.execute(
-            f'SELECT service_id FROM calendar WHERE {weekday} = 1 AND start_date <= ? AND end_date >= ?',
-            (today_ymd, today_ymd))
-
-        if not services:
-            return ()
-
-        service_ids = set([service[0] for service in services.fetchall()])
+        with self.read_pool.connection() as con:
+            services = con.execute(
+                f'SELECT service_id FROM calendar WHERE {weekday} = 1 AND start_date <= ? AND end_date >= ?',
+                (today_ymd, today_ymd)).fetchall()
+            service_exceptions = con.execute(
+                'SELECT service_id, exception_type FROM calendar_dates WHERE date = ?', (today_ymd,)).fetchall()
 
-        service_exceptions = cur.execute('SELECT service_id, exception_type FROM calendar_dates WHERE date = ?',
-                                         (today_ymd,))
+        service_ids = set([service[0] for service in services])
 
-        for service_exception in service_exceptions.fetchall():
+        for service_exception in service_exceptions:
             service_id, exception_type = service_exception
             if exception_type == 1:
                 service_ids.add(service_id)
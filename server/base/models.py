@@ -2,7 +2,7 @@ from datetime import date, datetime
 from typing import Optional
 
 from zoneinfo import ZoneInfo
-from sqlalchemy import ForeignKey, UniqueConstraint
+from sqlalchemy import ForeignKey, UniqueConstraint, func
 from sqlalchemy.orm import declarative_base, Mapped, mapped_column, relationship
 from sqlalchemy_utc import UtcDateTime
 
@@ -23,6 +23,9 @@ class DBSource(Base):
     city: Mapped[City] = relationship('City', back_populates='sources')
     color: Mapped[str]
     icon_code: Mapped[int]
+    # bumped by save_data every time the data of the source is ingested, see server.caching
+    data_version: Mapped[int] = mapped_column(server_default='0')
+    data_updated_at: Mapped[datetime] = mapped_column(UtcDateTime, server_default=func.now())
 
     def as_dict(self):
         return {
@@ -85,6 +88,13 @@ class StopTime(Base):
     source: Mapped[str] = mapped_column(ForeignKey('sources.name'))
     stop_id: Mapped[str] = mapped_column(ForeignKey('stops.id'))
     stop: Mapped[Stop] = relationship('Stop', foreign_keys=stop_id)
+
+    # realtime data merged at read time (see server.base.realtime), never stored in the table
+    delay = None
+    realtime_platform = None
+
+    def current_platform(self):
+        return self.realtime_platform or self.platform
     
     def tz_sched_arr_dt(self):
         return self.sched_arr_dt.astimezone(ZoneInfo('Europe/Berlin'))
@@ -95,13 +105,36 @@ class StopTime(Base):
     __table_args__ = (UniqueConstraint("stop_id", "number", "source", "orig_dep_date", "stop_sequence", 
                                        name="stop_times_unique_idx", postgresql_nulls_not_distinct=True),)
 
+    # keys of as_dict, and order of the values of as_row
+    API_FIELDS = ('id', 'sched_arr_dt', 'sched_dep_dt', 'orig_dep_date', 'platform', 'delay', 'orig_id', 'dest_text',
+                  'number', 'route_name', 'source', 'stop_id')
+
+    def as_row(self) -> list:
+        # datetimes are local and naive, they are serialized by the JSON encoder (see server.responses) in the same
+        # format of as_dict
+        return [
+            self.id,
+            self.tz_sched_arr_dt().replace(tzinfo=None) if self.sched_arr_dt else None,
+            self.tz_sched_dep_dt().replace(tzinfo=None) if self.sched_dep_dt else None,
+            self.orig_dep_date,
+            self.current_platform(),
+            self.delay,
+            self.orig_id,
+            self.dest_text,
+            self.number,
+            self.route_name,
+            self.source,
+            self.stop_id,
+        ]
+
     def as_dict(self):
         return {
             'id': self.id,
             'sched_arr_dt': self.tz_sched_arr_dt().replace(tzinfo=None).isoformat() if self.sched_arr_dt else None,
             'sched_dep_dt': self.tz_sched_dep_dt().replace(tzinfo=None).isoformat() if self.sched_dep_dt else None,
             'orig_dep_date': self.orig_dep_date.isoformat(),
-            'platform': self.platform,
+            'platform': self.current_platform(),
+            'delay': self.delay,
             'orig_id': self.orig_id,
             'dest_text': self.dest_text,
             'number': self.number,
@@ -0,0 +1,55 @@
+import threading
+import time
+from datetime import date
+from typing import Callable
+
+from .models import StopTime
+
+RealtimeKey = tuple[int, date, str]
+
+
+class RealtimeUpdate:
+    __slots__ = ('delay', 'platform', 'updated_at')
+
+    def __init__(self, delay: int | None, platform: str | None, updated_at: float):
+        self.delay = delay
+        self.platform = platform
+        self.updated_at = updated_at
+
+
+class RealtimeStore:
+    """Delays and platforms of the stop times in service, kept apart from the static timetable.
+
+    Updates are keyed by (trip number, orig_dep_date, stop_id) and are merged into the StopTime instances returned by
+    the queries, without writing them to the database. Updates older than `max_age` seconds are ignored.
+    """
+
+    def __init__(self, max_age: float = 15 * 60, clock: Callable[[], float] = time.monotonic):
+        self.max_age = max_age
+        self.clock = clock
+        self._updates: dict[RealtimeKey, RealtimeUpdate] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._updates)
+
+    def update(self, number: int, orig_dep_date: date, stop_id: str, delay: int | None, platform: str | None):
+        with self._lock:
+            self._updates[(number, orig_dep_date, stop_id)] = RealtimeUpdate(delay, platform, self.clock())
+
+    def get(self, number: int, orig_dep_date: date, stop_id: str) -> RealtimeUpdate | None:
+        update = self._updates.get((number, orig_dep_date, stop_id))
+        if update and self.clock() - update.updated_at <= self.max_age:
+            return update
+        return None
+
+    def prune(self):
+        oldest = self.clock() - self.max_age
+        with self._lock:
+            self._updates = {key: update for key, update in self._updates.items() if update.updated_at >= oldest}
+
+    def apply(self, stop_times: list[StopTime]):
+        for stop_time in stop_times:
+            update = self.get(stop_time.number, stop_time.orig_dep_date, stop_time.stop_id)
+            stop_time.delay = update.delay if update else None
+            stop_time.realtime_platform = update.platform if update else None
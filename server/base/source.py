@@ -1,19 +1,31 @@
+import asyncio
 import logging
-from datetime import datetime, date, timedelta
+from datetime import datetime, date, timedelta, timezone
 
-from sqlalchemy import select, func, and_
+from sqlalchemy import select, func, and_, literal, union_all, cast, null, Integer
 from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.orm import aliased
+from tqdm import tqdm
 
-from server.typesense.helpers import ts_search_stations
+from server import partitions, metrics
+from server.typesense import helpers as typesense_helpers
 from tgbot.formatting import Liner
 from .models import Station, Stop, StopTime
+from .realtime import RealtimeStore
 
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
 )
 logger = logging.getLogger(__name__)
 
+QUERY_SECONDS = metrics.histogram('muoversi_source_query_seconds', 'Duration of the queries of the sources',
+                                  ['source', 'method'])
+INGESTED_ROWS = metrics.counter('muoversi_ingested_rows_total', 'Stop times uploaded to Postgres by the ingestion',
+                                ['source'])
+INGESTION_ROWS_PER_SECOND = metrics.gauge('muoversi_ingestion_rows_per_second',
+                                          'Stop times uploaded per second by the last save_data of the source',
+                                          ['source'])
+
 
 class BaseStopTime(Liner):
     def __init__(self, station: 'Station', dep_time: datetime | None, arr_time: datetime | None, stop_sequence,
@@ -50,57 +62,131 @@ class TripStopTime(BaseStopTime):
         self.arr_time = arr_stop_time.arr_time
 
 
+class Board:
+    """Stop times board requested with `Source.get_boards`: the departures from `dep_stops_ids`, or the trips from
+    `dep_stops_ids` to `arr_stops_ids` when these are set, with the same parameters of `Source.get_stop_times`."""
+
+    def __init__(self, dep_stops_ids: str, start_dt: datetime, arr_stops_ids: str = None, line='',
+                 offset: int | tuple[int] = 0, limit: int | None = None, direction=1, end_dt: datetime = None):
+        self.dep_stops_ids = dep_stops_ids
+        self.arr_stops_ids = arr_stops_ids
+        self.start_dt = start_dt
+        self.line = line
+        self.offset = offset
+        self.limit = limit
+        self.direction = direction
+        self.end_dt = end_dt
+
+
+STOP_TIME_COLUMNS = [column.key for column in StopTime.__table__.columns]
+
+
+def board_columns(stop_times, prefix: str) -> list:
+    # columns of the stop times selected by a branch of Source.get_boards, typed NULLs when `stop_times` is None
+    if stop_times is None:
+        return [cast(null(), column.type).label(prefix + column.key) for column in StopTime.__table__.columns]
+    return [getattr(stop_times, key).label(prefix + key) for key in STOP_TIME_COLUMNS]
+
+
+def row_stop_time(row, prefix: str) -> StopTime:
+    return StopTime(**{key: row._mapping[prefix + key] for key in STOP_TIME_COLUMNS})
+
+
 class Source:
     LIMIT = 7
     MINUTES_TOLERANCE = 3
 
-    def __init__(self, name, emoji, session, typesense):
+    def __init__(self, name, emoji, session, typesense, stations_index=None):
         self.name = name
         self.emoji = emoji
         self.session = session
         self.typesense = typesense
-
+        # when set, stations are searched in this in-process index instead of Typesense
+        self.stations_index = stations_index
+        # when set, realtime delays and platforms are merged into the stop times returned by the queries, it can be a
+        # RealtimeStore or any object with the same apply(stop_times) method
+        self.realtime: RealtimeStore | None = None
+        # incremented after every successful realtime poll, part of the validators of the stop times responses
+        self.realtime_version = 0
+        self.realtime_updated_at: datetime | None = None
+
+    @metrics.timed_method(QUERY_SECONDS, 'search_stations')
     def search_stations(self, name=None, lat=None, lon=None, page=1, limit=4, all_sources=False,
-                     hide_ids: list[str] = None) -> tuple[list[Station], int]:
-        sources = [] if all_sources else [self.name]
-        return ts_search_stations(self.typesense, sources, name, lat, lon, page, limit, hide_ids)
-
-    def get_stop_times(self, stops_ids, line, start_dt: datetime, offset: int | tuple[int], count=False,
-                       limit: int | None = None, direction=1, end_dt: datetime = None) -> list[StopTime] | list[str]:
-
-        if limit is None:
-            limit = self.LIMIT
-
-        stops_ids = stops_ids.split(',')
-
-        if count:
-            stmt = select(StopTime.route_name)
-        else:
-            stmt = select(StopTime)
-
+                     hide_ids: list[str] = None, sources: list[str] = None) -> tuple[list[Station], int]:
+        if sources is None:
+            sources = [] if all_sources else [self.name]
+        if self.stations_index is not None:
+            return self.stations_index.search(sources, name, lat, lon, page, limit, hide_ids)
+        return typesense_helpers.ts_search_stations(self.typesense, sources, name, lat, lon, page, limit, hide_ids)
+
+    def filter_departures(self, stmt, departures, stops_ids: list[str], line, start_dt: datetime,
+                          offset: int | tuple[int], direction=1, end_dt: datetime = None):
+        """Filters shared by the stop times queries, applied on `departures` (StopTime or one of its aliases)."""
         start_day_minus_one = start_dt.date() - timedelta(days=1)
-        stmt = stmt.filter(StopTime.orig_dep_date >= start_day_minus_one)
+        stmt = stmt.filter(departures.orig_dep_date >= start_day_minus_one)
 
         if end_dt:
-            stmt = stmt.filter(StopTime.orig_dep_date <= end_dt.date())
+            stmt = stmt.filter(departures.orig_dep_date <= end_dt.date())
 
-        stmt = stmt.filter(StopTime.stop_id.in_(stops_ids))
+        stmt = stmt.filter(departures.stop_id.in_(stops_ids))
 
         if direction == 1:
-            stmt = stmt.filter(StopTime.sched_dep_dt >= start_dt)
+            stmt = stmt.filter(departures.sched_dep_dt >= start_dt)
             if end_dt:
-                stmt = stmt.filter(StopTime.sched_dep_dt <= end_dt)
+                stmt = stmt.filter(departures.sched_dep_dt <= end_dt)
         else:
-            stmt = stmt.filter(StopTime.sched_dep_dt <= start_dt)
+            stmt = stmt.filter(departures.sched_dep_dt <= start_dt)
             if end_dt:
-                stmt = stmt.filter(StopTime.sched_dep_dt >= end_dt)
+                stmt = stmt.filter(departures.sched_dep_dt >= end_dt)
 
         # if we are offsetting by ids of stop times (tuple[int])
         if isinstance(offset, tuple):
-            stmt = stmt.filter(StopTime.id.notin_(offset))
+            stmt = stmt.filter(departures.id.notin_(offset))
 
         if line != '':
-            stmt = stmt.filter(StopTime.route_name == line)
+            stmt = stmt.filter(departures.route_name == line)
+
+        return stmt
+
+    @staticmethod
+    def order_stop_times(stmt, offset: int | tuple[int], limit: int, direction, order_by: list, then_by: list = None):
+        if direction == 1:
+            stmt = stmt.order_by(*[column.asc() for column in order_by], *(then_by or []))
+        else:
+            stmt = stmt.order_by(*[column.desc() for column in order_by], *(then_by or []))
+
+        if isinstance(offset, int):
+            stmt = stmt.offset(offset)
+
+        return stmt.limit(limit)
+
+    def join_arrivals(self, stmt, departures, arrivals, arr_stops_ids: list[str]):
+        return stmt \
+            .select_from(departures) \
+            .join(arrivals, and_(departures.number == arrivals.number,
+                                 departures.orig_dep_date == arrivals.orig_dep_date,
+                                 departures.source == arrivals.source)) \
+            .filter(arrivals.stop_id.in_(arr_stops_ids), departures.sched_dep_dt < arrivals.sched_arr_dt)
+
+    @staticmethod
+    def distinct_trips(departures) -> list:
+        return [departures.sched_dep_dt, departures.orig_dep_date, departures.source, departures.number]
+
+    @metrics.timed_method(QUERY_SECONDS, 'get_stop_times')
+    def get_stop_times(self, stops_ids, line, start_dt: datetime, offset: int | tuple[int], count=False,
+                       limit: int | None = None, direction=1, end_dt: datetime = None) -> list[StopTime] | list[str]:
+
+        if limit is None:
+            limit = self.LIMIT
+
+        stops_ids = stops_ids.split(',')
+
+        if count:
+            stmt = select(StopTime.route_name)
+        else:
+            stmt = select(StopTime)
+
+        stmt = self.filter_departures(stmt, StopTime, stops_ids, line, start_dt, offset, direction, end_dt)
 
         if count:
             stmt = stmt \
@@ -108,15 +194,7 @@ class Source:
                 .order_by(func.count(StopTime.route_name).desc())
             stop_times = self.session.execute(stmt).all()
         else:
-            if direction == 1:
-                stmt = stmt.order_by(StopTime.sched_dep_dt.asc())
-            else:
-                stmt = stmt.order_by(StopTime.sched_dep_dt.desc())
-
-            if isinstance(offset, int):
-                stmt = stmt.offset(offset)
-
-            stmt = stmt.limit(limit)
+            stmt = self.order_stop_times(stmt, offset, limit, direction, [StopTime.sched_dep_dt])
 
             stop_times = self.session.scalars(stmt).all()
 
@@ -126,8 +204,12 @@ class Source:
         if count:
             return [train.route_name for train in stop_times]
 
+        if self.realtime is not None:
+            self.realtime.apply(stop_times)
+
         return stop_times
 
+    @metrics.timed_method(QUERY_SECONDS, 'get_stop_times_between_stops')
     def get_stop_times_between_stops(self, dep_stops_ids, arr_stops_ids, line, start_dt: datetime,
                                      offset: int | tuple[int],
                                      count=False, limit: int | None = None, direction=1, end_dt: datetime = None) \
@@ -146,64 +228,17 @@ class Source:
         if count:
             stmt = select(d_stop_times.route_name)
         else:
-            stmt = select(d_stop_times, a_stop_times) \
-                .distinct(d_stop_times.sched_dep_dt,
-                          d_stop_times.orig_dep_date,
-                          d_stop_times.source,
-                          d_stop_times.number)
-
-        stmt = stmt \
-            .select_from(d_stop_times) \
-            .join(a_stop_times, and_(d_stop_times.number == a_stop_times.number,
-                                     d_stop_times.orig_dep_date == a_stop_times.orig_dep_date,
-                                     d_stop_times.source == a_stop_times.source))
-        
-        start_day_minus_one = start_dt.date() - timedelta(days=1)
-        stmt = stmt.filter(d_stop_times.orig_dep_date >= start_day_minus_one)
-
-        if end_dt:
-            stmt = stmt.filter(d_stop_times.orig_dep_date <= end_dt.date())
-
-        stmt = stmt.filter(d_stop_times.stop_id.in_(dep_stops_ids), a_stop_times.stop_id.in_(arr_stops_ids),
-                           d_stop_times.sched_dep_dt < a_stop_times.sched_arr_dt)
-
-        if direction == 1:
-            stmt = stmt.filter(d_stop_times.sched_dep_dt >= start_dt)
-            if end_dt:
-                stmt = stmt.filter(d_stop_times.sched_dep_dt <= end_dt)
-        else:
-            stmt = stmt.filter(d_stop_times.sched_dep_dt <= start_dt)
-            if end_dt:
-                stmt = stmt.filter(d_stop_times.sched_dep_dt >= end_dt)
+            stmt = select(d_stop_times, a_stop_times).distinct(*self.distinct_trips(d_stop_times))
 
-        # if we are offsetting by ids of stop times (tuple[int])
-        if isinstance(offset, tuple):
-            stmt = stmt.filter(d_stop_times.id.notin_(offset))
-
-        if line != '':
-            stmt = stmt.filter(d_stop_times.route_name == line)
+        stmt = self.join_arrivals(stmt, d_stop_times, a_stop_times, arr_stops_ids)
+        stmt = self.filter_departures(stmt, d_stop_times, dep_stops_ids, line, start_dt, offset, direction, end_dt)
 
         if count:
             stmt = stmt.group_by(d_stop_times.route_name).order_by(
                 func.count(d_stop_times.route_name).desc())
         else:
-            if direction == 1:
-                stmt = stmt.order_by(d_stop_times.sched_dep_dt.asc(),
-                                     d_stop_times.orig_dep_date.asc(),
-                                     d_stop_times.source.asc(),
-                                     d_stop_times.number.asc(),
-                                     a_stop_times.sched_arr_dt.asc())
-            else:
-                stmt = stmt.order_by(d_stop_times.sched_dep_dt.desc(),
-                                     d_stop_times.orig_dep_date.desc(),
-                                     d_stop_times.source.desc(),
-                                     d_stop_times.number.desc(),
-                                     a_stop_times.sched_arr_dt.asc())
-
-            if isinstance(offset, int):
-                stmt = stmt.offset(offset)
-
-            stmt = stmt.limit(limit)
+            stmt = self.order_stop_times(stmt, offset, limit, direction, self.distinct_trips(d_stop_times),
+                                         [a_stop_times.sched_arr_dt.asc()])
 
         raw_stop_times = self.session.execute(stmt).all()
 
@@ -219,8 +254,63 @@ class Source:
             d_stop_time, a_stop_time = raw_stop_time
             stop_times_tuples.append((d_stop_time, a_stop_time))
 
+        if self.realtime is not None:
+            self.realtime.apply([stop_time for stop_times_tuple in stop_times_tuples for stop_time in stop_times_tuple])
+
         return stop_times_tuples
 
+    @metrics.timed_method(QUERY_SECONDS, 'get_boards')
+    def get_boards(self, boards: list[Board]) -> list[list[StopTime] | list[tuple[StopTime, StopTime]]]:
+        """Stop times of several boards with a single query, in the same order as `boards`.
+
+        Each board is a branch of a UNION ALL, with the same filters, ordering and limit of `get_stop_times` (or
+        `get_stop_times_between_stops` for boards with arrival stops), so that every branch can use the indexes of
+        stop_times on its own. The rows are returned as departures and arrivals columns side by side, the arrival ones
+        being NULL for departure boards.
+        """
+        if not boards:
+            return []
+
+        branches = []
+        for i, board in enumerate(boards):
+            limit = self.LIMIT if board.limit is None else board.limit
+            d_stop_times = aliased(StopTime)
+            if board.arr_stops_ids:
+                a_stop_times = aliased(StopTime)
+                stmt = select(literal(i, Integer).label('board'), *board_columns(d_stop_times, 'd_'),
+                              *board_columns(a_stop_times, 'a_')).distinct(*self.distinct_trips(d_stop_times))
+                stmt = self.join_arrivals(stmt, d_stop_times, a_stop_times, board.arr_stops_ids.split(','))
+                then_by = [a_stop_times.sched_arr_dt.asc()]
+            else:
+                stmt = select(literal(i, Integer).label('board'), *board_columns(d_stop_times, 'd_'),
+                              *board_columns(None, 'a_'))
+                then_by = None
+            stmt = self.filter_departures(stmt, d_stop_times, board.dep_stops_ids.split(','), board.line,
+                                          board.start_dt, board.offset, board.direction, board.end_dt)
+            branches.append(self.order_stop_times(stmt, board.offset, limit, board.direction,
+                                                  self.distinct_trips(d_stop_times), then_by))
+
+        # every board is returned in ascending order, like the single board queries
+        stmt = union_all(*branches).order_by('board', 'd_sched_dep_dt', 'd_orig_dep_date', 'd_source', 'd_number',
+                                             'a_sched_arr_dt')
+
+        results: list[list] = [[] for _ in boards]
+        all_stop_times: list[StopTime] = []
+        for row in self.session.execute(stmt):
+            d_stop_time = row_stop_time(row, 'd_')
+            all_stop_times.append(d_stop_time)
+            if boards[row.board].arr_stops_ids:
+                a_stop_time = row_stop_time(row, 'a_')
+                all_stop_times.append(a_stop_time)
+                results[row.board].append((d_stop_time, a_stop_time))
+            else:
+                results[row.board].append(d_stop_time)
+
+        if self.realtime is not None:
+            self.realtime.apply(all_stop_times)
+
+        return results
+
     def sync_stations_db(self, new_stations: list[Station], new_stops: list[Stop] = None):
         if new_stops is None:
             new_stops = []
@@ -289,6 +379,9 @@ class Source:
                 else:
                     results[station.id] = [station, stop.id]
 
+        if self.stations_index is not None:
+            self.stations_index.rebuild(self.session)
+
     def get_stop_from_ref(self, ref) -> Station | None:
         stmt = select(Station) \
             .filter(Station.id == ref, Station.source == self.name)
@@ -301,18 +394,18 @@ class Source:
     def search_lines(self, name):
         raise NotImplementedError
 
+    def stop_time_values(self, stop_time: TripStopTime) -> dict:
+        stop_id = self.name + '_' + stop_time.station.id if self.name != 'venezia-treni' else stop_time.station.id
+        return dict(stop_id=stop_id, sched_arr_dt=stop_time.arr_time, sched_dep_dt=stop_time.dep_time,
+                    platform=stop_time.platform, orig_id=stop_time.origin_id, dest_text=stop_time.destination,
+                    number=stop_time.trip_id, orig_dep_date=stop_time.orig_dep_date,
+                    route_name=stop_time.route_name, source=self.name, stop_sequence=stop_time.stop_sequence)
+
     def upload_trip_stop_time_to_postgres(self, stop_time: TripStopTime):
         if stop_time.orig_dep_date > date.today() + timedelta(days=2):
             return
 
-        stop_id = self.name + '_' + stop_time.station.id if self.name != 'venezia-treni' else stop_time.station.id
-
-        stmt = insert(StopTime).values(stop_id=stop_id, sched_arr_dt=stop_time.arr_time,
-                                       sched_dep_dt=stop_time.dep_time, platform=stop_time.platform,
-                                       orig_id=stop_time.origin_id, dest_text=stop_time.destination,
-                                       number=stop_time.trip_id, orig_dep_date=stop_time.orig_dep_date,
-                                       route_name=stop_time.route_name, source=self.name,
-                                       stop_sequence=stop_time.stop_sequence)
+        stmt = insert(StopTime).values(**self.stop_time_values(stop_time))
 
         stmt = stmt.on_conflict_do_update(
             constraint='stop_times_unique_idx',
@@ -323,7 +416,26 @@ class Source:
 
         self.session.execute(stmt)
         self.session.commit()
+        INGESTED_ROWS.inc(self.name)
+
+    def upload_stop_times_to_postgres(self, stop_times: list[TripStopTime], atomic=False):
+        if not atomic:
+            for stop_time in tqdm(stop_times, desc=f'Uploading {self.name} stop_times'):
+                self.upload_trip_stop_time_to_postgres(stop_time)
+            return
+
+        # in atomic mode each day is loaded aside and swapped in at once, see swap_day_partition
+        values_by_day: dict[date, list[dict]] = {}
+        for stop_time in stop_times:
+            if stop_time.orig_dep_date > date.today() + timedelta(days=2):
+                continue
+            values_by_day.setdefault(stop_time.orig_dep_date, []).append(self.stop_time_values(stop_time))
 
+        for day, values in sorted(values_by_day.items()):
+            partitions.swap_day_partition(self.session, day, values)
+            INGESTED_ROWS.inc(self.name, amount=len(values))
+
+    @metrics.timed_method(QUERY_SECONDS, 'get_stops_from_trip_id')
     def get_stops_from_trip_id(self, trip_id, day: date) -> list[BaseStopTime]:
         trip_id = int(trip_id)
         query = select(StopTime, Stop) \
@@ -348,5 +460,19 @@ class Source:
 
         return stop_times
 
-    def save_data(self):
+    def save_data(self, atomic=False):
+        raise NotImplementedError
+
+    def poll_realtime(self) -> int:
         raise NotImplementedError
+
+    async def poll_realtime_periodically(self, interval: float):
+        while True:
+            try:
+                await asyncio.to_thread(self.poll_realtime)
+            except Exception:
+                logger.exception('%s realtime poll failed', self.name)
+            else:
+                self.realtime_version += 1
+                self.realtime_updated_at = datetime.now(timezone.utc)
+            await asyncio.sleep(interval)
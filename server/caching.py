@@ -0,0 +1,137 @@
+import asyncio
+import hashlib
+import logging
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+
+from sqlalchemy import select, update, func
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+from starlette.requests import Request
+from starlette.responses import Response
+
+from server.base.models import City, DBSource
+
+logging.basicConfig(
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+
+def bump_data_version(session: Session, source_name: str):
+    """Mark the data of `source_name` as changed, called by the ingestion once the new data is committed."""
+    session.execute(update(DBSource).where(DBSource.name == source_name)
+                    .values(data_version=DBSource.data_version + 1, data_updated_at=func.now()))
+    session.commit()
+
+
+def make_etag(*parts) -> str:
+    # weak, since the same data can be sent with different encodings
+    return 'W/"' + hashlib.sha1(repr(parts).encode()).hexdigest()[:20] + '"'
+
+
+class Validators:
+    """Validators of a response: `etag` and `last_modified` are known before the response is computed, so that a
+    conditional request can be answered with `304 Not Modified` without computing it."""
+
+    def __init__(self, etag: str, last_modified: datetime, max_age: int):
+        self.etag = etag
+        # HTTP dates have a resolution of one second
+        self.last_modified = last_modified.replace(microsecond=0)
+        self.max_age = max_age
+
+    @property
+    def headers(self) -> dict[str, str]:
+        return {
+            'ETag': self.etag,
+            'Last-Modified': format_datetime(self.last_modified.astimezone(timezone.utc), usegmt=True),
+            'Cache-Control': f'public, max-age={self.max_age}',
+        }
+
+    def is_not_modified(self, request: Request) -> bool:
+        if_none_match = request.headers.get('If-None-Match')
+        if if_none_match is not None:
+            # weak comparison, If-Modified-Since is ignored when If-None-Match is present
+            etags = {etag.strip().removeprefix('W/') for etag in if_none_match.split(',')}
+            return '*' in etags or self.etag.removeprefix('W/') in etags
+
+        if_modified_since = request.headers.get('If-Modified-Since')
+        if if_modified_since is not None:
+            try:
+                return self.last_modified <= parsedate_to_datetime(if_modified_since)
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    def not_modified_response(self) -> Response:
+        return Response(status_code=304, headers=self.headers)
+
+
+class SourceVersion:
+    def __init__(self, version: int, updated_at: datetime):
+        self.version = version
+        self.updated_at = updated_at
+
+
+class DataVersions:
+    """In-memory copy of the data version of every source, and of the catalog of cities and sources.
+
+    The versions are read from the database by `refresh`, which the server runs periodically, so the validators of
+    the responses are computed without touching the database. A response depending on a source changes its ETag
+    within one refresh interval from the end of the ingestion that bumped the source version.
+    """
+
+    def __init__(self, engine: Engine):
+        self.engine = engine
+        self.sources: dict[str, SourceVersion] = {}
+        self.catalog_etag = make_etag()
+        self.catalog_updated_at = datetime.now(timezone.utc)
+        self.loaded_at = self.catalog_updated_at
+
+    def refresh(self):
+        # a connection of its own, as refresh runs in a thread while the shared session is used by the requests
+        with self.engine.connect() as con:
+            rows = con.execute(select(DBSource.name, DBSource.city_name, DBSource.color, DBSource.icon_code,
+                                      DBSource.data_version, DBSource.data_updated_at).order_by(DBSource.name)).all()
+            cities = con.scalars(select(City.name).order_by(City.name)).all()
+        self.load(rows, cities)
+
+    def load(self, rows, cities: list[str]):
+        now = datetime.now(timezone.utc)
+        self.sources = {row.name: SourceVersion(row.data_version, row.data_updated_at) for row in rows}
+        catalog_etag = make_etag(tuple(cities), tuple((row.name, row.city_name, row.color, row.icon_code)
+                                                      for row in rows))
+        if catalog_etag != self.catalog_etag:
+            self.catalog_etag = catalog_etag
+            self.catalog_updated_at = now
+        self.loaded_at = now
+
+    async def refresh_periodically(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await asyncio.to_thread(self.refresh)
+            except Exception:
+                logger.exception('data versions refresh failed')
+
+    def get(self, source_name: str) -> SourceVersion:
+        # sources missing from the table (never ingested) are considered unchanged since the versions were loaded
+        return self.sources.get(source_name) or SourceVersion(0, self.loaded_at)
+
+    def source_validators(self, request: Request, source_names: list[str], max_age: int,
+                          realtime: tuple[int, datetime | None] = None) -> Validators:
+        """Validators of a response to `request` computed from the data of `source_names`, and from the realtime
+        data with the given (version, updated_at) if any."""
+        versions = [self.get(name) for name in source_names]
+        last_modified = max((version.updated_at for version in versions), default=self.loaded_at)
+        parts = [request.url.path, sorted(request.query_params.multi_items()),
+                 [(name, version.version) for name, version in zip(source_names, versions)]]
+        if realtime is not None:
+            parts.append(realtime[0])
+            if realtime[1] is not None:
+                last_modified = max(last_modified, realtime[1])
+        return Validators(make_etag(*parts), last_modified, max_age)
+
+    def catalog_validators(self, request: Request, max_age: int) -> Validators:
+        """Validators of a response to `request` computed from the cities and the sources metadata."""
+        return Validators(make_etag(request.url.path, self.catalog_etag), self.catalog_updated_at, max_age)
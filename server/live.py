@@ -0,0 +1,169 @@
+import asyncio
+import logging
+from datetime import datetime, timezone
+from typing import AsyncIterator, Callable, Mapping
+
+import orjson
+from starlette.responses import StreamingResponse
+
+from server import metrics
+from server.base.models import StopTime
+from server.base.source import Source, Board
+from server.responses import stop_times_rows
+
+logging.basicConfig(
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+# messages waiting to be sent to a subscriber: a client that falls this far behind is disconnected, and gets a new
+# snapshot when its EventSource reconnects
+SUBSCRIBER_QUEUE_SIZE = 16
+KEEPALIVE = b': keepalive\n\n'
+
+LIVE_SUBSCRIBERS = metrics.gauge('muoversi_live_boards_subscribers', 'Clients subscribed to the live boards')
+LIVE_BOARDS = metrics.gauge('muoversi_live_boards', 'Distinct live boards computed at every tick')
+
+
+def sse_message(event: str, data) -> bytes:
+    return b'event: ' + event.encode() + b'\ndata: ' + orjson.dumps(data) + b'\n\n'
+
+
+def row_key(row: list) -> int:
+    # compact rows: the id of the departure stop time, unique in a board since its trips are distinct
+    return row[0][0]
+
+
+def diff_rows(old: list[list], new: list[list]) -> dict | None:
+    """Changes from the `old` rows of a board to the `new` ones: the keys of the rows gone (departed or scrolled out),
+    the rows added or changed (delay, platform) and the new order of the keys; None if nothing changed."""
+    old_rows = {row_key(row): row for row in old}
+    new_rows = {row_key(row): row for row in new}
+    removed = [key for key in old_rows if key not in new_rows]
+    upserted = [row for key, row in new_rows.items() if old_rows.get(key) != row]
+    if not removed and not upserted and list(old_rows) == list(new_rows):
+        return None
+    return {'removed': removed, 'upserted': upserted, 'order': list(new_rows)}
+
+
+class LiveBoard:
+    def __init__(self, key: tuple, source_name: str, dep_stops_ids: str, arr_stops_ids: str | None, limit: int):
+        self.key = key
+        self.source_name = source_name
+        self.dep_stops_ids = dep_stops_ids
+        self.arr_stops_ids = arr_stops_ids
+        self.limit = limit
+        self.rows: list[list] = []
+        # encoded once for all the subscribers
+        self.snapshot: bytes | None = None
+        self.subscribers: set[asyncio.Queue] = set()
+
+    def board(self, now: datetime) -> Board:
+        return Board(self.dep_stops_ids, now, arr_stops_ids=self.arr_stops_ids, limit=self.limit)
+
+    def update(self, rows: list[list]) -> bytes:
+        """Store the new rows and return the message for the current subscribers: the diff, or a keepalive."""
+        diff = diff_rows(self.rows, rows) if self.snapshot is not None else None
+        if self.snapshot is None or diff is not None:
+            self.rows = rows
+            self.snapshot = sse_message('board', {'fields': StopTime.API_FIELDS, 'rows': rows})
+        return sse_message('diff', diff) if diff is not None else KEEPALIVE
+
+
+class LiveBoards:
+    """Live departure boards streamed with server-sent events.
+
+    A board starts at the current time and is identified by its source, stops and limit: clients watching the same
+    board share it. Every `interval` seconds all the boards with subscribers are recomputed, with one query per source
+    (`Source.get_boards`), and only what changed is pushed: a subscriber first receives a `board` event with all the
+    rows, then `diff` events when departures pass or their delays change.
+    """
+
+    def __init__(self, sources: Mapping[str, Source], interval: float = 15,
+                 clock: Callable[[], datetime] = lambda: datetime.now(timezone.utc)):
+        self.sources = sources
+        self.interval = interval
+        self.clock = clock
+        self.boards: dict[tuple, LiveBoard] = {}
+        LIVE_SUBSCRIBERS.collect = lambda: {(): sum(len(board.subscribers) for board in self.boards.values())}
+        LIVE_BOARDS.collect = lambda: {(): len(self.boards)}
+
+    def subscribe(self, source_name: str, dep_stops_ids: str, arr_stops_ids: str | None, limit: int) \
+            -> tuple[LiveBoard, asyncio.Queue]:
+        # the same stops in another order are the same board
+        dep_stops_ids = ','.join(sorted(dep_stops_ids.split(',')))
+        arr_stops_ids = ','.join(sorted(arr_stops_ids.split(','))) if arr_stops_ids else None
+        key = (source_name, dep_stops_ids, arr_stops_ids, limit)
+        board = self.boards.get(key)
+        if board is None:
+            board = self.boards[key] = LiveBoard(key, source_name, dep_stops_ids, arr_stops_ids, limit)
+            # the first subscriber does not wait for the next tick
+            try:
+                self.refresh([board])
+            except Exception:
+                del self.boards[key]
+                raise
+
+        queue = asyncio.Queue(SUBSCRIBER_QUEUE_SIZE)
+        queue.put_nowait(board.snapshot)
+        board.subscribers.add(queue)
+        return board, queue
+
+    def unsubscribe(self, board: LiveBoard, queue: asyncio.Queue):
+        board.subscribers.discard(queue)
+        if not board.subscribers and self.boards.get(board.key) is board:
+            del self.boards[board.key]
+
+    def refresh(self, boards: list[LiveBoard] = None):
+        if boards is None:
+            boards = list(self.boards.values())
+        now = self.clock()
+
+        by_source: dict[str, list[LiveBoard]] = {}
+        for board in boards:
+            by_source.setdefault(board.source_name, []).append(board)
+
+        for source_name, source_boards in by_source.items():
+            results = self.sources[source_name].get_boards([board.board(now) for board in source_boards])
+            for board, stop_times in zip(source_boards, results):
+                self.fan_out(board, board.update(stop_times_rows(stop_times, compact=True)))
+
+    def fan_out(self, board: LiveBoard, message: bytes):
+        for queue in list(board.subscribers):
+            try:
+                queue.put_nowait(message)
+            except asyncio.QueueFull:
+                # the stream of a client this slow is ended, None being the end of the stream
+                self.unsubscribe(board, queue)
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(None)
+
+    async def run_periodically(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                self.refresh()
+            except Exception:
+                logger.exception('live boards refresh failed')
+
+    def response(self, source_name: str, dep_stops_ids: str, arr_stops_ids: str | None, limit: int) \
+            -> StreamingResponse:
+        board, queue = self.subscribe(source_name, dep_stops_ids, arr_stops_ids, limit)
+        # the retry field tells EventSource how long to wait before reconnecting
+        prelude = f'retry: {int(self.interval * 1000)}\n\n'.encode()
+
+        async def body() -> AsyncIterator[bytes]:
+            try:
+                yield prelude
+                while True:
+                    message = await queue.get()
+                    if message is None:
+                        return
+                    yield message
+            finally:
+                # also when the client disconnects
+                self.unsubscribe(board, queue)
+
+        return StreamingResponse(body(), media_type='text/event-stream',
+                                 headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
@@ -0,0 +1,256 @@
+import functools
+import inspect
+import os
+import threading
+import time
+from bisect import bisect_left
+from typing import Callable, Iterable
+
+# seconds, from a cached lookup to a slow ingestion query
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def escape_label_value(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labelnames: tuple[str, ...], labelvalues: tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{escape_label_value(value)}"' for name, value in zip(labelnames, labelvalues)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    type = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def samples(self) -> Iterable[str]:
+        raise NotImplementedError
+
+    def expose(self) -> str:
+        # metrics without samples are left out, so that the ones only observed by save_data are exposed once, from
+        # its textfile
+        samples = list(self.samples())
+        if not samples:
+            return ''
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}', *samples]
+        return '\n'.join(lines) + '\n'
+
+
+class Counter(Metric):
+    """Counter incremented with `inc`, or read at every scrape from `collect`, for the counts kept by other objects."""
+    type = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                 collect: Callable[[], dict[tuple, float]] = None):
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[tuple, float] = {}
+        self.collect = collect
+
+    def inc(self, *labelvalues, amount: float = 1):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def get(self, *labelvalues) -> float:
+        return self._values.get(labelvalues, 0)
+
+    def samples(self) -> Iterable[str]:
+        with self._lock:
+            values = list((self.collect() if self.collect else self._values).items())
+        for labelvalues, value in values:
+            yield f'{self.name}{format_labels(self.labelnames, labelvalues)} {format_value(value)}'
+
+
+class Gauge(Metric):
+    """Gauge set explicitly with `set`, or computed at every scrape by `collect`, which returns the values by labels."""
+    type = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                 collect: Callable[[], dict[tuple, float]] = None):
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[tuple, float] = {}
+        self.collect = collect
+
+    def set(self, value: float, *labelvalues):
+        self._values[labelvalues] = value
+
+    def get(self, *labelvalues) -> float | None:
+        return self._values.get(labelvalues)
+
+    def samples(self) -> Iterable[str]:
+        values = self.collect() if self.collect else dict(self._values)
+        for labelvalues, value in values.items():
+            yield f'{self.name}{format_labels(self.labelnames, labelvalues)} {format_value(value)}'
+
+
+class Histogram(Metric):
+    """Histogram with cumulative buckets, as exposed by Prometheus clients.
+
+    `observe` only finds the bucket with a bisection and increments two counters under a lock, so it can be called on
+    the hot path; the cumulative counts are computed at scrape time.
+    """
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                 buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # bucket counts (the last one being +Inf) and sum of the observed values, by labels
+        self._series: dict[tuple, tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, *labelvalues):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labelvalues)
+            if series is None:
+                series = self._series[labelvalues] = ([0] * (len(self.buckets) + 1), [0.0])
+            series[0][index] += 1
+            series[1][0] += value
+
+    def count(self, *labelvalues) -> int:
+        series = self._series.get(labelvalues)
+        return sum(series[0]) if series else 0
+
+    def time(self, *labelvalues) -> 'Timer':
+        return Timer(self, labelvalues)
+
+    def samples(self) -> Iterable[str]:
+        with self._lock:
+            series = [(labelvalues, list(counts), total[0]) for labelvalues, (counts, total) in self._series.items()]
+        for labelvalues, counts, total in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                labels = format_labels(self.labelnames, labelvalues, f'le="{format_value(bound)}"')
+                yield f'{self.name}_bucket{labels} {cumulative}'
+            labels = format_labels(self.labelnames, labelvalues)
+            yield f'{self.name}_sum{labels} {format_value(total)}'
+            yield f'{self.name}_count{labels} {cumulative}'
+
+
+class Timer:
+    """Context manager observing the seconds spent in its block, also when it raises."""
+
+    __slots__ = ('histogram', 'labelvalues', 'start')
+
+    def __init__(self, histogram: Histogram, labelvalues: tuple):
+        self.histogram = histogram
+        self.labelvalues = labelvalues
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labelvalues)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self.metrics:
+            raise ValueError(f'metric {metric.name} is already registered')
+        self.metrics[metric.name] = metric
+        return metric
+
+    def expose(self, metrics: Iterable[Metric] = None) -> str:
+        """Metrics (all of them by default) in the Prometheus text exposition format."""
+        return ''.join(metric.expose() for metric in (self.metrics.values() if metrics is None else metrics))
+
+    def write_textfile(self, path: str, metrics: Iterable[Metric] = None):
+        # atomically, for the processes reading it (see `routes.get_metrics`)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(self.expose(metrics))
+        os.replace(tmp_path, path)
+
+
+registry = Registry()
+
+
+def counter(name: str, documentation: str, labelnames: Iterable[str] = (),
+            collect: Callable[[], dict[tuple, float]] = None) -> Counter:
+    return registry.register(Counter(name, documentation, labelnames, collect))
+
+
+def gauge(name: str, documentation: str, labelnames: Iterable[str] = (),
+          collect: Callable[[], dict[tuple, float]] = None) -> Gauge:
+    return registry.register(Gauge(name, documentation, labelnames, collect))
+
+
+def histogram(name: str, documentation: str, labelnames: Iterable[str] = (),
+              buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+    return registry.register(Histogram(name, documentation, labelnames, buckets))
+
+
+def timed(metric: Histogram, *labelvalues):
+    """Decorator observing the duration of every call of a function or coroutine function."""
+    def decorator(function):
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def async_wrapper(*args, **kwargs):
+                with metric.time(*labelvalues):
+                    return await function(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with metric.time(*labelvalues):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def timed_method(metric: Histogram, method_name: str):
+    """Decorator for the methods of the sources, observed with the name of the source and `method_name` as labels."""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(self, *args, **kwargs):
+            with metric.time(self.name, method_name):
+                return function(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class MetricsMiddleware:
+    """ASGI middleware observing the latency of the HTTP requests in `metric`, labelled with the name of the endpoint
+    (known once the router has handled the request), the method and the status code."""
+
+    def __init__(self, app, metric: Histogram):
+        self.app = app
+        self.metric = metric
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            endpoint = scope.get('endpoint')
+            self.metric.observe(time.perf_counter() - start, getattr(endpoint, '__name__', 'not_found'),
+                                scope['method'], status)
@@ -0,0 +1,234 @@
+import asyncio
+import gzip
+import logging
+import os
+from datetime import date, timedelta, datetime
+
+from sqlalchemy import text, Engine, Connection, MetaData
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+from server.base.models import StopTime
+
+logging.basicConfig(
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+PARENT_TABLE = 'stop_times'
+PARTITION_PREFIX = 'stop_times_'
+DEFAULT_PARTITION = 'stop_times_default'
+
+
+def partition_name(day: date) -> str:
+    return f'{PARTITION_PREFIX}{day.strftime("%Y%m%d")}'
+
+
+def partition_day(name: str) -> date | None:
+    if not name.startswith(PARTITION_PREFIX):
+        return None
+    try:
+        return datetime.strptime(name[len(PARTITION_PREFIX):], '%Y%m%d').date()
+    except ValueError:
+        return None
+
+
+def plan_partitions(today: date, existing_days: set[date], days_ahead: int, retention_days: int) \
+        -> tuple[list[date], list[date]]:
+    # only the missing days from today on are created and every day older than the retention is expired, so runs
+    # missed in the past are caught up by the next one
+    to_create = [today + timedelta(days=i) for i in range(days_ahead) if today + timedelta(days=i) not in existing_days]
+    oldest_kept = today - timedelta(days=retention_days)
+    to_expire = sorted(day for day in existing_days if day < oldest_kept)
+    return to_create, to_expire
+
+
+class PartitionManager:
+    """Keeps the day partitions of stop_times in shape.
+
+    Each run creates the partitions for the next `days_ahead` days (their indexes are created by Postgres from the
+    ones of the partitioned table), makes sure the DEFAULT partition exists, then detaches and drops the partitions
+    older than `retention_days` days, dumping them to `archive_dir` first when it is set. Every step is idempotent
+    and is retried on the next run when it fails.
+    """
+
+    def __init__(self, engine: Engine, days_ahead=3, retention_days=1, archive_dir: str = None):
+        self.engine = engine
+        self.days_ahead = days_ahead
+        self.retention_days = retention_days
+        self.archive_dir = archive_dir
+
+    def quote(self, name: str) -> str:
+        return self.engine.dialect.identifier_preparer.quote(name)
+
+    def attached_partitions(self, con: Connection) -> list[str]:
+        return list(con.execute(text("""
+            SELECT c.relname FROM pg_inherits i
+                JOIN pg_class c ON c.oid = i.inhrelid
+                JOIN pg_class p ON p.oid = i.inhparent
+            WHERE p.relname = :parent
+        """), {'parent': PARENT_TABLE}).scalars())
+
+    def detached_partitions(self, con: Connection) -> list[str]:
+        tables = con.execute(text("""
+            SELECT tablename FROM pg_tables WHERE schemaname = current_schema() AND starts_with(tablename, :prefix)
+        """), {'prefix': PARTITION_PREFIX}).scalars()
+        attached = set(self.attached_partitions(con))
+        return [table for table in tables if table not in attached and partition_day(table)]
+
+    def run(self, today: date = None) -> list[dict]:
+        if today is None:
+            today = date.today()
+
+        with self.engine.begin() as con:
+            self.ensure_default_partition(con)
+            attached = {partition_day(name): name for name in self.attached_partitions(con) if partition_day(name)}
+            detached = {partition_day(name): name for name in self.detached_partitions(con)}
+
+        to_create, to_expire = plan_partitions(today, set(attached), self.days_ahead, self.retention_days)
+        # tables detached by previous runs (or by hand) and never dropped are expired too
+        _, detached_to_expire = plan_partitions(today, set(detached), 0, self.retention_days)
+
+        for day in to_create:
+            self.try_step(self.create_partition, day)
+        for day in to_expire:
+            self.try_step(self.expire_partition, attached[day], True)
+        for day in detached_to_expire:
+            self.try_step(self.expire_partition, detached[day], False)
+
+        report = self.report()
+        for partition in report:
+            logger.info('partition %s: %s rows, %.1f MB', partition['name'], partition['rows'],
+                        partition['size'] / 1024 ** 2)
+        return report
+
+    def try_step(self, step, *args):
+        # each step runs in its own transaction, a failing one does not stop the others
+        try:
+            step(*args)
+        except Exception:
+            logger.exception('partition step %s%s failed', step.__name__, args)
+
+    def ensure_default_partition(self, con: Connection):
+        con.execute(text(f'CREATE TABLE IF NOT EXISTS {self.quote(DEFAULT_PARTITION)} '
+                         f'PARTITION OF {self.quote(PARENT_TABLE)} DEFAULT'))
+
+    def create_partition(self, day: date):
+        name = self.quote(partition_name(day))
+        params = {'start': day, 'end': day + timedelta(days=1)}
+        with self.engine.begin() as con:
+            rows_in_default = con.execute(text(
+                f'SELECT count(*) FROM {self.quote(DEFAULT_PARTITION)} '
+                f'WHERE orig_dep_date >= :start AND orig_dep_date < :end'), params).scalar()
+
+            if not rows_in_default:
+                con.execute(text(f'CREATE TABLE {name} PARTITION OF {self.quote(PARENT_TABLE)} '
+                                 f'FOR VALUES FROM (:start) TO (:end)'), params)
+            else:
+                # the rows of the day that ended up in the default partition are moved to the new one, otherwise
+                # Postgres refuses to create it
+                con.execute(text(f'CREATE TABLE {name} '
+                                 f'(LIKE {self.quote(PARENT_TABLE)} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)'))
+                con.execute(text(f'INSERT INTO {name} SELECT * FROM {self.quote(DEFAULT_PARTITION)} '
+                                 f'WHERE orig_dep_date >= :start AND orig_dep_date < :end'), params)
+                con.execute(text(f'DELETE FROM {self.quote(DEFAULT_PARTITION)} '
+                                 f'WHERE orig_dep_date >= :start AND orig_dep_date < :end'), params)
+                con.execute(text(f'ALTER TABLE {self.quote(PARENT_TABLE)} ATTACH PARTITION {name} '
+                                 f'FOR VALUES FROM (:start) TO (:end)'), params)
+        logger.info('created partition %s (%d rows moved from the default partition)', name, rows_in_default)
+
+    def expire_partition(self, name: str, attached: bool):
+        with self.engine.begin() as con:
+            if attached:
+                con.execute(text(f'ALTER TABLE {self.quote(PARENT_TABLE)} DETACH PARTITION {self.quote(name)}'))
+            if self.archive_dir:
+                self.archive_partition(con, name)
+            con.execute(text(f'DROP TABLE {self.quote(name)}'))
+        logger.info('expired partition %s', name)
+
+    def archive_partition(self, con: Connection, name: str):
+        os.makedirs(self.archive_dir, exist_ok=True)
+        file_path = os.path.join(self.archive_dir, f'{name}.csv.gz')
+        cursor = con.connection.cursor()
+        with gzip.open(file_path, 'wb') as f:
+            cursor.copy_expert(f'COPY {self.quote(name)} TO STDOUT WITH CSV HEADER', f)
+        logger.info('archived partition %s to %s', name, file_path)
+
+    def report(self) -> list[dict]:
+        with self.engine.connect() as con:
+            rows = con.execute(text("""
+                SELECT c.relname AS name, pg_total_relation_size(c.oid) AS size, coalesce(s.n_live_tup, 0) AS rows
+                FROM pg_inherits i
+                    JOIN pg_class c ON c.oid = i.inhrelid
+                    JOIN pg_class p ON p.oid = i.inhparent
+                    LEFT JOIN pg_stat_user_tables s ON s.relid = c.oid
+                WHERE p.relname = :parent
+                ORDER BY c.relname
+            """), {'parent': PARENT_TABLE}).mappings().all()
+        return [dict(row) for row in rows]
+
+    async def run_periodically(self, interval: float):
+        while True:
+            try:
+                await asyncio.to_thread(self.run)
+            except Exception:
+                logger.exception('partition manager run failed')
+            await asyncio.sleep(interval)
+
+
+STOP_TIMES_UNIQUE_COLUMNS = ['stop_id', 'number', 'source', 'orig_dep_date', 'stop_sequence']
+
+
+def swap_day_partition(session: Session, day: date, values: list[dict]):
+    """Upsert `values` into the partition of `day` by building a shadow copy of it and swapping it in.
+
+    The shadow table gets the indexes and constraints of stop_times, the current rows of the partition (ids
+    included) and then the new rows. It replaces the live partition in the same transaction, so readers either see
+    the old day or the new one, never a partially loaded one. Writes to the partition wait for the load to finish.
+    """
+    name = partition_name(day)
+    shadow_name = f'{name}_shadow'
+    engine = session.get_bind()
+    quote = engine.dialect.identifier_preparer.quote
+    params = {'start': day, 'end': day + timedelta(days=1)}
+
+    con = session.connection()
+    attached = con.execute(text("""
+        SELECT count(*) FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            JOIN pg_class p ON p.oid = i.inhparent
+        WHERE p.relname = :parent AND c.relname = :name
+    """), {'parent': PARENT_TABLE, 'name': name}).scalar()
+    if not attached:
+        session.commit()
+        PartitionManager(engine).create_partition(day)
+        con = session.connection()
+
+    con.execute(text(f'LOCK TABLE {quote(name)} IN EXCLUSIVE MODE'))
+    con.execute(text(f'DROP TABLE IF EXISTS {quote(shadow_name)}'))
+    con.execute(text(f'CREATE TABLE {quote(shadow_name)} (LIKE {quote(PARENT_TABLE)} INCLUDING ALL)'))
+    # lets ATTACH PARTITION skip the scan that validates the range of the rows
+    con.execute(text(f'ALTER TABLE {quote(shadow_name)} ADD CONSTRAINT {quote(shadow_name + "_range")} '
+                     f'CHECK (orig_dep_date >= :start AND orig_dep_date < :end)'), params)
+    con.execute(text(f'INSERT INTO {quote(shadow_name)} SELECT * FROM {quote(name)}'))
+
+    # rows with the same key would make the upsert fail, the last one wins as with one upsert per row
+    unique_values = list({tuple(v[c] for c in STOP_TIMES_UNIQUE_COLUMNS): v for v in values}.values())
+    if unique_values:
+        shadow_table = StopTime.__table__.to_metadata(MetaData(), name=shadow_name)
+        stmt = insert(shadow_table)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=STOP_TIMES_UNIQUE_COLUMNS,
+            set_={column: stmt.excluded[column] for column in unique_values[0] if
+                  column not in STOP_TIMES_UNIQUE_COLUMNS}
+        )
+        con.execute(stmt, unique_values)
+
+    con.execute(text(f'ALTER TABLE {quote(PARENT_TABLE)} DETACH PARTITION {quote(name)}'))
+    con.execute(text(f'ALTER TABLE {quote(PARENT_TABLE)} ATTACH PARTITION {quote(shadow_name)} '
+                     f'FOR VALUES FROM (:start) TO (:end)'), params)
+    con.execute(text(f'DROP TABLE {quote(name)}'))
+    con.execute(text(f'ALTER TABLE {quote(shadow_name)} RENAME TO {quote(name)}'))
+    con.execute(text(f'ALTER TABLE {quote(name)} DROP CONSTRAINT {quote(shadow_name + "_range")}'))
+    session.commit()
+    logger.info('swapped partition %s with %d new or updated rows', name, len(unique_values))
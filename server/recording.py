@@ -0,0 +1,44 @@
+import json
+import time
+
+import orjson
+
+
+class TrafficRecorder:
+    """ASGI middleware appending every HTTP request to `path` as a JSON line, with its time, method, path (query
+    included) and JSON body, so that the traffic can be replayed with replay.py. Headers are not recorded: the
+    webhook secret token is added back by the replay."""
+
+    def __init__(self, app, path: str, exclude: tuple[str, ...] = ('/metrics',)):
+        self.app = app
+        self.exclude = exclude
+        # line buffered, every request is on disk as soon as it is handled
+        self.file = open(path, 'a', buffering=1)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['path'] in self.exclude:
+            await self.app(scope, receive, send)
+            return
+
+        start = time.time()
+        chunks = []
+
+        async def receive_and_record():
+            message = await receive()
+            if message['type'] == 'http.request':
+                chunks.append(message.get('body', b''))
+            return message
+
+        try:
+            await self.app(scope, receive_and_record, send)
+        finally:
+            path = scope['path']
+            if scope['query_string']:
+                path += '?' + scope['query_string'].decode('latin-1')
+            body = b''.join(chunks)
+            try:
+                body = orjson.loads(body) if body else None
+            except orjson.JSONDecodeError:
+                body = body.decode('utf-8', 'replace')
+            self.file.write(json.dumps({'time': start, 'method': scope['method'], 'path': path, 'body': body},
+                                       ensure_ascii=False) + '\n')
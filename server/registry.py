@@ -0,0 +1,66 @@
+import logging
+import threading
+import time
+from collections.abc import Mapping
+from typing import Callable, Iterator
+
+from server.base import Source
+
+logging.basicConfig(
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+
+class SourceRegistry(Mapping):
+    """Read-only mapping of the sources by name, each one constructed the first time it is looked up.
+
+    Scripts only pay for the sources they use, the server constructs all of them at startup with `warm_up`. Each
+    source is constructed once even when it is looked up by several threads at the same time; `on_init` is called
+    with every new source before it is returned. The construction time of each source is kept in `init_timings`.
+    """
+
+    def __init__(self, factories: dict[str, Callable[[], Source]], on_init: Callable[[Source], None] = None):
+        self._factories = factories
+        self._sources: dict[str, Source] = {}
+        # the sources share the database session, so they are constructed one at a time
+        self._lock = threading.RLock()
+        self.on_init = on_init
+        self.init_timings: dict[str, float] = {}
+
+    def __getitem__(self, name: str) -> Source:
+        source = self._sources.get(name)
+        if source is not None:
+            return source
+
+        factory = self._factories[name]
+        with self._lock:
+            if name not in self._sources:
+                start = time.perf_counter()
+                source = factory()
+                if self.on_init:
+                    self.on_init(source)
+                self.init_timings[name] = time.perf_counter() - start
+                logger.info('source %s initialized in %.2fs', name, self.init_timings[name])
+                self._sources[name] = source
+        return self._sources[name]
+
+    def __contains__(self, name) -> bool:
+        # the names are known without constructing the sources
+        return name in self._factories
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._factories)
+
+    def __len__(self) -> int:
+        return len(self._factories)
+
+    def is_initialized(self, name: str) -> bool:
+        return name in self._sources
+
+    def warm_up(self, names: list[str] = None) -> dict[str, float]:
+        """Construct the sources in `names` (all of them by default), returns their init timings in seconds."""
+        names = list(self) if names is None else names
+        for name in names:
+            self[name]
+        return {name: self.init_timings[name] for name in names}
@@ -0,0 +1,113 @@
+import gzip
+import typing
+
+import orjson
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+try:
+    import brotli
+except ImportError:
+    # brotli is optional, responses are only compressed with gzip without it
+    brotli = None
+
+from server.base.models import StopTime
+
+
+class ORJSONResponse(JSONResponse):
+    """JSONResponse encoded with orjson, which also serializes dates and datetimes (ISO 8601, like isoformat)."""
+
+    def render(self, content: typing.Any) -> bytes:
+        return orjson.dumps(content)
+
+
+def stop_times_rows(stop_times: list[StopTime] | list[tuple[StopTime, StopTime]], compact=False) -> list:
+    """Rows of a stop times board: each row is the list of the departure (and arrival) stop times of a trip.
+
+    Stop times are objects with the keys of `StopTime.API_FIELDS`, or in compact format arrays with the values in the
+    same order, the client reading the keys once from a `fields` list next to the rows.
+    """
+    if not stop_times or isinstance(stop_times[0], StopTime):
+        stop_times = [(stop_time,) for stop_time in stop_times]
+    if compact:
+        return [[stop_time.as_row() for stop_time in row] for row in stop_times]
+    return [[dict(zip(StopTime.API_FIELDS, stop_time.as_row())) for stop_time in row] for row in stop_times]
+
+
+def accepted_encoding(accept_encoding: str) -> str | None:
+    # best content coding accepted by the client among the supported ones, brotli being preferred on equal quality
+    supported = ['br', 'gzip'] if brotli is not None else ['gzip']
+    qualities = {}
+    for coding in accept_encoding.split(','):
+        name, _, params = coding.strip().partition(';')
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        qualities[name.strip().lower()] = quality
+    for name in supported:
+        if name not in qualities and '*' in qualities:
+            qualities[name] = qualities['*']
+    candidates = [name for name in supported if qualities.get(name, 0) > 0]
+    return max(candidates, key=lambda name: qualities[name], default=None)
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if encoding == 'br':
+        # a low quality is as fast as gzip and still compresses better
+        return brotli.compress(body, quality=4)
+    return gzip.compress(body, compresslevel=6)
+
+
+class CompressionMiddleware:
+    """Compresses with brotli or gzip, as negotiated with Accept-Encoding, the responses of at least `minimum_size`
+    bytes.
+
+    Unlike Starlette's GZipMiddleware it only handles responses sent in a single body message, as all the routes of
+    the server do: streaming responses are passed through uncompressed.
+    """
+
+    def __init__(self, app: ASGIApp, minimum_size=500):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        encoding = accepted_encoding(Headers(scope=scope).get('Accept-Encoding', ''))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start_message: Message | None = None
+
+        async def send_compressed(message: Message) -> None:
+            nonlocal start_message
+            if message['type'] == 'http.response.start':
+                # sent with the body, once it is known whether it is compressed
+                start_message = message
+                return
+            if message['type'] != 'http.response.body' or start_message is None:
+                await send(message)
+                return
+
+            headers = MutableHeaders(raw=start_message['headers'])
+            body = message.get('body', b'')
+            if not message.get('more_body', False) and len(body) >= self.minimum_size \
+                    and 'content-encoding' not in headers:
+                body = compress(body, encoding)
+                headers['Content-Encoding'] = encoding
+                headers['Content-Length'] = str(len(body))
+                message = {**message, 'body': body}
+            headers.add_vary_header('Accept-Encoding')
+            await send(start_message)
+            start_message = None
+            await send(message)
+
+        await self.app(scope, receive, send_compressed)
@@ -3,16 +3,29 @@ from datetime import datetime
 from zoneinfo import ZoneInfo
 from sqlalchemy import text, select
 from starlette.requests import Request
-from starlette.responses import Response, JSONResponse
+from starlette.responses import Response, PlainTextResponse
 from starlette.routing import Route
 
+from config import config
+from server import metrics
 from server.base.models import StopTime, City, DBSource
-from server.base.source import Source
-from server.sources import sources
-from server.typesense.helpers import ts_search_stations
+from server.base.source import Source, Board
+from server.responses import ORJSONResponse, stop_times_rows
+from server.sources import sources, data_versions, live_boards
+from server.typesense.helpers import search_cache
 import arrow
 
 
+# seconds for which clients and CDNs can reuse a response without revalidating it: cities and sources almost never
+# change, stations change with the ingestion, stop times also with the realtime data
+CATALOG_MAX_AGE = 3600
+SEARCH_MAX_AGE = 600
+STOP_TIMES_MAX_AGE = 30
+
+REQUEST_SECONDS = metrics.histogram('muoversi_http_request_seconds', 'Duration of the HTTP requests, by endpoint',
+                                    ['endpoint', 'method', 'status'])
+
+
 async def home(request: Request) -> Response:
     text_response = '<html>'
 
@@ -25,11 +38,16 @@ async def home(request: Request) -> Response:
 
     text_response += '<ul>'
     for source in sources.values():
+        init_time = f'initialized in {sources.init_timings[source.name]:.2f}s'
         if hasattr(source, 'gtfs_version'):
-            text_response += f'<li>{source.name}: GTFS v.{source.gtfs_version}</li>'
+            text_response += f'<li>{source.name}: GTFS v.{source.gtfs_version}, {init_time}</li>'
         else:
-            text_response += f'<li>{source.name}</li>'
-    text_response += '</ul></html>'
+            text_response += f'<li>{source.name}: {init_time}</li>'
+    text_response += '</ul>'
+
+    cache_stats = search_cache.stats()
+    text_response += f'<p>Typesense search cache: {cache_stats["hits"]} hits, {cache_stats["coalesced"]} coalesced, ' \
+                     f'{cache_stats["misses"]} misses</p></html>'
     return Response(text_response)
 
 
@@ -51,30 +69,40 @@ async def search_stations(request: Request) -> Response:
     sources_to_search = [only_source] if only_source else sources_to_search
 
     limit = max(1, min(limit, 10))
-    stations, count = ts_search_stations(sources['venezia-aut'].typesense, sources_to_search, name=query, limit=limit,
-                                         hide_ids=hide_ids)
-    return JSONResponse([station.as_dict() for station in stations])
 
+    validators = data_versions.source_validators(request, list(sources_to_search), SEARCH_MAX_AGE)
+    if validators.is_not_modified(request):
+        return validators.not_modified_response()
 
-async def get_stop_times(request: Request) -> Response:
-    dep_stops_ids = request.query_params.get('dep_stops_ids')
+    stations, count = sources['venezia-aut'].search_stations(name=query, limit=limit, hide_ids=hide_ids,
+                                                             sources=list(sources_to_search))
+    return ORJSONResponse([station.as_dict() for station in stations], headers=validators.headers)
+
+
+MAX_BOARDS = 20
+
+
+def parse_board(params) -> tuple[str, Board]:
+    """Source name and board of the stop times requested with `params` (query parameters of /stop_times, or a board
+    of /stop_times/boards), raises ValueError with the response content if a parameter is missing."""
+    dep_stops_ids = params.get('dep_stops_ids')
     if not dep_stops_ids:
-        return Response(status_code=400, content='Missing dep_stops_ids')
-    arr_stops_ids = request.query_params.get('arr_stops_ids')
-    direction = int(request.query_params.get('direction', 1))
-    source_name = request.query_params.get('source')
+        raise ValueError('Missing dep_stops_ids')
+    arr_stops_ids = params.get('arr_stops_ids')
+    direction = int(params.get('direction', 1))
+    source_name = params.get('source')
     if not source_name:
-        return Response(status_code=400, content='Missing source')
+        raise ValueError('Missing source')
 
-    start_dt_str = request.query_params.get('start_dt')
+    start_dt_str = params.get('start_dt')
     if not start_dt_str:
-        return Response(status_code=400, content='Missing start_dt')
+        raise ValueError('Missing start_dt')
     start_dt = datetime.fromisoformat(start_dt_str)
     # if not timezone aware, assume it's in Europe/Berlin timezone
     if not start_dt.tzinfo:
         start_dt = arrow.get(start_dt, 'Europe/Berlin').datetime
 
-    end_dt_str = request.query_params.get('end_dt')
+    end_dt_str = params.get('end_dt')
     end_dt = None
     if end_dt_str:
         end_dt = datetime.fromisoformat(end_dt_str)
@@ -82,48 +110,146 @@ async def get_stop_times(request: Request) -> Response:
         if not end_dt.tzinfo:
             end_dt = arrow.get(end_dt, 'Europe/Berlin').datetime
 
-    str_offset = request.query_params.get('offset_by_ids', '')
+    str_offset = params.get('offset_by_ids', '')
 
     if str_offset == '':
         offset: int = 0
     else:
         offset: tuple[int] = tuple(map(int, str_offset.split(',')))
 
-    limit = int(request.query_params.get('limit', 10))
+    limit = int(params.get('limit', 10))
 
     if limit > 15:
         limit = 15
 
+    return source_name, Board(dep_stops_ids, start_dt, arr_stops_ids=arr_stops_ids, offset=offset, limit=limit,
+                              direction=direction, end_dt=end_dt)
+
+
+def is_compact(request: Request) -> bool:
+    # format=compact returns the stop times as arrays of values, with their keys listed once in `fields`
+    return request.query_params.get('format') == 'compact'
+
+
+async def get_stop_times(request: Request) -> Response:
+    try:
+        source_name, board = parse_board(request.query_params)
+    except ValueError as e:
+        return Response(status_code=400, content=str(e))
+
     source: Source = sources[source_name]
 
-    if arr_stops_ids:
-        stop_times: list[tuple[StopTime, StopTime]] = source.get_stop_times_between_stops(dep_stops_ids, arr_stops_ids,
-                                                                                          '', start_dt,
-                                                                                          offset, limit=limit,
-                                                                                          direction=direction,
-                                                                                          end_dt=end_dt)
-        return JSONResponse([[stop_time[0].as_dict(), stop_time[1].as_dict()] for stop_time in stop_times])
+    # stop times also change with the realtime data polled by this process
+    validators = data_versions.source_validators(request, [source_name], STOP_TIMES_MAX_AGE,
+                                                 realtime=(source.realtime_version, source.realtime_updated_at))
+    if validators.is_not_modified(request):
+        return validators.not_modified_response()
+
+    if board.arr_stops_ids:
+        stop_times: list[tuple[StopTime, StopTime]] = source.get_stop_times_between_stops(board.dep_stops_ids,
+                                                                                          board.arr_stops_ids,
+                                                                                          '', board.start_dt,
+                                                                                          board.offset,
+                                                                                          limit=board.limit,
+                                                                                          direction=board.direction,
+                                                                                          end_dt=board.end_dt)
     else:
-        stop_times: list[StopTime] = source.get_stop_times(dep_stops_ids, '', start_dt, offset, limit=limit,
-                                                           direction=direction, end_dt=end_dt)
-        return JSONResponse([[stop_time.as_dict()] for stop_time in stop_times])
+        stop_times: list[StopTime] = source.get_stop_times(board.dep_stops_ids, '', board.start_dt, board.offset,
+                                                           limit=board.limit, direction=board.direction,
+                                                           end_dt=board.end_dt)
+    if is_compact(request):
+        return ORJSONResponse({'fields': StopTime.API_FIELDS, 'rows': stop_times_rows(stop_times, compact=True)},
+                              headers=validators.headers)
+    return ORJSONResponse(stop_times_rows(stop_times), headers=validators.headers)
+
+
+async def get_boards(request: Request) -> Response:
+    """Several /stop_times boards at once: the body is a JSON list of objects with the query parameters of
+    /stop_times, the response is the list of the boards in the same order (or, with format=compact, the `boards` next
+    to the `fields`). The boards of each source are fetched with a single query."""
+    try:
+        boards_params = await request.json()
+    except ValueError:
+        return Response(status_code=400, content='Invalid JSON')
+    if not isinstance(boards_params, list) or not all(isinstance(params, dict) for params in boards_params):
+        return Response(status_code=400, content='Expected a list of boards')
+    if len(boards_params) > MAX_BOARDS:
+        return Response(status_code=400, content=f'Too many boards, the maximum is {MAX_BOARDS}')
+
+    boards_by_source: dict[str, list[tuple[int, Board]]] = {}
+    for i, params in enumerate(boards_params):
+        try:
+            source_name, board = parse_board(params)
+        except ValueError as e:
+            return Response(status_code=400, content=f'Board {i}: {e}')
+        if source_name not in sources:
+            return Response(status_code=400, content=f'Board {i}: Unknown source')
+        boards_by_source.setdefault(source_name, []).append((i, board))
+
+    compact = is_compact(request)
+    response: list = [None] * len(boards_params)
+    for source_name, indexed_boards in boards_by_source.items():
+        boards = [board for _, board in indexed_boards]
+        for (i, board), stop_times in zip(indexed_boards, sources[source_name].get_boards(boards)):
+            response[i] = stop_times_rows(stop_times, compact)
+    if compact:
+        return ORJSONResponse({'fields': StopTime.API_FIELDS, 'boards': response})
+    return ORJSONResponse(response)
+
+
+async def get_live_stop_times(request: Request) -> Response:
+    """Board of /stop_times starting now and kept up to date with server-sent events: a `board` event with all the
+    rows (in compact format), then `diff` events with the keys of the rows `removed`, the rows `upserted` and the
+    `order` of the keys, the key of a row being the id of its departure stop time."""
+    dep_stops_ids = request.query_params.get('dep_stops_ids')
+    if not dep_stops_ids:
+        return Response(status_code=400, content='Missing dep_stops_ids')
+    source_name = request.query_params.get('source')
+    if source_name not in sources:
+        return Response(status_code=400, content='Missing or unknown source')
+    limit = max(1, min(int(request.query_params.get('limit', 10)), 15))
+    return live_boards.response(source_name, dep_stops_ids, request.query_params.get('arr_stops_ids'), limit)
 
 
 def get_cities(request: Request):
+    validators = data_versions.catalog_validators(request, CATALOG_MAX_AGE)
+    if validators.is_not_modified(request):
+        return validators.not_modified_response()
+
     cities = sources['venezia-aut'].session.scalars(select(City)).all()
-    return JSONResponse([city.name for city in cities])
+    return ORJSONResponse([city.name for city in cities], headers=validators.headers)
 
 
 def get_city_sources(request: Request):
+    validators = data_versions.catalog_validators(request, CATALOG_MAX_AGE)
+    if validators.is_not_modified(request):
+        return validators.not_modified_response()
+
     city_name = request.path_params['city']
     db_sources = sources['venezia-aut'].session.scalars(select(DBSource).filter_by(city_name=city_name)).all()
-    return JSONResponse([source.as_dict() for source in db_sources])
+    return ORJSONResponse([source.as_dict() for source in db_sources], headers=validators.headers)
+
+
+def get_metrics(request: Request) -> Response:
+    content = metrics.registry.expose()
+    # metrics of the last ingestion, written by save_data
+    textfile = config.get('METRICS_TEXTFILE')
+    if textfile:
+        try:
+            with open(textfile) as f:
+                content += f.read()
+        except FileNotFoundError:
+            pass
+    return PlainTextResponse(content, media_type='text/plain; version=0.0.4')
 
 
 routes = [
     Route("/", home),
     Route("/search/stations", search_stations),
     Route("/stop_times", get_stop_times),
+    Route("/stop_times/boards", get_boards, methods=["POST"]),
+    Route("/stop_times/live", get_live_stop_times),
     Route("/cities", get_cities),
-    Route("/cities/{city}", get_city_sources)
+    Route("/cities/{city}", get_city_sources),
+    Route("/metrics", get_metrics)
 ]
@@ -0,0 +1 @@
+from .stations_index import *
@@ -0,0 +1,271 @@
+import bisect
+import logging
+import math
+import re
+import threading
+import unicodedata
+from collections import defaultdict
+
+from sqlalchemy import select
+
+from server.base.models import Station, Stop
+
+logging.basicConfig(
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+# same synonyms of the Typesense "stations" collection
+SYNONYMS = [
+    ['p.le', 'piazzale'],
+    ['s.', 'santo', 'santa', 'san'],
+    ['fs', 'stazione'],
+    ['f.te', 'fondamenta', 'fondamente'],
+    ['cap.', 'capolinea']
+]
+
+# Typesense defaults: no typos below 4 characters, one typo below 7 characters, two typos otherwise
+MIN_LEN_1TYPO = 4
+MIN_LEN_2TYPO = 7
+
+# size in degrees of the cells of the geospatial grid, about 1.1km of latitude
+CELL_SIZE = 0.01
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+SEPARATORS_RE = re.compile(r'[\s\-"\'(),/]+')
+
+
+def normalize_token(token: str) -> str:
+    token = unicodedata.normalize('NFKD', token.lower())
+    return ''.join(c for c in token if c.isalnum())
+
+
+def tokenize(text: str) -> list[str]:
+    tokens = (normalize_token(token) for token in SEPARATORS_RE.split(text))
+    return [token for token in tokens if token]
+
+
+SYNONYMS_MAP: dict[str, list[str]] = {}
+for synonyms_group in SYNONYMS:
+    normalized_group = [normalize_token(synonym) for synonym in synonyms_group]
+    for synonym in normalized_group:
+        SYNONYMS_MAP[synonym] = normalized_group
+
+
+def trigrams(token: str) -> set[str]:
+    padded = f'^{token}$'
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def max_typos(token: str) -> int:
+    if len(token) >= MIN_LEN_2TYPO:
+        return 2
+    if len(token) >= MIN_LEN_1TYPO:
+        return 1
+    return 0
+
+
+def bounded_levenshtein(a: str, b: str, max_distance: int) -> int | None:
+    if abs(len(a) - len(b)) > max_distance:
+        return None
+
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        if min(current) > max_distance:
+            return None
+        previous = current
+
+    return previous[-1] if previous[-1] <= max_distance else None
+
+
+def haversine_km(lat1, lon1, lat2, lon2) -> float:
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+def grid_cell(lat, lon) -> tuple[int, int]:
+    return math.floor(lat / CELL_SIZE), math.floor(lon / CELL_SIZE)
+
+
+class IndexedStation:
+    __slots__ = ('id', 'name', 'lat', 'lon', 'ids', 'source', 'times_count')
+
+    def __init__(self, id_, name, lat, lon, ids, source, times_count):
+        self.id = id_
+        self.name = name
+        self.lat = lat
+        self.lon = lon
+        self.ids = ids
+        self.source = source
+        self.times_count = times_count
+
+    def to_station(self) -> Station:
+        return Station(id=self.id, name=self.name, lat=self.lat, lon=self.lon, ids=self.ids, source=self.source,
+                       times_count=self.times_count)
+
+
+class IndexData:
+    def __init__(self, stations: list[IndexedStation]):
+        # stations are kept sorted by popularity, so that the position of a station is also its rank
+        self.stations = sorted(stations, key=lambda s: (-s.times_count, s.name))
+
+        self.token_stations: dict[str, set[int]] = defaultdict(set)
+        self.cells: dict[tuple[int, int], list[int]] = defaultdict(list)
+
+        for position, station in enumerate(self.stations):
+            for token in tokenize(station.name):
+                self.token_stations[token].add(position)
+                for synonym in SYNONYMS_MAP.get(token, []):
+                    self.token_stations[synonym].add(position)
+            if station.lat is not None and station.lon is not None:
+                self.cells[grid_cell(station.lat, station.lon)].append(position)
+
+        self.vocabulary = sorted(self.token_stations)
+        self.trigram_tokens: dict[str, set[str]] = defaultdict(set)
+        for token in self.vocabulary:
+            for trigram in trigrams(token):
+                self.trigram_tokens[trigram].add(token)
+
+        if self.cells:
+            self.cells_bounds = (min(cell[0] for cell in self.cells), max(cell[0] for cell in self.cells),
+                                 min(cell[1] for cell in self.cells), max(cell[1] for cell in self.cells))
+
+
+class StationsIndex:
+    """In-process search engine for stations, used in place of Typesense.
+
+    Names are searched through an inverted index of their tokens (with the synonyms of the Typesense collection), a
+    sorted vocabulary for prefix matches and a trigram index of the vocabulary for typo tolerance. Results are ranked
+    by `times_count`. Nearest stations are found through a grid of `CELL_SIZE` degrees.
+    """
+
+    def __init__(self):
+        self._data = IndexData([])
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data.stations)
+
+    def load(self, stations_with_stop_ids: list[tuple[Station, str]]):
+        data = IndexData([IndexedStation(station.id, station.name, station.lat, station.lon, stop_ids, station.source,
+                                         station.times_count or 0) for station, stop_ids in stations_with_stop_ids])
+        # the new index is built aside and swapped in, so that searches never see a partial index
+        with self._lock:
+            self._data = data
+
+    def rebuild(self, session):
+        stmt = select(Station, Stop.id).select_from(Stop).join(Stop.station).filter(Stop.active)
+        stops_ids: dict[str, list[str]] = {}
+        stations: dict[str, Station] = {}
+        for station, stop_id in session.execute(stmt).all():
+            stations[station.id] = station
+            stops_ids.setdefault(station.id, []).append(stop_id)
+
+        self.load([(station, ','.join(stops_ids[station_id])) for station_id, station in stations.items()])
+        logger.info('stations index rebuilt with %d stations', len(self))
+
+    def search(self, sources: list[str], name=None, lat=None, lon=None, page=1, limit=4,
+               hide_ids: list[str] = None) -> tuple[list[Station], int]:
+        data = self._data
+        hide_ids = set(hide_ids) if hide_ids else set()
+        sources = set(sources) if sources else None
+
+        def is_visible(station: IndexedStation):
+            return (sources is None or station.source in sources) and station.id not in hide_ids
+
+        if lat and lon:
+            limit_hits = limit * 2
+            positions = self.nearest(data, float(lat), float(lon), limit_hits, is_visible)
+            results = positions[(page - 1) * limit:page * limit]
+            return [data.stations[position].to_station() for position in results], min(limit_hits, len(positions))
+
+        positions = [position for position in self.match(data, name or '') if is_visible(data.stations[position])]
+        results = positions[(page - 1) * limit:page * limit]
+        return [data.stations[position].to_station() for position in results], len(positions)
+
+    def match(self, data: IndexData, name: str) -> list[int]:
+        tokens = tokenize(name)
+        if not tokens:
+            return list(range(len(data.stations)))
+
+        # like Typesense, typos are only tried when there are no exact matches and tokens are dropped from the
+        # right only when there are no matches at all
+        while tokens:
+            for typos in (False, True):
+                positions = None
+                for i, token in enumerate(tokens):
+                    token_positions = self.token_matches(data, token, prefix=i == len(tokens) - 1, typos=typos)
+                    positions = token_positions if positions is None else positions & token_positions
+                    if not positions:
+                        break
+                if positions:
+                    return sorted(positions)
+            tokens = tokens[:-1]
+
+        return []
+
+    def token_matches(self, data: IndexData, token: str, prefix: bool, typos: bool) -> set[int]:
+        matching_tokens = set()
+        if token in data.token_stations:
+            matching_tokens.add(token)
+
+        if prefix:
+            start = bisect.bisect_left(data.vocabulary, token)
+            for vocabulary_token in data.vocabulary[start:]:
+                if not vocabulary_token.startswith(token):
+                    break
+                matching_tokens.add(vocabulary_token)
+
+        if typos and max_typos(token):
+            max_distance = max_typos(token)
+            candidates = set()
+            for trigram in trigrams(token):
+                candidates |= data.trigram_tokens.get(trigram, set())
+            for candidate in candidates:
+                # with prefix search the typos are counted against the prefixes of the candidate
+                if prefix:
+                    compared = {candidate[:length] for length in
+                                range(len(token) - max_distance, len(token) + max_distance + 1)}
+                else:
+                    compared = {candidate}
+                if any(bounded_levenshtein(token, c, max_distance) is not None for c in compared):
+                    matching_tokens.add(candidate)
+
+        positions = set()
+        for matching_token in matching_tokens:
+            positions |= data.token_stations[matching_token]
+        return positions
+
+    def nearest(self, data: IndexData, lat, lon, k, is_visible) -> list[int]:
+        if not data.cells:
+            return []
+
+        center_lat, center_lon = grid_cell(lat, lon)
+        min_lat, max_lat, min_lon, max_lon = data.cells_bounds
+        max_ring = max(abs(center_lat - min_lat), abs(center_lat - max_lat), abs(center_lon - min_lon),
+                       abs(center_lon - max_lon))
+        # distance guaranteed to be covered by each ring, longitude degrees being the shortest ones
+        ring_km = CELL_SIZE * KM_PER_DEGREE * max(math.cos(math.radians(min(abs(lat) + CELL_SIZE, 90))), 0.01)
+
+        found: list[tuple[float, int]] = []
+        for ring in range(max_ring + 1):
+            for cell_lat in range(center_lat - ring, center_lat + ring + 1):
+                for cell_lon in range(center_lon - ring, center_lon + ring + 1):
+                    if max(abs(cell_lat - center_lat), abs(cell_lon - center_lon)) != ring:
+                        continue
+                    for position in data.cells.get((cell_lat, cell_lon), []):
+                        station = data.stations[position]
+                        if is_visible(station):
+                            found.append((haversine_km(lat, lon, station.lat, station.lon), position))
+
+            # stations outside the rings searched so far are farther than ring * ring_km
+            if len([distance for distance, _ in found if distance <= ring * ring_km]) >= k:
+                break
+
+        found.sort()
+        return [position for _, position in found[:k]]
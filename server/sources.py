@@ -2,8 +2,12 @@ from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 
 from config import config
+from server.caching import DataVersions
+from server.live import LiveBoards
 from server.GTFS import GTFS
 from server.base import Source
+from server.registry import SourceRegistry
+from server.search import StationsIndex
 from server.trenitalia import Trenitalia
 from server.typesense.connection import connect_to_typesense
 
@@ -14,8 +18,30 @@ engine = create_engine(engine_url)
 session = sessionmaker(bind=engine)()
 typesense = connect_to_typesense()
 
-sources: dict[str, Source] = {
-    'venezia-aut': GTFS('automobilistico', 'venezia-aut', '🚌', session, typesense, dev=config.get('DEV', False)),
-    'venezia-nav': GTFS('navigazione', 'venezia-nav', '⛴️', session, typesense, dev=config.get('DEV', False)),
-    'venezia-treni': Trenitalia(session, typesense)
-}
+# stations are searched in-process unless Typesense is explicitly chosen as search backend
+stations_index = StationsIndex() if config.get('SEARCH_BACKEND', 'local') == 'local' else None
+
+gtfs_rt_feeds = config.get('GTFS_RT_FEEDS') or {}
+
+# versions of the data of the sources, from which the HTTP caching headers are computed
+data_versions = DataVersions(engine)
+
+
+def rebuild_stations_index(source: Source):
+    # the index holds the stations of every source, it is built as soon as the first one is ready
+    if stations_index is not None and not len(stations_index):
+        stations_index.rebuild(session)
+
+
+# sources are constructed on first use: scripts that do not need them (or need only some of them) do not pay for the
+# GTFS setup, run.py warms all of them up before serving requests
+sources: SourceRegistry = SourceRegistry({
+    'venezia-aut': lambda: GTFS('automobilistico', 'venezia-aut', '🚌', session, typesense, dev=config.get('DEV', False),
+                                stations_index=stations_index, realtime_feeds=gtfs_rt_feeds.get('venezia-aut')),
+    'venezia-nav': lambda: GTFS('navigazione', 'venezia-nav', '⛴️', session, typesense, dev=config.get('DEV', False),
+                                stations_index=stations_index, realtime_feeds=gtfs_rt_feeds.get('venezia-nav')),
+    'venezia-treni': lambda: Trenitalia(session, typesense, stations_index=stations_index)
+}, on_init=rebuild_stations_index)
+
+# live boards streamed by /stop_times/live, recomputed by run.py in every process serving the API
+live_boards = LiveBoards(sources, config.get('LIVE_BOARDS_INTERVAL') or 15)
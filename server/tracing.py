@@ -0,0 +1,214 @@
+import json
+import logging
+import random
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar
+from logging.handlers import RotatingFileHandler
+from typing import Callable, Iterator
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logging.basicConfig(
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+# statements are explained with the plan actually executed, only read-only ones since EXPLAIN ANALYZE runs them
+EXPLAIN_PREFIXES = {
+    'postgresql': 'EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ',
+    'sqlite': 'EXPLAIN QUERY PLAN ',
+}
+EXPLAINABLE = ('SELECT', 'WITH', '(SELECT')
+MAX_PARAMETERS_LENGTH = 2000
+
+
+class RequestStats:
+    def __init__(self, request_id: str):
+        self.request_id = request_id
+        self.queries = 0
+        self.seconds = 0.0
+
+
+current_request: ContextVar[RequestStats | None] = ContextVar('current_request', default=None)
+
+
+def new_request_id() -> str:
+    return uuid.uuid4().hex[:16]
+
+
+def get_request_id() -> str | None:
+    stats = current_request.get()
+    return stats.request_id if stats else None
+
+
+class QueryTracer:
+    """Opt-in tracing of the SQL statements run through `engine`, written as JSON lines to a rotating log.
+
+    Every statement is logged with its bind parameters, row count, elapsed time and the id of the API request or bot
+    update that ran it (see `request_context`). Read-only statements slower than `slow_threshold` seconds are explained
+    with a probability of `explain_sample_rate`: the EXPLAIN runs in a background thread, on a connection of its own,
+    so the request is not slowed down further. When a request exceeds `max_queries` statements or `max_seconds` of
+    SQL time, its summary is logged as over budget.
+    """
+
+    def __init__(self, engine: Engine, log_path: str, slow_threshold: float = 0.5, explain_sample_rate: float = 0.1,
+                 max_queries: int = 20, max_seconds: float = 1.0, max_bytes: int = 10 * 1024 ** 2,
+                 backup_count: int = 5, random_: Callable[[], float] = random.random):
+        self.engine = engine
+        self.slow_threshold = slow_threshold
+        self.explain_sample_rate = explain_sample_rate
+        self.max_queries = max_queries
+        self.max_seconds = max_seconds
+        self.random = random_
+        self.explain_prefix = EXPLAIN_PREFIXES.get(engine.dialect.name)
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='explain')
+
+        self.log = logging.getLogger(f'{__name__}.queries.{id(self)}')
+        self.log.propagate = False
+        self.log.setLevel(logging.INFO)
+        self.handler = RotatingFileHandler(log_path, maxBytes=max_bytes, backupCount=backup_count)
+        self.log.addHandler(self.handler)
+
+    def install(self):
+        event.listen(self.engine, 'before_cursor_execute', self.before_cursor_execute)
+        event.listen(self.engine, 'after_cursor_execute', self.after_cursor_execute)
+
+    def uninstall(self):
+        event.remove(self.engine, 'before_cursor_execute', self.before_cursor_execute)
+        event.remove(self.engine, 'after_cursor_execute', self.after_cursor_execute)
+        self.executor.shutdown(wait=True)
+        self.log.removeHandler(self.handler)
+        self.handler.close()
+
+    def write(self, record: dict):
+        self.log.info(json.dumps(record, default=str))
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['query_start'].pop()
+        stats = current_request.get()
+        if stats is not None:
+            stats.queries += 1
+            stats.seconds += elapsed
+
+        self.write({
+            'type': 'query',
+            'time': time.time(),
+            'request_id': stats.request_id if stats else None,
+            'statement': statement,
+            'parameters': format_parameters(parameters),
+            'rowcount': cursor.rowcount,
+            'elapsed': round(elapsed, 6),
+            'executemany': executemany,
+        })
+
+        if elapsed >= self.slow_threshold and self.explain_prefix and not executemany \
+                and statement.lstrip().upper().startswith(EXPLAINABLE) and self.random() < self.explain_sample_rate:
+            self.executor.submit(self.explain, statement, parameters, elapsed, stats.request_id if stats else None)
+
+    def explain(self, statement: str, parameters, elapsed: float, request_id: str | None):
+        # a raw DBAPI connection, so that the EXPLAIN itself is not traced
+        try:
+            con = self.engine.raw_connection()
+            try:
+                cursor = con.cursor()
+                cursor.execute(self.explain_prefix + statement, parameters)
+                plan = cursor.fetchall()
+            finally:
+                con.rollback()
+                con.close()
+        except Exception:
+            logger.exception('could not explain a slow statement')
+            return
+        self.write({
+            'type': 'explain',
+            'time': time.time(),
+            'request_id': request_id,
+            'statement': statement,
+            'parameters': format_parameters(parameters),
+            'elapsed': round(elapsed, 6),
+            'plan': [list(row) for row in plan],
+        })
+
+    def finish_request(self, stats: RequestStats, name: str):
+        over_budget = stats.queries > self.max_queries or stats.seconds > self.max_seconds
+        if over_budget:
+            logger.warning('request %s (%s) over the query budget: %d queries in %.3fs', stats.request_id, name,
+                           stats.queries, stats.seconds)
+        if stats.queries:
+            self.write({
+                'type': 'request',
+                'time': time.time(),
+                'request_id': stats.request_id,
+                'name': name,
+                'queries': stats.queries,
+                'seconds': round(stats.seconds, 6),
+                'over_budget': over_budget,
+            })
+
+
+def format_parameters(parameters) -> str:
+    text = json.dumps(parameters, default=str)
+    return text if len(text) <= MAX_PARAMETERS_LENGTH else text[:MAX_PARAMETERS_LENGTH] + '...'
+
+
+# the tracer installed by the server, if tracing is enabled
+tracer: QueryTracer | None = None
+
+
+@contextmanager
+def request_context(name: str, request_id: str = None) -> Iterator[RequestStats]:
+    """Statements run in this block, also in the threads started from it with asyncio.to_thread, are traced with
+    `request_id` (a new one by default); `name` is the route or the bot handler."""
+    stats = RequestStats(request_id or new_request_id())
+    token = current_request.set(stats)
+    try:
+        yield stats
+    finally:
+        current_request.reset(token)
+        if tracer is not None:
+            tracer.finish_request(stats, name)
+
+
+class RequestIdMiddleware:
+    """ASGI middleware running every HTTP request in a `request_context`: the id is taken from the X-Request-ID header
+    (e.g. set by a proxy) or generated, and returned in the X-Request-ID header of the response."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        request_id = None
+        for key, value in scope['headers']:
+            if key == b'x-request-id':
+                request_id = value.decode('latin-1')[:64]
+                break
+
+        with request_context(scope['path'], request_id) as stats:
+            async def send_with_request_id(message):
+                if message['type'] == 'http.response.start':
+                    message = {**message, 'headers': [*message.get('headers', []),
+                                                      (b'x-request-id', stats.request_id.encode('latin-1'))]}
+                await send(message)
+
+            await self.app(scope, receive, send_with_request_id)
+
+
+def traced_handler(callback, name: str):
+    """Wrap a bot handler callback so that the statements it runs are traced with the id of the update."""
+    async def wrapper(update, context):
+        with request_context(name, f'tg-{update.update_id}'):
+            return await callback(update, context)
+
+    wrapper.__name__ = callback.__name__
+    return wrapper
@@ -3,9 +3,12 @@ import math
 import os
 
 import requests
+from sqlalchemy import or_
+from sqlalchemy.orm import Session
 from zoneinfo import ZoneInfo
 from tqdm import tqdm
 
+from server import metrics
 from server.base import *
 
 logging.basicConfig(
@@ -15,13 +18,24 @@ logger = logging.getLogger(__name__)
 
 rome_tz = ZoneInfo('Europe/Berlin')
 
+# stations with stop times scheduled in this window of minutes around now are polled for realtime data
+REALTIME_WINDOW_BEFORE = 60
+REALTIME_WINDOW_AFTER = 90
+
+VIAGGIATRENO_SECONDS = metrics.histogram('muoversi_viaggiatreno_request_seconds',
+                                         'Duration of the requests to the viaggiatreno API', ['endpoint'])
+VIAGGIATRENO_ERRORS = metrics.counter('muoversi_viaggiatreno_errors_total',
+                                      'Failed requests to the viaggiatreno API, by HTTP status or exception',
+                                      ['endpoint', 'error'])
+
 
 class Trenitalia(Source):
     LIMIT = 7
 
-    def __init__(self, session, typesense, location='', force_update_stations=False):
+    def __init__(self, session, typesense, location='', force_update_stations=False, stations_index=None):
         self.location = location
-        super().__init__('venezia-treni', '🚆', session, typesense)
+        super().__init__('venezia-treni', '🚆', session, typesense, stations_index)
+        self.realtime = RealtimeStore()
 
         if force_update_stations or self.session.query(Station).filter_by(source=self.name, active=True).count() == 0 or \
                 self.session.query(Stop).filter_by(source=self.name, active=True).count() == 0:
@@ -39,7 +53,7 @@ class Trenitalia(Source):
                 file_stations]
             self.sync_stations_db(new_stations)
 
-    def save_data(self):
+    def save_data(self, atomic=False):
         stations = self.session.scalars(
             select(Station)
                 .filter_by(source=self.name, active=True)
@@ -51,6 +65,8 @@ class Trenitalia(Source):
 
         tqdm_stations = tqdm(enumerate(stations), total=len(stations), desc=f'Uploading {self.name} data')
 
+        all_stop_times = []
+
         for i, station in tqdm_stations:
             tqdm_stations.set_description(f'Processing station {station.name}')
             stop_times = self.get_stop_times_from_station(station)
@@ -58,13 +74,50 @@ class Trenitalia(Source):
             if stop_times_count > max_times_count:
                 max_times_count = stop_times_count
             times_count.append(stop_times_count)
-            for stop_time in stop_times:
-                self.upload_trip_stop_time_to_postgres(stop_time)
+            if atomic:
+                all_stop_times += stop_times
+            else:
+                for stop_time in stop_times:
+                    self.upload_trip_stop_time_to_postgres(stop_time)
+
+        if atomic:
+            self.upload_stop_times_to_postgres(all_stop_times, atomic=True)
 
         for i, station in enumerate(stations):
             station.times_count = round(times_count[i] / max_times_count, int(math.log10(max_times_count)) + 1)
         self.sync_stations_db(stations)
 
+    def get_stations_in_service(self, session, now: datetime) -> list[Station]:
+        start_dt = now - timedelta(minutes=REALTIME_WINDOW_BEFORE)
+        end_dt = now + timedelta(minutes=REALTIME_WINDOW_AFTER)
+        stmt = select(StopTime.stop_id) \
+            .filter(StopTime.source == self.name, StopTime.orig_dep_date >= now.date() - timedelta(days=1),
+                    or_(StopTime.sched_dep_dt.between(start_dt, end_dt),
+                        StopTime.sched_arr_dt.between(start_dt, end_dt))) \
+            .distinct()
+        return [Station(id=stop_id) for stop_id in session.scalars(stmt).all()]
+
+    def poll_realtime(self, now: datetime = None) -> int:
+        if now is None:
+            now = datetime.now(rome_tz)
+
+        # the poller runs in its own thread, so it does not share the session used by the requests
+        with Session(bind=self.session.get_bind()) as session:
+            stations = self.get_stations_in_service(session, now)
+
+        start_dt = now - timedelta(minutes=REALTIME_WINDOW_BEFORE)
+        updates = 0
+        for station in stations:
+            for type_ in ('partenze', 'arrivi'):
+                for stop_time in self.get_stop_times_from_start_dt(type_, station, start_dt, None):
+                    self.realtime.update(stop_time.trip_id, stop_time.orig_dep_date, station.id, stop_time.delay,
+                                         stop_time.platform)
+                    updates += 1
+
+        self.realtime.prune()
+        logger.info('%s realtime: %d updates from %d stations in service', self.name, updates, len(stations))
+        return updates
+
     def get_stop_times_from_station(self, station) -> list[TripStopTime]:
         now = datetime.now(rome_tz)
         departures = self.loop_get_times(10000, station, now, type='partenze')
@@ -141,8 +194,14 @@ class Trenitalia(Source):
         url_dt = start_dt.strftime('%a %b %d %Y %H:%M:%S GMT') + f'{num_offset} (GMT{sc_num_offset})'
         url_dt = url_dt.replace(' ', '%20')
         url = f'http://www.viaggiatreno.it/infomobilita/resteasy/viaggiatreno/{type}/{stop.id}/{url_dt}'
-        r = requests.get(url)
+        try:
+            with VIAGGIATRENO_SECONDS.time(type):
+                r = requests.get(url)
+        except requests.RequestException as e:
+            VIAGGIATRENO_ERRORS.inc(type, e.__class__.__name__)
+            raise
         if r.status_code != 200:
+            VIAGGIATRENO_ERRORS.inc(type, str(r.status_code))
             return []
 
         stop_times = []
@@ -1,11 +1,54 @@
+import json
+import logging
+
 from sqlalchemy import select
 from typesense.collection import Collection
 
+from server import metrics
 from server.base.models import Station, Stop
+from .cache import TTLCache
+
+logging.basicConfig(
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+SYNC_BATCH_SIZE = 100
+
+SEARCH_CACHE_TTL = 60
+# 3 decimals are about 100m
+SEARCH_CACHE_LOCATION_DECIMALS = 3
 
+search_cache = TTLCache(SEARCH_CACHE_TTL)
 
+SEARCH_SECONDS = metrics.histogram('muoversi_ts_search_stations_seconds',
+                                   'Duration of the stations searches on Typesense, cached ones included')
+metrics.gauge('muoversi_cache_hit_ratio', 'Ratio of the lookups answered by the cache (coalesced ones included)',
+              ['cache'], collect=lambda: {('typesense_search',): search_cache.stats()['hit_ratio']})
+metrics.counter('muoversi_cache_lookups_total', 'Lookups of the cache by result', ['cache', 'result'],
+                collect=lambda: {('typesense_search', result): search_cache.stats()[result]
+                                 for result in ('hits', 'misses', 'coalesced')})
+
+
+@metrics.timed(SEARCH_SECONDS)
 def ts_search_stations(typesense, sources: list[str], name=None, lat=None, lon=None, page=1, limit=4,
                        hide_ids: list[str] = None) -> tuple[list[Station], int]:
+    if lat and lon:
+        # nearby users share the same results
+        lat, lon = round(float(lat), SEARCH_CACHE_LOCATION_DECIMALS), round(float(lon), SEARCH_CACHE_LOCATION_DECIMALS)
+        name = None
+    else:
+        name = ' '.join(name.lower().split()) if name else name
+
+    key = (name, tuple(sorted(sources)) if sources else (), lat, lon, page, limit,
+           tuple(sorted(hide_ids)) if hide_ids else ())
+    stations, found = search_cache.get_or_compute(
+        key, lambda: search_stations_typesense(typesense, sources, name, lat, lon, page, limit, hide_ids))
+    return list(stations), found
+
+
+def search_stations_typesense(typesense, sources: list[str], name=None, lat=None, lon=None, page=1, limit=4,
+                              hide_ids: list[str] = None) -> tuple[list[Station], int]:
     search_config = {'per_page': limit, 'query_by': 'name', 'page': page}
 
     limit_hits = None
@@ -41,37 +84,59 @@ def ts_search_stations(typesense, sources: list[str], name=None, lat=None, lon=N
     return stations, found
 
 
-def sync_stations_typesense(typesense, session):
-    stations_collection: Collection = typesense.collections['stations']
-
-    # delete all records in typesense
-    stations_collection.documents.delete({'filter_by': 'times_count:>=0'})
-
-    # get all stations_with_stop_ids
+def get_stations_documents(session) -> dict[str, dict]:
+    # get all stations with the ids of their active stops
     stmt = select(Station, Stop.id).select_from(Stop).join(Stop.station).filter(Stop.active)
     stops_stations: list[tuple[Station, str]] = session.execute(stmt).all()
 
-    results: dict[str, tuple[Station, str]] = {}
-    for stop_station in stops_stations:
-        station, stop_id = stop_station
-        if station.id in results:
-            # += ',' + stop_id
-            results[station.id] = (station, results[station.id][1] + ',' + stop_id)
-        else:
-            results[station.id] = (station, stop_id)
-
-    stations_with_stop_ids: list[tuple[Station, str]] = list(results.values())
+    stations: dict[str, Station] = {}
+    stops_ids: dict[str, list[str]] = {}
+    for station, stop_id in stops_stations:
+        stations[station.id] = station
+        stops_ids.setdefault(station.id, []).append(stop_id)
 
-    stations_to_sync = [{
+    return {station.id: {
         'id': station.id,
         'name': station.name,
         'location': [station.lat, station.lon],
-        'ids': stop_ids,
+        'ids': ','.join(stops_ids[station.id]),
         'source': station.source,
         'times_count': station.times_count
-    } for station, stop_ids in stations_with_stop_ids]
+    } for station in stations.values()}
+
+
+def export_stations_documents(stations_collection: Collection) -> dict[str, dict]:
+    exported = stations_collection.documents.export()
+    documents = [json.loads(line) for line in exported.splitlines() if line]
+    return {document['id']: document for document in documents}
+
+
+def diff_stations_documents(current: dict[str, dict], new: dict[str, dict]) -> tuple[list[dict], list[str]]:
+    """Return the documents to upsert (added or changed) and the ids of the documents to delete."""
+    to_upsert = [document for id_, document in new.items()
+                 if id_ not in current or any(current[id_].get(field) != value for field, value in document.items())]
+    to_delete = [id_ for id_ in current if id_ not in new]
+    return to_upsert, to_delete
+
 
-    if not stations_to_sync:
-        return
+def sync_stations_documents(stations_collection: Collection, new_documents: dict[str, dict]) -> tuple[int, int]:
+    to_upsert, to_delete = diff_stations_documents(export_stations_documents(stations_collection), new_documents)
 
-    stations_collection.documents.import_(stations_to_sync)
+    if to_upsert:
+        results = stations_collection.documents.import_(to_upsert, {'action': 'upsert'}, batch_size=SYNC_BATCH_SIZE)
+        for document, result in zip(to_upsert, results):
+            if not result.get('success'):
+                logger.error('could not upsert station %s: %s', document['id'], result.get('error'))
+
+    for i in range(0, len(to_delete), SYNC_BATCH_SIZE):
+        batch = to_delete[i:i + SYNC_BATCH_SIZE]
+        # ids are escaped with backticks since station names may contain commas
+        stations_collection.documents.delete({'filter_by': f'id:[{",".join(f"`{id_}`" for id_ in batch)}]'})
+
+    logger.info('typesense stations synced: %d upserted, %d deleted', len(to_upsert), len(to_delete))
+    return len(to_upsert), len(to_delete)
+
+
+def sync_stations_typesense(typesense, session):
+    stations_collection: Collection = typesense.collections['stations']
+    sync_stations_documents(stations_collection, get_stations_documents(session))
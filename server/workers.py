@@ -0,0 +1,89 @@
+import asyncio
+import logging
+import multiprocessing
+import multiprocessing.connection
+import queue
+import signal
+import socket
+from typing import Callable, Coroutine
+
+import uvicorn
+
+logging.basicConfig(
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+# workers are spawned rather than forked: they must not inherit the database connections and the threads of the
+# process that starts them
+context = multiprocessing.get_context('spawn')
+
+
+def bind_socket(host: str, port: int) -> socket.socket:
+    """Listening socket shared by the worker processes, each of them accepts connections from it."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+
+async def serve(app, sock: socket.socket, **kwargs) -> None:
+    """Serve `app` with uvicorn on an already bound socket, `kwargs` are passed to `uvicorn.Config`."""
+    host, port = sock.getsockname()[:2]
+    webserver = uvicorn.Server(config=uvicorn.Config(app=app, host=host, port=port, **kwargs))
+    await webserver.serve(sockets=[sock])
+
+
+def run_coroutine(coroutine_function: Callable[..., Coroutine], *args) -> None:
+    # entry point of the worker processes, KeyboardInterrupt is also received by every worker on Ctrl+C
+    try:
+        asyncio.run(coroutine_function(*args))
+    except KeyboardInterrupt:
+        pass
+
+
+def start_process(coroutine_function: Callable[..., Coroutine], *args, name: str = None) -> multiprocessing.Process:
+    """Run `coroutine_function(*args)` in a new process, the function and its arguments must be picklable."""
+    process = context.Process(target=run_coroutine, args=(coroutine_function, *args), name=name)
+    process.start()
+    logger.info('started process %s (pid %s)', process.name, process.pid)
+    return process
+
+
+def wait_for_processes(processes: list[multiprocessing.Process]) -> None:
+    """Wait until one of the processes exits, then stop all of them.
+
+    SIGTERM received by the current process is forwarded to the workers, which shut down gracefully.
+    """
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+
+    previous_handler = signal.signal(signal.SIGTERM, stop)
+    try:
+        multiprocessing.connection.wait([process.sentinel for process in processes])
+    except KeyboardInterrupt:
+        pass
+    finally:
+        signal.signal(signal.SIGTERM, previous_handler)
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        for process in processes:
+            process.join()
+            logger.info('process %s exited with code %s', process.name, process.exitcode)
+
+
+async def consume_queue(local_queue: multiprocessing.Queue, callback: Callable[[object], Coroutine]) -> None:
+    """Await `callback` with every item put in `local_queue` by the other processes, until cancelled."""
+    while True:
+        try:
+            # the timeout lets the thread return shortly after the task is cancelled
+            item = await asyncio.to_thread(local_queue.get, timeout=1)
+        except queue.Empty:
+            continue
+        try:
+            await callback(item)
+        except Exception:
+            logger.exception('error while handling an item of the queue')
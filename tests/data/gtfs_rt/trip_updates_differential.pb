@@ -0,0 +1,7 @@
+
+
+2.0)
+1001!
+
+100120240210 
+1003
\ No newline at end of file
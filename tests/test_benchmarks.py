@@ -0,0 +1,56 @@
+import json
+
+from benchmarks.harness import Results, compare
+from benchmarks.suite import StandInDocuments
+
+
+def results(**medians) -> Results:
+    return Results({name: {'median': median} for name, median in medians.items()}, {'commit': 'abc'})
+
+
+def test_measure_and_save(tmp_path):
+    current = Results()
+    stats = current.measure('sum', lambda: sum(range(1000)), repeat=10, rows=1000)
+    assert stats['runs'] == 10
+    assert stats['min'] <= stats['median'] <= stats['p95']
+    assert stats['rows_per_second'] == 1000 / stats['median']
+
+    current.save(str(tmp_path / 'results.json'))
+    loaded = Results.load(str(tmp_path / 'results.json'))
+    assert loaded.benchmarks == current.benchmarks
+    assert loaded.meta['python'] == current.meta['python']
+    assert set(json.loads((tmp_path / 'results.json').read_text())) == {'meta', 'benchmarks'}
+
+
+def test_compare_with_baseline():
+    comparisons = compare(results(get_stop_times=0.013, render=0.0011, search=0.002),
+                          results(get_stop_times=0.010, render=0.001, removed=0.5), tolerance=0.25)
+    by_name = {comparison.name: comparison for comparison in comparisons}
+
+    assert by_name['get_stop_times'].regression
+    assert by_name['get_stop_times'].format() == \
+           'get_stop_times: 13.00 ms, baseline 10.00 ms (+30%)  REGRESSION'
+    assert not by_name['render'].regression
+    # benchmarks added or removed since the baseline are reported, never as regressions
+    assert by_name['search'].format() == 'search: 2.00 ms (new)'
+    assert by_name['removed'].format() == 'removed: missing, was 500.00 ms'
+    assert [comparison.name for comparison in comparisons if comparison.regression] == ['get_stop_times']
+
+
+def test_stand_in_typesense_search():
+    documents = StandInDocuments([
+        {'id': 'P.le Roma', 'name': 'P.le Roma', 'location': [45.438, 12.318], 'source': 'venezia-nav',
+         'times_count': 0.8, 'ids': '1'},
+        {'id': 'Roma', 'name': 'Roma', 'location': [41.9, 12.5], 'source': 'venezia-treni', 'times_count': 1,
+         'ids': '2'},
+        {'id': 'Rialto', 'name': 'Rialto', 'location': [45.438, 12.336], 'source': 'venezia-nav', 'times_count': 0.9,
+         'ids': '3'},
+    ])
+    found = documents.search({'q': 'roma', 'sort_by': 'times_count:desc', 'per_page': 4, 'page': 1,
+                              'query_by': 'name'})
+    assert [hit['document']['id'] for hit in found['hits']] == ['Roma', 'P.le Roma']
+
+    found = documents.search({'q': '*', 'sort_by': 'location(45.43,12.33):asc', 'per_page': 1, 'page': 1,
+                              'query_by': 'name', 'filter_by': 'source:[venezia-nav]'})
+    assert [hit['document']['id'] for hit in found['hits']] == ['Rialto']
+    assert found['found'] == 2
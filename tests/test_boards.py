@@ -0,0 +1,85 @@
+from datetime import datetime, date, timedelta, timezone
+from types import SimpleNamespace
+
+from sqlalchemy.dialects import postgresql
+
+from server.base import Source, Board
+from server.base.source import STOP_TIME_COLUMNS
+
+START_DT = datetime(2024, 1, 15, 8, tzinfo=timezone.utc)
+
+
+class FakeSession:
+    def __init__(self, rows):
+        self.rows = rows
+        self.statements = []
+
+    def execute(self, stmt):
+        self.statements.append(stmt)
+        return self.rows
+
+
+class FakeRealtime:
+    def __init__(self):
+        self.applied = []
+
+    def apply(self, stop_times):
+        for stop_time in stop_times:
+            stop_time.delay = 2
+        self.applied.extend(stop_times)
+
+
+def stop_time_values(prefix, number, stop_id, minutes) -> dict:
+    values = {prefix + key: None for key in STOP_TIME_COLUMNS}
+    values.update({f'{prefix}id': number * 100 + minutes, f'{prefix}number': number, f'{prefix}stop_id': stop_id,
+                   f'{prefix}sched_dep_dt': START_DT + timedelta(minutes=minutes),
+                   f'{prefix}sched_arr_dt': START_DT + timedelta(minutes=minutes),
+                   f'{prefix}orig_dep_date': date(2024, 1, 15), f'{prefix}source': 'venezia-aut'})
+    return values
+
+
+def row(board, departure, arrival=None):
+    mapping = {'board': board, **stop_time_values('d_', *departure)}
+    mapping.update(stop_time_values('a_', *arrival) if arrival else {f'a_{key}': None for key in STOP_TIME_COLUMNS})
+    return SimpleNamespace(board=board, _mapping=mapping)
+
+
+def fake_source(rows) -> Source:
+    source = Source.__new__(Source)
+    source.name = 'venezia-aut'
+    source.session = FakeSession(rows)
+    source.realtime = FakeRealtime()
+    return source
+
+
+def test_boards_are_fetched_with_one_query():
+    source = fake_source([])
+    boards = [Board('1,2', START_DT, limit=5), Board('3', START_DT, arr_stops_ids='4', direction=-1),
+              Board('5', START_DT, offset=(10, 11))]
+    assert source.get_boards(boards) == [[], [], []]
+    assert len(source.session.statements) == 1
+
+    sql = str(source.session.statements[0].compile(dialect=postgresql.dialect()))
+    assert sql.count('UNION ALL') == 2
+    # every branch keeps its own ordering and limit
+    assert sql.count('LIMIT') == 3
+    assert sql.count('DISTINCT ON') == 1
+    assert 'ORDER BY stop_times_2.sched_dep_dt DESC' in sql
+
+
+def test_rows_are_split_by_board():
+    source = fake_source([row(0, (1, 'A', 0)), row(0, (2, 'A', 10)), row(1, (3, 'B', 5), (3, 'C', 20)),
+                          row(2, (4, 'A', 15))])
+    boards = [Board('A', START_DT), Board('B', START_DT, arr_stops_ids='C'), Board('A', START_DT, limit=1),
+              Board('D', START_DT)]
+    departures, trips, first_departure, empty = source.get_boards(boards)
+
+    assert [stop_time.number for stop_time in departures] == [1, 2]
+    assert [(dep.stop_id, arr.stop_id) for dep, arr in trips] == [('B', 'C')]
+    assert trips[0][1].sched_arr_dt == START_DT + timedelta(minutes=20)
+    assert [stop_time.number for stop_time in first_departure] == [4]
+    assert empty == []
+
+    # realtime data is merged once, into the stop times of all the boards
+    assert len(source.realtime.applied) == 5
+    assert departures[0].as_dict()['delay'] == 2
@@ -0,0 +1,101 @@
+from datetime import datetime, timezone, timedelta
+from types import SimpleNamespace
+
+import pytest
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+from starlette.testclient import TestClient
+
+from server.caching import DataVersions
+
+UPDATED_AT = datetime(2024, 2, 20, 4, 30, 12, 345, tzinfo=timezone.utc)
+
+
+def source_row(name, data_version, color='#000000'):
+    return SimpleNamespace(name=name, city_name='venezia', color=color, icon_code=1, data_version=data_version,
+                           data_updated_at=UPDATED_AT)
+
+
+@pytest.fixture
+def data_versions() -> DataVersions:
+    data_versions = DataVersions(engine=None)
+    data_versions.load([source_row('venezia-aut', 3), source_row('venezia-treni', 7)], ['venezia'])
+    return data_versions
+
+
+@pytest.fixture
+def computed() -> list[str]:
+    return []
+
+
+@pytest.fixture
+def client(data_versions, computed) -> TestClient:
+    async def stop_times(request: Request):
+        validators = data_versions.source_validators(request, [request.query_params['source']], 30)
+        if validators.is_not_modified(request):
+            return validators.not_modified_response()
+        computed.append(request.url.path)
+        return JSONResponse([], headers=validators.headers)
+
+    async def cities(request: Request):
+        validators = data_versions.catalog_validators(request, 3600)
+        if validators.is_not_modified(request):
+            return validators.not_modified_response()
+        computed.append(request.url.path)
+        return JSONResponse(['venezia'], headers=validators.headers)
+
+    return TestClient(Starlette(routes=[Route('/stop_times', stop_times), Route('/cities', cities)]))
+
+
+def test_conditional_requests_skip_the_computation(client, computed):
+    response = client.get('/stop_times?source=venezia-aut&dep_stops_ids=1')
+    assert response.status_code == 200
+    assert response.headers['Cache-Control'] == 'public, max-age=30'
+    assert response.headers['Last-Modified'] == 'Tue, 20 Feb 2024 04:30:12 GMT'
+    etag = response.headers['ETag']
+
+    response = client.get('/stop_times?source=venezia-aut&dep_stops_ids=1', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.headers['ETag'] == etag
+    response = client.get('/stop_times?source=venezia-aut&dep_stops_ids=1',
+                          headers={'If-Modified-Since': 'Tue, 20 Feb 2024 04:30:12 GMT'})
+    assert response.status_code == 304
+    assert computed == ['/stop_times']
+
+    # another board of the same source has a different ETag
+    response = client.get('/stop_times?source=venezia-aut&dep_stops_ids=2', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    response = client.get('/stop_times?source=venezia-aut&dep_stops_ids=1',
+                          headers={'If-Modified-Since': 'Tue, 20 Feb 2024 04:30:11 GMT'})
+    assert response.status_code == 200
+
+
+def test_ingestion_changes_the_etag_of_its_source_only(client, data_versions):
+    aut_etag = client.get('/stop_times?source=venezia-aut&dep_stops_ids=1').headers['ETag']
+    treni_etag = client.get('/stop_times?source=venezia-treni&dep_stops_ids=1').headers['ETag']
+    cities_etag = client.get('/cities').headers['ETag']
+
+    data_versions.load([source_row('venezia-aut', 4), source_row('venezia-treni', 7)], ['venezia'])
+    assert client.get('/stop_times?source=venezia-aut&dep_stops_ids=1',
+                      headers={'If-None-Match': aut_etag}).status_code == 200
+    assert client.get('/stop_times?source=venezia-treni&dep_stops_ids=1',
+                      headers={'If-None-Match': treni_etag}).status_code == 304
+    assert client.get('/cities', headers={'If-None-Match': f'"other", {cities_etag}'}).status_code == 304
+
+    # a change of the sources metadata changes the catalog
+    data_versions.load([source_row('venezia-aut', 4, color='#ffffff'), source_row('venezia-treni', 7)], ['venezia'])
+    response = client.get('/cities', headers={'If-None-Match': cities_etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != cities_etag
+
+
+def test_realtime_data_is_part_of_the_validators(data_versions):
+    request = Request({'type': 'http', 'method': 'GET', 'path': '/stop_times', 'query_string': b'source=venezia-aut',
+                       'headers': []})
+    polled_at = UPDATED_AT + timedelta(hours=1)
+    first = data_versions.source_validators(request, ['venezia-aut'], 30, realtime=(1, polled_at))
+    second = data_versions.source_validators(request, ['venezia-aut'], 30, realtime=(2, polled_at))
+    assert first.etag != second.etag
+    assert first.last_modified == polled_at.replace(microsecond=0)
@@ -0,0 +1,77 @@
+import timeit
+from datetime import datetime, timedelta, timezone, date
+
+import pytest
+
+from server.base.models import StopTime
+from tgbot.formatting import NamedStopTime, Route, Direction, format_board, named_stop_time_fragment, \
+    route_fragment
+
+
+def _(text):
+    return {'venezia-aut_platform': 'stop'}.get(text, text)
+
+
+def make_stop_time(i, sched_dep_dt: datetime) -> StopTime:
+    return StopTime(id=i, sched_dep_dt=sched_dep_dt, sched_arr_dt=sched_dep_dt, orig_dep_date=date(2024, 2, 10),
+                    platform='B' if i % 2 else None, orig_id='1', dest_text='LIDO S.M.E. via Piazzale Roma',
+                    number=1000 + i, route_name='5.1', source='venezia-aut', stop_id=f'venezia-aut_{i}')
+
+
+@pytest.fixture
+def board() -> list[NamedStopTime]:
+    first_dt = datetime(2024, 2, 10, 9, 0, tzinfo=timezone.utc)
+    return [NamedStopTime(make_stop_time(i, first_dt + timedelta(minutes=5 * i)), 'P.le Roma') for i in range(15)]
+
+
+def test_named_stop_time_format(board):
+    now = datetime(2024, 2, 10, 9, 3, tzinfo=timezone.utc)
+    assert board[0].format(1, _, 'venezia-aut', now=now) == \
+           '\n1. <del><b>10:00</b> 5.1 LIDO S.M.E. via Piazz\n⎿ <i>/1000 stop /</i></del>'
+    assert board[1].format(2, _, 'venezia-aut', now=now) == \
+           '\n2. <b>10:05</b> 5.1 LIDO S.M.E. via Piazz\n⎿ <i>/1001 stop B</i>'
+
+
+def test_route_format(board):
+    now = datetime(2024, 2, 10, 8, 0, tzinfo=timezone.utc)
+    direction = Direction([Route(board[1], board[3])])
+    assert direction.format(1, _, 'venezia-aut', now=now) == \
+           '\n1. <b>10:05</b>-><b>10:15</b> 5.1 LIDO S.M.E. vi\n⎿ <i>/1001 stop B -> B</i>'
+
+
+def test_departed_state_is_applied_at_render_time(board):
+    before = datetime(2024, 2, 10, 8, 0, tzinfo=timezone.utc)
+    after = datetime(2024, 2, 10, 12, 0, tzinfo=timezone.utc)
+    assert '<del>' not in format_board(board, _, 'venezia-aut', now=before)
+    assert format_board(board, _, 'venezia-aut', now=after).count('<del>') == len(board)
+
+
+def test_fragment_changes_with_stop_time_version(board):
+    named_stop_time_fragment.cache_clear()
+    board[0].format(1, _, 'venezia-aut')
+    board[0].format(1, _, 'venezia-aut')
+    assert named_stop_time_fragment.cache_info().hits == 1
+
+    board[0].stop_time.platform = 'C'
+    assert 'stop C' in board[0].format(1, _, 'venezia-aut')
+    assert named_stop_time_fragment.cache_info().misses == 2
+
+
+def test_board_rendering_benchmark(board):
+    now = datetime(2024, 2, 10, 9, 30, tzinfo=timezone.utc)
+
+    def cold():
+        named_stop_time_fragment.cache_clear()
+        route_fragment.cache_clear()
+        return format_board(board, _, 'venezia-aut', now=now)
+
+    def warm():
+        return format_board(board, _, 'venezia-aut', now=now)
+
+    assert cold() == warm()
+
+    number = 500
+    cold_time = min(timeit.repeat(cold, number=number, repeat=3))
+    warm_time = min(timeit.repeat(warm, number=number, repeat=3))
+    print(f'\n15-row board: cold {cold_time / number * 1e6:.1f}us, cached {warm_time / number * 1e6:.1f}us')
+    assert warm_time < cold_time
@@ -0,0 +1,91 @@
+import os
+import sqlite3
+import subprocess
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from server.GTFS.connections import ReadOnlyConnectionPool, MMAP_SIZE
+from server.GTFS.importer import import_gtfs_zip
+from tests.test_gtfs_importer import write_feed
+
+REPO_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+
+
+@pytest.fixture(scope='module')
+def db_path(tmp_path_factory) -> str:
+    tmp_path = tmp_path_factory.mktemp('gtfs')
+    write_feed(tmp_path / 'feed.zip', n_trips=2000, n_stops=50)
+    import_gtfs_zip(str(tmp_path / 'feed.zip'), str(tmp_path / 'feed.db'))
+    return str(tmp_path / 'feed.db')
+
+
+def test_connections_are_read_only(db_path):
+    pool = ReadOnlyConnectionPool(db_path)
+    with pool.connection() as con:
+        assert con.execute('PRAGMA mmap_size').fetchone() == (MMAP_SIZE,)
+        assert con.execute('SELECT count(*) FROM stop_times').fetchone() == (100000,)
+        with pytest.raises(sqlite3.OperationalError):
+            con.execute('DELETE FROM stop_times')
+    pool.close()
+
+
+def test_pool_size_is_bounded(db_path):
+    pool = ReadOnlyConnectionPool(db_path, size=2)
+    barrier = threading.Barrier(2)
+    used = set()
+
+    def query(i):
+        with pool.connection() as con:
+            used.add(id(con))
+            if i < 2:
+                # the first two queries hold their connection at the same time
+                barrier.wait(5)
+            return con.execute('SELECT count(*) FROM trips').fetchone()[0]
+
+    with ThreadPoolExecutor(max_workers=6) as executor:
+        assert list(executor.map(query, range(12))) == [2000] * 12
+    assert len(used) == 2
+    pool.close()
+
+
+MEMORY_SCRIPT = """
+import sqlite3, sys
+from server.GTFS.connections import ReadOnlyConnectionPool
+
+def rss_anon_kb():
+    with open('/proc/self/status') as f:
+        return next(int(line.split()[1]) for line in f if line.startswith('RssAnon:'))
+
+db_path, mode = sys.argv[1], sys.argv[2]
+before = rss_anon_kb()
+if mode == 'default':
+    con = sqlite3.connect(db_path)
+    run = lambda query: con.execute(query).fetchall()
+else:
+    pool = ReadOnlyConnectionPool(db_path)
+    def run(query):
+        with pool.connection() as con:
+            return con.execute(query).fetchall()
+for _ in range(3):
+    run('SELECT stop_id, count(*), sum(departure_seconds) FROM stop_times GROUP BY stop_id')
+print(rss_anon_kb() - before)
+"""
+
+
+@pytest.mark.skipif(not os.path.exists('/proc/self/status'), reason='memory is read from /proc')
+def test_private_memory_per_worker(db_path):
+    # private memory grown by a worker running a query that reads the whole stop_times table: with a default
+    # connection the pages are copied in the page cache of every process, with mmap they stay in the page cache
+    # shared by the OS
+    def private_memory_kb(mode):
+        output = subprocess.run([sys.executable, '-c', MEMORY_SCRIPT, db_path, mode], cwd=REPO_DIR, check=True,
+                                capture_output=True, text=True).stdout
+        return int(output.split()[-1])
+
+    default_kb, pool_kb = private_memory_kb('default'), private_memory_kb('pool')
+    print(f'\nprivate memory per worker after scanning stop_times: {default_kb} kB with a default connection, '
+          f'{pool_kb} kB with the mmap pool ({os.path.getsize(db_path) // 1024} kB database)')
+    assert pool_kb < default_kb
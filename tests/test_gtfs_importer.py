@@ -0,0 +1,132 @@
+import sqlite3
+import time as time_
+import zipfile
+from datetime import date, time
+
+import pytest
+
+from server.GTFS import GTFS
+from server.GTFS.connections import ReadOnlyConnectionPool
+from server.GTFS.importer import import_gtfs_zip, upgrade_gtfs_db
+
+
+def write_feed(zip_path, n_trips=10, n_stops=20, n_routes=2, start_date='20240101'):
+    # a synthetic feed shaped like the ACTV ones: every trip stops at all the stops, some of them after midnight
+    stops = ['stop_id,stop_name,stop_lat,stop_lon'] + \
+            [f'{i},"Stop {i} ""{chr(65 + i % 3)}""",45.{4000 + i},12.{3000 + i}' for i in range(n_stops)]
+    trips = ['route_id,service_id,trip_id,trip_headsign'] + [f'{i % n_routes},{"WKD" if i % 2 else "SUN"},{1000 + i},LIDO'
+                                                             for i in range(n_trips)]
+    stop_times = ['trip_id,arrival_time,departure_time,stop_id,stop_sequence,stop_headsign,pickup_type']
+    for i in range(n_trips):
+        for sequence in range(1, n_stops + 1):
+            minutes = 6 * 60 + i * 10 + sequence * 2
+            dep_time = f'{minutes // 60}:{minutes % 60:02}:00'
+            pickup_type = 1 if sequence == n_stops else ''
+            stop_times.append(f'{1000 + i},{dep_time},{dep_time},{sequence - 1},{sequence},LIDO,{pickup_type}')
+
+    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+        zip_file.writestr('agency.txt', 'agency_id,agency_name,agency_url,agency_timezone\n'
+                                        'ACTV,ACTV,https://actv.avmspa.it,Europe/Rome\n')
+        zip_file.writestr('calendar.txt', '﻿service_id,monday,tuesday,wednesday,thursday,friday,saturday,sunday,'
+                                          'start_date,end_date\n'
+                                          f'WKD,1,1,1,1,1,1,0,{start_date},20241231\n'
+                                          f'SUN,0,0,0,0,0,0,1,{start_date},20241231\n')
+        zip_file.writestr('calendar_dates.txt', 'service_id,date,exception_type\nWKD,20240210,2\nSUN,20240210,1\n')
+        zip_file.writestr('routes.txt', 'route_id,agency_id,route_short_name,route_long_name,route_type\n' +
+                          ''.join(f'{i},ACTV,{i},P.le Roma - Lido,4\n' for i in range(n_routes)))
+        zip_file.writestr('stops.txt', '\r\n'.join(stops) + '\r\n')
+        zip_file.writestr('trips.txt', '\n'.join(trips) + '\n')
+        zip_file.writestr('stop_times.txt', '\n'.join(stop_times) + '\n')
+        zip_file.writestr('shapes.txt', 'shape_id,shape_pt_lat,shape_pt_lon,shape_pt_sequence\n')
+
+
+@pytest.fixture
+def gtfs_db(tmp_path):
+    write_feed(tmp_path / 'feed.zip')
+    db_path = str(tmp_path / 'navigazione_1.db')
+    counts = import_gtfs_zip(str(tmp_path / 'feed.zip'), db_path)
+    assert counts == {'agency': 1, 'calendar': 2, 'calendar_dates': 2, 'routes': 2, 'stops': 20, 'trips': 10,
+                      'stop_times': 200, 'trip_origins': 10}
+    con = sqlite3.connect(db_path)
+    yield con
+    con.close()
+
+
+def test_import_types_and_values(gtfs_db):
+    stop = gtfs_db.execute('SELECT stop_name, stop_lat FROM stops WHERE stop_id = ?', ('1',)).fetchone()
+    assert stop == ('Stop 1 "B"', 45.4001)
+    assert gtfs_db.execute('SELECT start_date, sunday FROM calendar WHERE service_id = ?', ('SUN',)).fetchone() == \
+           (20240101, 1)
+    # single digit hours are padded, empty values are NULL
+    assert gtfs_db.execute('SELECT departure_time, departure_seconds, pickup_type FROM stop_times '
+                           'WHERE trip_id = ? AND stop_sequence = 1', ('1000',)).fetchone() == ('06:02:00', 21720, None)
+    assert gtfs_db.execute('SELECT * FROM trip_origins WHERE trip_id = ?', ('1001',)).fetchone() == \
+           ('1001', '0', '06:12:00', 22320)
+
+
+def test_indexes_are_used(gtfs_db):
+    plan = ' '.join(row[3] for row in gtfs_db.execute(
+        'EXPLAIN QUERY PLAN SELECT * FROM stop_times WHERE departure_seconds >= ? AND departure_seconds <= ?',
+        (28800, 32400)))
+    assert 'idx_stop_times_departure_seconds' in plan
+    plan = ' '.join(row[3] for row in gtfs_db.execute(
+        'EXPLAIN QUERY PLAN SELECT * FROM stop_times WHERE trip_id = ? AND stop_sequence = 1', ('1000',)))
+    assert 'idx_stop_times_trip_id_stop_sequence' in plan
+
+
+def sqlite_source(db_path) -> GTFS:
+    source = GTFS.__new__(GTFS)
+    source.read_pool, source.service_ids = ReadOnlyConnectionPool(str(db_path)), {}
+    return source
+
+
+def test_stop_times_query_plan(tmp_path):
+    # a feed with about the number of routes and stops of the ACTV ones, the plan depends on the statistics
+    write_feed(tmp_path / 'feed.zip', n_trips=500, n_stops=40, n_routes=100)
+    import_gtfs_zip(str(tmp_path / 'feed.zip'), str(tmp_path / 'feed.db'))
+    con = sqlite3.connect(str(tmp_path / 'feed.db'))
+
+    # the query for the early morning also looks for the trips of the day before
+    query, params = sqlite_source(tmp_path / 'feed.db').get_sqlite_stop_times_query(date(2024, 2, 10), time(5, 0), time(6, 30), 1000, 0)
+    plan = [row[3] for row in con.execute(f'EXPLAIN QUERY PLAN {query}', params)]
+    con.close()
+    assert not [step for step in plan if step.startswith('SCAN')], plan
+    assert 'SEARCH dep USING INDEX idx_stop_times_departure_seconds (departure_seconds>? AND departure_seconds<?)' \
+           in plan or 'SEARCH dep USING INDEX idx_stop_times_departure_seconds (departure_seconds>?)' in plan, plan
+    for table in ('orig', 't', 'r', 's'):
+        assert any(step.startswith(f'SEARCH {table} USING PRIMARY KEY') or
+                   step.startswith(f'SEARCH {table} USING INDEX sqlite_autoindex') for step in plan), plan
+
+
+def test_upgrade_node_gtfs_db(gtfs_db):
+    # databases converted by node-gtfs have neither trip_origins nor the seconds columns
+    gtfs_db.execute('DROP TABLE trip_origins')
+    gtfs_db.execute('DROP INDEX idx_stop_times_departure_seconds')
+    gtfs_db.execute('ALTER TABLE stop_times DROP COLUMN departure_seconds')
+    gtfs_db.execute('ALTER TABLE stop_times DROP COLUMN arrival_seconds')
+
+    assert upgrade_gtfs_db(gtfs_db)
+    assert not upgrade_gtfs_db(gtfs_db)
+    assert gtfs_db.execute('SELECT departure_seconds FROM stop_times WHERE trip_id = ? AND stop_sequence = 1',
+                           ('1000',)).fetchone() == (21720,)
+    assert gtfs_db.execute('SELECT count(*) FROM trip_origins').fetchone() == (10,)
+
+
+def test_get_sqlite_stop_times(gtfs_db, tmp_path):
+    source = sqlite_source(tmp_path / 'navigazione_1.db')
+
+    # on 2024-02-10 the weekday service is replaced by the sunday one
+    assert source.get_active_service_ids(date(2024, 2, 10)) == ('SUN',)
+    stop_times = source.get_sqlite_stop_times(date(2024, 2, 10), time(6, 0), time(6, 30), 1000, 0)
+    assert {stop_time.trip_id for stop_time in stop_times} == {'1000', '1002'}
+    assert all(stop_time.origin_id == '0' for stop_time in stop_times)
+
+
+def test_import_benchmark(tmp_path):
+    write_feed(tmp_path / 'feed.zip', n_trips=1000, n_stops=50)
+    start = time_.perf_counter()
+    counts = import_gtfs_zip(str(tmp_path / 'feed.zip'), str(tmp_path / 'feed.db'))
+    elapsed = time_.perf_counter() - start
+    print(f'\nGTFS import: {counts["stop_times"]} stop_times in {elapsed:.2f}s, '
+          f'{counts["stop_times"] / elapsed:.0f} rows/s')
+    assert counts['stop_times'] == 50000
@@ -0,0 +1,71 @@
+import os
+from datetime import date, datetime
+
+import pytest
+
+from server.GTFS import GTFS
+from server.GTFS import manifest as manifest_module
+from server.GTFS.importer import import_gtfs_zip
+from server.GTFS.manifest import GTFSManifest
+from tests.test_gtfs_importer import write_feed
+
+
+@pytest.fixture
+def versions_dir(tmp_path):
+    # version 1 is in service since January, version 2 is published but starts in March
+    for version, start_date in ((1, '20240101'), (2, '20240301')):
+        write_feed(tmp_path / f'navigazione_{version}.zip', start_date=start_date)
+        import_gtfs_zip(str(tmp_path / f'navigazione_{version}.zip'), str(tmp_path / f'navigazione_{version}.db'))
+    return tmp_path
+
+
+@pytest.fixture
+def scans(monkeypatch) -> list[str]:
+    calls = []
+    scan_calendar = manifest_module.scan_calendar
+
+    def counting_scan_calendar(db_path):
+        calls.append(db_path)
+        return scan_calendar(db_path)
+
+    monkeypatch.setattr(manifest_module, 'scan_calendar', counting_scan_calendar)
+    return calls
+
+
+def test_manifest_entry(versions_dir, scans):
+    manifest = GTFSManifest(str(versions_dir / 'navigazione_manifest.json'))
+    entry = manifest.add_version(2, str(versions_dir / 'navigazione_2.db'), str(versions_dir / 'navigazione_2.zip'))
+    assert (entry['start_date'], entry['end_date']) == ('2024-03-01', '2024-12-31')
+    assert entry['weekday_start_dates']['sunday'] == '2024-03-01'
+    assert len(entry['sha256']) == 64
+
+    # entries are persisted, the calendar is not scanned again
+    manifest = GTFSManifest(str(versions_dir / 'navigazione_manifest.json'))
+    assert manifest.service_start_date(2, str(versions_dir / 'navigazione_2.db'), 'monday') == date(2024, 3, 1)
+    assert len(scans) == 1
+
+
+def test_startup_reads_the_manifest(versions_dir, scans, monkeypatch):
+    def no_network(transport_type):
+        raise AssertionError('the ACTV website must not be requested')
+
+    monkeypatch.setattr('server.GTFS.source.get_latest_gtfs_version', no_network)
+    monkeypatch.setattr(GTFS, 'upload_stops_clusters_to_db', lambda self, force=False: False)
+    GTFSManifest(str(versions_dir / 'navigazione_manifest.json')).set_latest_version(2)
+
+    location = os.path.relpath(versions_dir, os.path.join(os.path.dirname(__file__), os.pardir))
+    ref_dt = datetime(2024, 2, 10)
+    for expected_scans in (2, 2):
+        source = GTFS('navigazione', 'venezia-nav', '⛴️', None, None, location=location, ref_dt=ref_dt)
+        assert source.gtfs_version == 1
+        assert source.next_service_start_date == date(2024, 3, 1)
+        assert len(scans) == expected_scans
+
+    # once version 2 is in service it is selected by the refresh done by save_data.py
+    monkeypatch.setattr('server.GTFS.source.get_latest_gtfs_version', lambda transport_type: 3)
+    # version 3 starts in June, its entry is enough to skip it
+    monkeypatch.setattr(GTFS, 'download_and_convert_file', lambda self, version, force=False: None)
+    source.manifest.data['versions']['3'] = {'weekday_start_dates': {'monday': '2024-06-03'}}
+    assert source.refresh_versions(datetime(2024, 3, 4))
+    assert source.gtfs_version == 2
+    assert source.next_service_start_date == date(2024, 6, 3)
@@ -0,0 +1,145 @@
+import os
+import threading
+import time
+from datetime import date, datetime, timezone
+from functools import partial
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from types import SimpleNamespace
+
+import pytest
+
+from server.GTFS import GTFS
+from server.GTFS.realtime import GTFSRealtimeIndex, parse_feed
+from server.base.models import StopTime
+
+FEEDS_DIR = os.path.join(os.path.dirname(__file__), 'data', 'gtfs_rt')
+# header timestamp of the recorded feeds
+FEED_TIMESTAMP = 1707555600
+
+
+def read_feed(name) -> bytes:
+    with open(os.path.join(FEEDS_DIR, name), 'rb') as f:
+        return f.read()
+
+
+@pytest.fixture
+def index() -> GTFSRealtimeIndex:
+    return GTFSRealtimeIndex(clock=lambda: FEED_TIMESTAMP + 30)
+
+
+@pytest.fixture
+def feeds_server():
+    # local stand-in for the feeds producer, serving the recorded feeds
+    class QuietHandler(SimpleHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), partial(QuietHandler, directory=FEEDS_DIR))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_address[1]}'
+    server.shutdown()
+    server.server_close()
+
+
+def make_stop_time(number, stop_sequence, orig_dep_date=date(2024, 2, 10)) -> StopTime:
+    dt = datetime(2024, 2, 10, 9, 0, tzinfo=timezone.utc)
+    return StopTime(id=1, sched_dep_dt=dt, sched_arr_dt=dt, orig_dep_date=orig_dep_date, platform='A',
+                    orig_id='5000', dest_text='LIDO', number=number, route_name='1', stop_sequence=stop_sequence,
+                    source='venezia-nav', stop_id='venezia-nav_5030')
+
+
+def test_parse_feed():
+    feed = parse_feed(read_feed('trip_updates.pb'))
+    assert len(feed.trip_updates) == 500
+    trip_update = feed.trip_updates[0]
+    assert (trip_update.trip_id, trip_update.start_date) == ('1001', date(2024, 2, 10))
+    assert (trip_update.stop_sequences, trip_update.delays) == ([3, 6], [120, 360])
+    assert feed.trip_updates[1].canceled
+    # negative delays and skipped stops
+    assert feed.trip_updates[2].delays == [-60, None]
+
+    vehicle = parse_feed(read_feed('vehicle_positions.pb')).vehicle_positions[0]
+    assert (vehicle.trip_id, vehicle.current_stop_sequence, vehicle.stop_id) == ('1001', 4, '5031')
+    assert vehicle.lat == pytest.approx(45.4383) and vehicle.lon == pytest.approx(12.3186)
+
+
+def test_delays_propagate_to_following_stops(index):
+    index.apply_feed(read_feed('trip_updates.pb'))
+    assert index.get_delay('1001', 2) is None
+    assert index.get_delay('1001', 3) == 120
+    assert index.get_delay('1001', 5) == 120
+    assert index.get_delay('1001', 8) == 360
+    assert index.get_delay('1002', 1) is None, 'canceled trips have no delay'
+    assert index.get_delay('1003', 2) == -60
+    assert index.get_delay('1003', 4) is None
+    assert index.get_delay('1001', 3, date(2024, 2, 11)) is None, 'the update refers to another day'
+
+
+def test_apply_to_stop_times(index):
+    index.apply_feed(read_feed('trip_updates.pb'))
+    stop_times = [make_stop_time(1001, 4), make_stop_time(1001, 1), make_stop_time(9999, 4)]
+    index.apply(stop_times)
+    assert [stop_time.delay for stop_time in stop_times] == [2, None, None]
+    assert stop_times[0].as_dict()['delay'] == 2
+
+
+def test_incremental_feeds(index):
+    index.apply_feed(read_feed('trip_updates.pb'), feed_id='trips')
+    index.apply_feed(read_feed('vehicle_positions.pb'), feed_id='vehicles')
+
+    # a differential feed only touches its own entities
+    assert index.apply_feed(read_feed('trip_updates_differential.pb'), feed_id='trips') == 1
+    assert index.get_delay('1001', 3) == 600
+    assert index.get_trip_update('1003') is None
+    assert index.get_vehicle_position('1003') is None
+    assert index.get_delay('2000', 40) is not None
+
+    # a full dataset drops the trips it provided before and no longer contains
+    # the recorded feed cut right before its second entity
+    vehicles_only = read_feed('vehicle_positions.pb')
+    index.apply_feed(vehicles_only[:vehicles_only.index(b'v1002') - 4], feed_id='vehicles')
+    assert index.get_vehicle_position('1001') is not None
+    assert index.get_vehicle_position('1002') is None
+    assert index.get_delay('1001', 3) == 600, 'trip updates come from another feed'
+
+    # older data does not overwrite newer one
+    index.apply_feed(read_feed('trip_updates.pb'), feed_id='trips')
+    assert index.get_delay('1001', 3) == 600
+
+
+def test_stale_trips_are_ignored_and_pruned():
+    clock = SimpleNamespace(now=FEED_TIMESTAMP)
+    index = GTFSRealtimeIndex(max_age=600, clock=lambda: clock.now)
+    index.apply_feed(read_feed('trip_updates.pb'))
+    clock.now += 601
+    assert index.get_delay('1001', 3) is None
+    index.prune()
+    assert not index.trip_updates
+
+
+def test_poll_feeds_from_http(feeds_server, index):
+    source = SimpleNamespace(name='venezia-nav', realtime=index, realtime_feeds=[
+        f'{feeds_server}/trip_updates.pb', f'{feeds_server}/vehicle_positions.pb', f'{feeds_server}/missing.pb'])
+    assert GTFS.poll_realtime(source) == 503
+    assert index.get_delay('1001', 6) == 360
+    assert index.get_vehicle_position('1002').stop_id == '5031'
+
+
+def test_throughput(feeds_server, index):
+    source = SimpleNamespace(name='venezia-nav', realtime=index, realtime_feeds=[f'{feeds_server}/trip_updates.pb'])
+    GTFS.poll_realtime(source)
+
+    feed = read_feed('trip_updates.pb')
+    number = 20
+    start = time.perf_counter()
+    updates = sum(index.apply_feed(feed) for _ in range(number))
+    decode_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    polled_updates = sum(GTFS.poll_realtime(source) for _ in range(number))
+    poll_time = time.perf_counter() - start
+
+    print(f'\nGTFS-RT: {updates / decode_time:.0f} updates/s decoded, {polled_updates / poll_time:.0f} updates/s '
+          f'polled over HTTP')
+    assert updates == polled_updates == 500 * number
@@ -0,0 +1,139 @@
+import asyncio
+import json
+from datetime import datetime, date, timedelta, timezone
+
+import httpx
+from starlette.applications import Starlette
+from starlette.routing import Route
+
+from benchmarks.replay import serve_in_background, stop_server
+from server.base import Source
+from server.base.models import StopTime
+from server.live import LiveBoards, diff_rows, KEEPALIVE, SUBSCRIBER_QUEUE_SIZE
+
+START_DT = datetime(2024, 1, 15, 8, tzinfo=timezone.utc)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = START_DT
+
+    def __call__(self):
+        return self.now
+
+
+class FakeLiveSource(Source):
+    # departures every 5 minutes from stop A, delays can be set by id
+    def __init__(self):
+        self.name = 'venezia-aut'
+        self.delays = {}
+        self.queries = 0
+
+    def get_boards(self, boards):
+        self.queries += 1
+        results = []
+        for board in boards:
+            stop_times = []
+            for i in range(40):
+                sched_dep_dt = START_DT + timedelta(minutes=5 * i)
+                if sched_dep_dt >= board.start_dt and len(stop_times) < board.limit:
+                    stop_time = StopTime(id=i, stop_id='A', sched_dep_dt=sched_dep_dt, sched_arr_dt=sched_dep_dt,
+                                         orig_dep_date=date(2024, 1, 15), orig_id='1', dest_text='LIDO',
+                                         number=1000 + i, route_name='5.1', source=self.name)
+                    stop_time.delay = self.delays.get(i)
+                    stop_times.append(stop_time)
+            results.append(stop_times)
+        return results
+
+
+def parse(message: bytes) -> tuple[str, dict]:
+    event, data = message.decode().strip().split('\n')
+    return event.removeprefix('event: '), json.loads(data.removeprefix('data: '))
+
+
+def test_diff_rows():
+    old = [[[1, 'a']], [[2, 'b']], [[3, 'c']]]
+    assert diff_rows(old, [[[1, 'a']], [[2, 'b']], [[3, 'c']]]) is None
+    assert diff_rows(old, [[[2, 'b']], [[3, 'c+2']], [[4, 'd']]]) == \
+           {'removed': [1], 'upserted': [[[3, 'c+2']], [[4, 'd']]], 'order': [2, 3, 4]}
+
+
+def test_boards_are_computed_once_and_diffs_fanned_out():
+    async def main():
+        source, clock = FakeLiveSource(), FakeClock()
+        live_boards = LiveBoards({'venezia-aut': source}, clock=clock)
+        board, first = live_boards.subscribe('venezia-aut', 'A,B', None, 3)
+        same_board, second = live_boards.subscribe('venezia-aut', 'B,A', None, 3)
+        assert board is same_board
+        assert source.queries == 1
+
+        event, snapshot = parse(first.get_nowait())
+        assert event == 'board'
+        assert [row[0][0] for row in snapshot['rows']] == [0, 1, 2]
+        assert second.get_nowait() == board.snapshot
+
+        # nothing changed
+        live_boards.refresh()
+        assert first.get_nowait() == second.get_nowait() == KEEPALIVE
+
+        # a departure passed, another one is delayed: one query for the tick, the same diff for both subscribers
+        clock.now = START_DT + timedelta(minutes=1)
+        source.delays[2] = 4
+        live_boards.refresh()
+        assert source.queries == 3
+        message = first.get_nowait()
+        assert second.get_nowait() == message
+        event, diff = parse(message)
+        assert event == 'diff'
+        assert diff['removed'] == [0]
+        assert [row[0][0] for row in diff['upserted']] == [2, 3]
+        assert diff['upserted'][0][0][5] == 4
+        assert diff['order'] == [1, 2, 3]
+
+        # a new subscriber gets the current board
+        _, third = live_boards.subscribe('venezia-aut', 'A,B', None, 3)
+        assert [row[0][0] for row in parse(third.get_nowait())[1]['rows']] == [1, 2, 3]
+        assert source.queries == 3
+
+        # subscribers that stop reading are dropped, the board goes away with the last one
+        for _ in range(SUBSCRIBER_QUEUE_SIZE + 1):
+            live_boards.refresh()
+        assert third.get_nowait() is None
+        assert len(board.subscribers) == 0
+        assert live_boards.boards == {}
+
+    asyncio.run(main())
+
+
+def test_sse_stream():
+    async def main():
+        source, clock = FakeLiveSource(), FakeClock()
+        live_boards = LiveBoards({'venezia-aut': source}, interval=0.05, clock=clock)
+        app = Starlette(routes=[Route('/stop_times/live', lambda request: live_boards.response(
+            'venezia-aut', request.query_params['dep_stops_ids'], None, 2))])
+        server, task, url = await serve_in_background(app)
+        refresh_task = asyncio.create_task(live_boards.run_periodically())
+        try:
+            async with httpx.AsyncClient(base_url=url) as client:
+                async with client.stream('GET', '/stop_times/live', params={'dep_stops_ids': 'A'}) as response:
+                    assert response.headers['content-type'].startswith('text/event-stream')
+                    events = []
+                    async for line in response.aiter_lines():
+                        if line.startswith('event: '):
+                            events.append(line.removeprefix('event: '))
+                            if events == ['board']:
+                                clock.now = START_DT + timedelta(minutes=6)
+                            elif len(events) == 2:
+                                break
+            assert events == ['board', 'diff']
+            # the subscription ends with the connection
+            for _ in range(100):
+                if not live_boards.boards:
+                    break
+                await asyncio.sleep(0.01)
+            assert live_boards.boards == {}
+        finally:
+            refresh_task.cancel()
+            await stop_server(server, task)
+
+    asyncio.run(main())
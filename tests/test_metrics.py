@@ -0,0 +1,117 @@
+import asyncio
+import time
+
+import pytest
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.responses import PlainTextResponse
+from starlette.routing import Route
+from starlette.testclient import TestClient
+
+from server.metrics import Registry, Counter, Gauge, Histogram, MetricsMiddleware, timed, timed_method
+
+
+@pytest.fixture
+def registry() -> Registry:
+    return Registry()
+
+
+def test_exposition_format(registry):
+    requests = registry.register(Counter('requests_total', 'Requests', ['route']))
+    registry.register(Gauge('cache_hit_ratio', 'Hit ratio', ['cache'], collect=lambda: {('search',): 0.75}))
+    seconds = registry.register(Histogram('query_seconds', 'Queries', ['method'], buckets=(0.01, 0.1)))
+    registry.register(Counter('unused_total', 'Never incremented'))
+
+    requests.inc('/stop_times')
+    requests.inc('/stop_times', amount=2)
+    requests.inc('say "hi"')
+    for value in (0.005, 0.01, 0.05, 3):
+        seconds.observe(value, 'get_stop_times')
+
+    assert registry.expose() == '''# HELP requests_total Requests
+# TYPE requests_total counter
+requests_total{route="/stop_times"} 3
+requests_total{route="say \\"hi\\""} 1
+# HELP cache_hit_ratio Hit ratio
+# TYPE cache_hit_ratio gauge
+cache_hit_ratio{cache="search"} 0.75
+# HELP query_seconds Queries
+# TYPE query_seconds histogram
+query_seconds_bucket{method="get_stop_times",le="0.01"} 2
+query_seconds_bucket{method="get_stop_times",le="0.1"} 3
+query_seconds_bucket{method="get_stop_times",le="+Inf"} 4
+query_seconds_sum{method="get_stop_times"} 3.065
+query_seconds_count{method="get_stop_times"} 4
+'''
+
+    with pytest.raises(ValueError):
+        registry.register(Counter('requests_total', 'Requests'))
+
+
+def test_textfile_holds_the_given_metrics(registry, tmp_path):
+    rows = registry.register(Counter('ingested_rows_total', 'Rows', ['source']))
+    registry.register(Counter('other_total', 'Other')).inc()
+    rows.inc('venezia-aut', amount=120)
+    registry.write_textfile(str(tmp_path / 'ingestion.prom'), [rows])
+    assert (tmp_path / 'ingestion.prom').read_text() == \
+           '# HELP ingested_rows_total Rows\n# TYPE ingested_rows_total counter\n' \
+           'ingested_rows_total{source="venezia-aut"} 120\n'
+
+
+def test_timed_functions_and_methods():
+    seconds = Histogram('seconds', 'Durations', ['source', 'method'])
+
+    @timed(seconds, 'venezia-aut', 'sync')
+    def sync_function():
+        return 1
+
+    @timed(seconds, 'venezia-aut', 'async')
+    async def async_function():
+        await asyncio.sleep(0.01)
+        return 2
+
+    class FakeSource:
+        name = 'venezia-nav'
+
+        @timed_method(seconds, 'get_stop_times')
+        def get_stop_times(self):
+            raise RuntimeError
+
+    assert sync_function() == 1
+    assert asyncio.run(async_function()) == 2
+    with pytest.raises(RuntimeError):
+        FakeSource().get_stop_times()
+
+    assert seconds.count('venezia-aut', 'sync') == 1
+    assert seconds.count('venezia-aut', 'async') == 1
+    # failed calls are observed too
+    assert seconds.count('venezia-nav', 'get_stop_times') == 1
+    assert seconds._series[('venezia-aut', 'async')][1][0] >= 0.01
+
+
+def test_middleware_observes_routes():
+    seconds = Histogram('http_seconds', 'Requests', ['endpoint', 'method', 'status'])
+
+    def stop_times(request):
+        return PlainTextResponse('[]')
+
+    client = TestClient(Starlette(routes=[Route('/stop_times', stop_times)],
+                                  middleware=[Middleware(MetricsMiddleware, metric=seconds)]))
+    client.get('/stop_times')
+    client.get('/stop_times')
+    client.get('/missing')
+    assert seconds.count('stop_times', 'GET', 200) == 2
+    assert seconds.count('not_found', 'GET', 404) == 1
+
+
+def test_observe_overhead():
+    seconds = Histogram('seconds', 'Durations', ['source', 'method'])
+    n = 100000
+    start = time.perf_counter()
+    for _ in range(n):
+        with seconds.time('venezia-aut', 'get_stop_times'):
+            pass
+    per_call = (time.perf_counter() - start) / n
+    print(f'\ntimer overhead: {per_call * 1e6:.2f} µs per observation')
+    # negligible compared to the milliseconds of a query
+    assert per_call < 20e-6
@@ -0,0 +1,33 @@
+from datetime import date
+
+from server.partitions import partition_name, partition_day, plan_partitions
+
+
+def test_partition_name_and_day():
+    assert partition_name(date(2024, 2, 9)) == 'stop_times_20240209'
+    assert partition_day('stop_times_20240209') == date(2024, 2, 9)
+    assert partition_day('stop_times_default') is None
+    assert partition_day('stop_times_reg') is None
+    assert partition_day('stops') is None
+
+
+def test_plan_creates_missing_days_ahead():
+    today = date(2024, 2, 10)
+    to_create, to_expire = plan_partitions(today, {date(2024, 2, 9), date(2024, 2, 10)}, 3, 1)
+    assert to_create == [date(2024, 2, 11), date(2024, 2, 12)]
+    assert to_expire == []
+
+
+def test_plan_is_idempotent():
+    today = date(2024, 2, 10)
+    existing = {date(2024, 2, 9), date(2024, 2, 10), date(2024, 2, 11), date(2024, 2, 12)}
+    assert plan_partitions(today, existing, 3, 1) == ([], [])
+
+
+def test_plan_catches_up_missed_days():
+    # the manager did not run for a week: every expired day is removed, even with gaps between them
+    today = date(2024, 2, 10)
+    existing = {date(2024, 2, 1), date(2024, 2, 3), date(2024, 2, 4), date(2024, 2, 5)}
+    to_create, to_expire = plan_partitions(today, existing, 3, 1)
+    assert to_create == [date(2024, 2, 10), date(2024, 2, 11), date(2024, 2, 12)]
+    assert to_expire == [date(2024, 2, 1), date(2024, 2, 3), date(2024, 2, 4), date(2024, 2, 5)]
@@ -0,0 +1,67 @@
+from datetime import datetime, timezone, date
+
+import pytest
+
+from server.base.models import StopTime
+from server.base.realtime import RealtimeStore
+from tgbot.formatting import NamedStopTime
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock() -> FakeClock:
+    return FakeClock()
+
+
+@pytest.fixture
+def store(clock) -> RealtimeStore:
+    return RealtimeStore(max_age=600, clock=clock)
+
+
+def make_stop_time(number=2215, stop_id='S02593', platform='3') -> StopTime:
+    return StopTime(id=1, sched_dep_dt=datetime(2024, 2, 10, 9, 0, tzinfo=timezone.utc),
+                    sched_arr_dt=datetime(2024, 2, 10, 9, 0, tzinfo=timezone.utc), orig_dep_date=date(2024, 2, 10),
+                    platform=platform, orig_id='S02581', dest_text='VENEZIA S. LUCIA', number=number,
+                    route_name='R', source='venezia-treni', stop_id=stop_id)
+
+
+def test_apply_merges_updates(store):
+    stop_time, other_stop_time = make_stop_time(), make_stop_time(number=2217)
+    store.update(2215, date(2024, 2, 10), 'S02593', 7, '5')
+    store.apply([stop_time, other_stop_time])
+
+    assert (stop_time.delay, stop_time.current_platform()) == (7, '5')
+    assert stop_time.platform == '3', 'the scheduled platform must not be modified'
+    assert (other_stop_time.delay, other_stop_time.current_platform()) == (None, '3')
+
+    as_dict = stop_time.as_dict()
+    assert (as_dict['delay'], as_dict['platform']) == (7, '5')
+
+
+def test_stale_updates_are_ignored_and_pruned(store, clock):
+    store.update(2215, date(2024, 2, 10), 'S02593', 7, '5')
+    clock.now = 601
+    stop_time = make_stop_time()
+    store.apply([stop_time])
+    assert stop_time.delay is None
+
+    store.prune()
+    assert len(store) == 0
+
+
+def test_delay_in_board_line(store):
+    stop_time = make_stop_time()
+    store.update(2215, date(2024, 2, 10), 'S02593', 5, None)
+    store.apply([stop_time])
+
+    # scheduled at 10:00 with 5 minutes of delay, at 10:03 the train has not departed yet
+    now = datetime(2024, 2, 10, 9, 3, tzinfo=timezone.utc)
+    line = NamedStopTime(stop_time, 'MESTRE').format(1, lambda text: 'bin.', 'venezia-treni', now=now)
+    assert line == "\n1. <b>10:00</b> <i>+5'</i> R VENEZIA S. LUCIA\n⎿ <i>/2215 bin. 3</i>"
@@ -0,0 +1,60 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import pytest
+
+from server.registry import SourceRegistry
+
+
+@pytest.fixture
+def constructed() -> list[str]:
+    return []
+
+
+@pytest.fixture
+def registry(constructed) -> SourceRegistry:
+    def factory(name, seconds=0.0):
+        def construct():
+            constructed.append(name)
+            time.sleep(seconds)
+            return SimpleNamespace(name=name)
+
+        return construct
+
+    return SourceRegistry({'venezia-aut': factory('venezia-aut', 0.02), 'venezia-nav': factory('venezia-nav'),
+                           'venezia-treni': factory('venezia-treni')})
+
+
+def test_sources_are_constructed_on_first_use(registry, constructed):
+    assert list(registry) == ['venezia-aut', 'venezia-nav', 'venezia-treni']
+    assert 'venezia-nav' in registry and 'venezia-bus' not in registry
+    assert constructed == []
+
+    assert registry['venezia-nav'].name == 'venezia-nav'
+    assert registry['venezia-nav'] is registry['venezia-nav']
+    assert constructed == ['venezia-nav']
+    assert not registry.is_initialized('venezia-aut')
+
+    with pytest.raises(KeyError):
+        registry['venezia-bus']
+
+
+def test_concurrent_lookups_construct_once(registry, constructed):
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(lambda _: registry['venezia-aut'], range(8)))
+    assert constructed == ['venezia-aut']
+    assert all(result is results[0] for result in results)
+
+
+def test_warm_up_reports_timings(registry, constructed):
+    initialized = []
+    registry.on_init = lambda source: initialized.append(source.name)
+    registry['venezia-nav']
+
+    timings = registry.warm_up()
+    assert list(timings) == ['venezia-aut', 'venezia-nav', 'venezia-treni']
+    assert timings['venezia-aut'] >= 0.02
+    assert sorted(constructed) == sorted(registry)
+    # on_init runs once per source
+    assert initialized == ['venezia-nav', 'venezia-aut', 'venezia-treni']
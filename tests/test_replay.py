@@ -0,0 +1,125 @@
+import asyncio
+from datetime import datetime
+
+import httpx
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+from starlette.testclient import TestClient
+from telegram import Bot
+from telegram.request import HTTPXRequest
+
+from benchmarks.replay import TelegramStub, load_traffic, synthetic_traffic, replay, in_process_client, \
+    socket_client, serve_in_background, stop_server, message_update, WEBHOOK_PATH
+from server.recording import TrafficRecorder
+
+STATIONS = [{'id': 'P.le Roma', 'name': 'P.le Roma', 'ids': '1,2', 'source': 'venezia-aut'},
+            {'id': 'Lido S.M.E.', 'name': 'Lido S.M.E.', 'ids': '3', 'source': 'venezia-aut'},
+            {'id': 'Rialto', 'name': 'Rialto', 'ids': '4', 'source': 'venezia-nav'}]
+
+
+def stand_in_app(stub: TelegramStub = None) -> Starlette:
+    # /stop_times fails for one of the stations; the webhook answers through the stubbed Bot API, as the bot does
+    bot_api = httpx.AsyncClient(transport=httpx.ASGITransport(app=stub.app), base_url='http://stub') if stub else None
+    tasks = set()
+
+    async def stop_times(request: Request):
+        if request.query_params['dep_stops_ids'] == '4':
+            return Response(status_code=500)
+        return JSONResponse([])
+
+    async def search_stations(request: Request):
+        return JSONResponse(STATIONS)
+
+    async def webhook(request: Request):
+        update = await request.json()
+        if bot_api is not None:
+            task = asyncio.create_task(bot_api.post('/bot123:abc/sendMessage', data={
+                'chat_id': str(update['message']['chat']['id']), 'text': 'ok'}))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        return Response()
+
+    return Starlette(routes=[Route('/stop_times', stop_times), Route('/search/stations', search_stations),
+                             Route(WEBHOOK_PATH, webhook, methods=['POST'])])
+
+
+def test_recorded_traffic_is_grouped_by_chat(tmp_path):
+    path = str(tmp_path / 'traffic.jsonl')
+    app = stand_in_app()
+    app.user_middleware.insert(0, Middleware(TrafficRecorder, path=path))
+    client = TestClient(app)
+    client.get('/stop_times?source=venezia-aut&dep_stops_ids=1,2')
+    client.post(WEBHOOK_PATH, json=message_update(1, 42, '/fermata'))
+    client.get('/search/stations?q=lido')
+    client.post(WEBHOOK_PATH, json=message_update(2, 43, '/linea'))
+    client.post(WEBHOOK_PATH, json=message_update(3, 42, 'rialto'))
+    client.get('/metrics')
+
+    jobs = load_traffic(path)
+    assert [[entry['path'] for entry in job] for job in jobs] == [
+        ['/stop_times?source=venezia-aut&dep_stops_ids=1,2'], [WEBHOOK_PATH, WEBHOOK_PATH],
+        ['/search/stations?q=lido'], [WEBHOOK_PATH]]
+    assert jobs[1][1]['body']['message']['text'] == 'rialto'
+    assert jobs[0][0]['at'] == 0 and jobs[1][1]['at'] > 0
+
+
+def test_synthetic_traffic():
+    jobs = synthetic_traffic(200, STATIONS, datetime(2024, 1, 15, 8), seed=1)
+    assert len(jobs) == 200
+    assert synthetic_traffic(200, STATIONS, datetime(2024, 1, 15, 8), seed=1) == jobs
+    paths = [entry['path'].split('?')[0] for job in jobs for entry in job]
+    assert {'/stop_times', '/search/stations', WEBHOOK_PATH} == set(paths)
+    sessions = [job for job in jobs if job[0]['path'] == WEBHOOK_PATH]
+    assert all([entry['body']['message']['text'] for entry in job][::2] == ['/fermata', '/cancel'] for job in sessions)
+    # every update has its own id
+    update_ids = [entry['body']['update_id'] for job in sessions for entry in job]
+    assert len(set(update_ids)) == len(update_ids)
+
+
+def test_in_process_replay():
+    async def main():
+        stub = TelegramStub()
+        jobs = synthetic_traffic(300, STATIONS, datetime(2024, 1, 15, 8), seed=2)
+        async with in_process_client(stand_in_app(stub)) as client:
+            return await replay(client, jobs, concurrency=16, stub=stub, secret_token='secret'), jobs, stub
+
+    report, jobs, stub = asyncio.run(main())
+    summary = report.summary()
+    print('\n' + report.format())
+
+    failing = sum(1 for job in jobs for entry in job if 'dep_stops_ids=4' in entry['path'])
+    assert summary['requests'] == sum(map(len, jobs))
+    assert summary['kinds']['stop_times']['statuses'].get('500', 0) == failing
+    assert summary['error_rate'] == failing / summary['requests']
+    # every update is answered by the bot
+    assert summary['kinds']['bot_reply']['requests'] == summary['kinds']['webhook']['requests']
+    assert summary['kinds']['bot_reply']['statuses'] == {'replied': summary['kinds']['webhook']['requests']}
+    assert stub.calls['sendMessage'] == summary['kinds']['webhook']['requests']
+    kind = summary['kinds']['search_stations']
+    assert 0 < kind['p50'] <= kind['p90'] <= kind['p99'] <= kind['max']
+
+
+def test_socket_replay_and_bot_api_stub():
+    async def main():
+        stub = TelegramStub()
+        stub_server, stub_task, stub_url = await serve_in_background(stub.app)
+        stub.base_url = f'{stub_url}/bot'
+        server, task, base_url = await serve_in_background(stand_in_app())
+        try:
+            # the stub is understood by python-telegram-bot
+            async with Bot('123:abc', base_url=stub.base_url, request=HTTPXRequest(http_version='1.1')) as bot:
+                message = await bot.send_message(42, 'ciao')
+            async with socket_client(base_url, 4) as client:
+                report = await replay(client, synthetic_traffic(20, STATIONS[:2], datetime(2024, 1, 15, 8)), 4)
+        finally:
+            await stop_server(server, task)
+            await stop_server(stub_server, stub_task)
+        return message, report, stub
+
+    message, report, stub = asyncio.run(main())
+    assert message.chat.id == 42 and message.text == 'ciao'
+    assert stub.calls['getMe'] == 1 and stub.calls['sendMessage'] == 1
+    assert report.summary()['error_rate'] == 0
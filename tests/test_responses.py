@@ -0,0 +1,117 @@
+import gzip
+import json
+import time
+from datetime import datetime, date, timedelta, timezone
+
+import orjson
+import pytest
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.responses import PlainTextResponse
+from starlette.routing import Route
+from starlette.testclient import TestClient
+
+from server.base.models import StopTime
+from server.responses import ORJSONResponse, CompressionMiddleware, stop_times_rows, accepted_encoding, brotli
+
+START_DT = datetime(2024, 1, 15, 7, 4, tzinfo=timezone.utc)
+
+
+def a_to_b_response() -> list[tuple[StopTime, StopTime]]:
+    # the 15 rows of a full /stop_times response between two stops
+    stop_times = []
+    for i in range(15):
+        values = dict(orig_dep_date=date(2024, 1, 15), platform=str(i % 4 + 1), orig_id='S02593',
+                      dest_text='VENEZIA SANTA LUCIA', number=2210 + i, route_name='RV', source='venezia-treni')
+        departure = StopTime(id=1000 + i, stop_id='S02581', sched_arr_dt=START_DT + timedelta(minutes=20 * i),
+                             sched_dep_dt=START_DT + timedelta(minutes=20 * i + 1), **values)
+        arrival = StopTime(id=2000 + i, stop_id='S02593', sched_arr_dt=START_DT + timedelta(minutes=20 * i + 12),
+                           sched_dep_dt=START_DT + timedelta(minutes=20 * i + 14), **values)
+        arrival.delay = i % 3
+        stop_times.append((departure, arrival))
+    return stop_times
+
+
+def stdlib_body(stop_times) -> bytes:
+    # previous serialization: as_dict rendered by Starlette's JSONResponse
+    return json.dumps([[stop_time[0].as_dict(), stop_time[1].as_dict()] for stop_time in stop_times],
+                      ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode("utf-8")
+
+
+def orjson_body(stop_times, compact=False) -> bytes:
+    rows = stop_times_rows(stop_times, compact)
+    return ORJSONResponse({'fields': StopTime.API_FIELDS, 'rows': rows} if compact else rows).body
+
+
+def p99_ms(function, iterations=2000) -> float:
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    return timings[int(len(timings) * 0.99)] * 1000
+
+
+def test_orjson_body_is_unchanged():
+    stop_times = a_to_b_response()
+    assert orjson.loads(orjson_body(stop_times)) == json.loads(stdlib_body(stop_times))
+    assert orjson.loads(orjson_body(stop_times[:1]))[0][0]['sched_dep_dt'] == '2024-01-15T08:05:00'
+
+    compact = orjson.loads(orjson_body(stop_times, compact=True))
+    dicts = [[dict(zip(compact['fields'], stop_time)) for stop_time in row] for row in compact['rows']]
+    assert dicts == json.loads(stdlib_body(stop_times))
+
+
+def test_serialization_benchmark():
+    stop_times = a_to_b_response()
+    bodies = {'stdlib json': stdlib_body(stop_times), 'orjson': orjson_body(stop_times),
+              'orjson compact': orjson_body(stop_times, compact=True)}
+    timings = {'stdlib json': p99_ms(lambda: stdlib_body(stop_times)),
+               'orjson': p99_ms(lambda: orjson_body(stop_times)),
+               'orjson compact': p99_ms(lambda: orjson_body(stop_times, compact=True))}
+
+    print('\n15-row A→B /stop_times response:')
+    for name, body in bodies.items():
+        sizes = f'{len(body)} B, gzip {len(gzip.compress(body, 6))} B'
+        if brotli is not None:
+            sizes += f', brotli {len(brotli.compress(body, quality=4))} B'
+        print(f'  {name}: {sizes}, p99 serialization {timings[name]:.3f} ms')
+
+    assert len(bodies['orjson compact']) < len(bodies['orjson']) * 0.6
+    assert timings['orjson compact'] < timings['stdlib json']
+
+
+@pytest.mark.parametrize('accept_encoding, encoding', [
+    ('', None),
+    ('gzip, deflate', 'gzip'),
+    ('gzip;q=0', None),
+    ('identity', None),
+    ('*', 'br' if brotli else 'gzip'),
+    ('br;q=0.5, gzip', 'gzip'),
+    ('br, gzip', 'br' if brotli else 'gzip'),
+])
+def test_accepted_encoding(accept_encoding, encoding):
+    assert accepted_encoding(accept_encoding) == encoding
+
+
+def test_large_responses_are_compressed():
+    stop_times = a_to_b_response()
+    app = Starlette(routes=[Route('/stop_times', lambda request: ORJSONResponse(stop_times_rows(stop_times))),
+                            Route('/small', lambda request: PlainTextResponse('ok'))],
+                    middleware=[Middleware(CompressionMiddleware, minimum_size=500)])
+    client = TestClient(app)
+
+    response = client.get('/stop_times', headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert response.headers['Vary'] == 'Accept-Encoding'
+    assert int(response.headers['Content-Length']) < len(orjson_body(stop_times)) / 4
+    assert response.json() == orjson.loads(orjson_body(stop_times))
+
+    response = client.get('/small', headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in response.headers
+    assert response.text == 'ok'
+
+    response = client.get('/stop_times', headers={'Accept-Encoding': 'identity'})
+    assert 'Content-Encoding' not in response.headers
+    assert response.content == orjson_body(stop_times)
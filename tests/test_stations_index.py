@@ -0,0 +1,76 @@
+import pytest
+
+from server.base.models import Station
+from server.search import StationsIndex, haversine_km
+
+
+@pytest.fixture
+def stations_index() -> StationsIndex:
+    stations = [
+        ('P.le Roma', 45.4380, 12.3185, 'venezia-aut', 1.0),
+        ('Piazzale Roma People Mover', 45.4376, 12.3182, 'venezia-aut', 0.2),
+        ('P.le Roma', 45.4382, 12.3188, 'venezia-nav', 0.8),
+        ('S. Marco-S. Zaccaria', 45.4335, 12.3425, 'venezia-nav', 0.7),
+        ('Stazione MESTRE FS', 45.4826, 12.2318, 'venezia-aut', 0.9),
+        ('MESTRE', 45.4826, 12.2322, 'venezia-treni', 0.6),
+        ('VENEZIA S. LUCIA', 45.4415, 12.3209, 'venezia-treni', 0.95),
+        ('Lido S.M.E.', 45.4183, 12.3694, 'venezia-nav', 0.5),
+        ('PADOVA', 45.4178, 11.8808, 'venezia-treni', 0.99),
+    ]
+    index = StationsIndex()
+    index.load([(Station(id=f'{name}-{source}', name=name, lat=lat, lon=lon, source=source, times_count=times_count),
+                 f'{source}_{i}') for i, (name, lat, lon, source, times_count) in enumerate(stations)])
+    return index
+
+
+def names(results):
+    return [station.name for station in results[0]]
+
+
+def test_ranking_by_times_count(stations_index):
+    assert names(stations_index.search([], 'roma')) == ['P.le Roma', 'P.le Roma', 'Piazzale Roma People Mover']
+
+
+def test_prefix_search(stations_index):
+    assert names(stations_index.search([], 'mest')) == ['Stazione MESTRE FS', 'MESTRE']
+    assert names(stations_index.search([], 'venezia s. luc')) == ['VENEZIA S. LUCIA']
+
+
+def test_synonyms(stations_index):
+    assert names(stations_index.search([], 'piazzale roma')) == ['P.le Roma', 'P.le Roma',
+                                                                 'Piazzale Roma People Mover']
+    assert names(stations_index.search([], 'santa lucia')) == ['VENEZIA S. LUCIA']
+    assert names(stations_index.search([], 'mestre stazione')) == ['Stazione MESTRE FS']
+
+
+def test_typo_tolerance(stations_index):
+    assert names(stations_index.search([], 'padva')) == ['PADOVA']
+    assert names(stations_index.search([], 'zacaria')) == ['S. Marco-S. Zaccaria']
+    # tokens shorter than 4 characters do not allow typos
+    assert names(stations_index.search([], 'lodo')) == ['Lido S.M.E.']
+    assert names(stations_index.search([], 'xyz')) == []
+
+
+def test_filters_and_paging(stations_index):
+    assert names(stations_index.search(['venezia-nav'], 'roma')) == ['P.le Roma']
+    assert names(stations_index.search([], 'roma', hide_ids=['P.le Roma-venezia-aut'])) == \
+           ['P.le Roma', 'Piazzale Roma People Mover']
+
+    results, count = stations_index.search([], 'roma', page=2, limit=2)
+    assert [station.name for station in results] == ['Piazzale Roma People Mover']
+    assert count == 3
+
+
+def test_nearest_stations(stations_index):
+    lat, lon = 45.4410, 12.3200
+    results, count = stations_index.search([], lat=lat, lon=lon, limit=4)
+    distances = [haversine_km(lat, lon, station.lat, station.lon) for station in results]
+    assert results[0].name == 'VENEZIA S. LUCIA'
+    assert distances == sorted(distances)
+    assert count == 8
+
+    all_by_distance = sorted(stations_index._data.stations, key=lambda s: haversine_km(lat, lon, s.lat, s.lon))
+    assert [station.id for station in results] == [station.id for station in all_by_distance[:4]]
+
+    results, _ = stations_index.search(['venezia-treni'], lat=lat, lon=lon, page=2, limit=2)
+    assert [station.name for station in results] == ['PADOVA']
@@ -0,0 +1,104 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy import create_engine, text
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.responses import PlainTextResponse
+from starlette.routing import Route
+from starlette.testclient import TestClient
+
+from server import tracing
+
+
+@pytest.fixture
+def engine(tmp_path):
+    # a file, since the EXPLAIN runs on another connection, from another thread
+    engine = create_engine(f'sqlite:///{tmp_path / "muoversi.db"}')
+    with engine.begin() as con:
+        con.execute(text('CREATE TABLE stops (id TEXT PRIMARY KEY, name TEXT)'))
+        con.execute(text("INSERT INTO stops VALUES ('A', 'Piazzale Roma'), ('B', 'Rialto')"))
+    return engine
+
+
+@pytest.fixture
+def tracer(engine, tmp_path, monkeypatch):
+    # every statement is slow and sampled
+    tracer = tracing.QueryTracer(engine, str(tmp_path / 'queries.log'), slow_threshold=0, explain_sample_rate=1,
+                                 max_queries=1)
+    tracer.install()
+    monkeypatch.setattr(tracing, 'tracer', tracer)
+    yield tracer
+    tracer.uninstall()
+
+
+def read_log(tracer) -> list[dict]:
+    tracer.executor.submit(lambda: None).result()
+    with open(tracer.handler.baseFilename) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_queries_are_logged_with_the_request_id(engine, tracer):
+    with tracing.request_context('/stops', 'req-1'):
+        with engine.connect() as con:
+            con.execute(text('SELECT name FROM stops WHERE id = :id'), {'id': 'A'}).all()
+            con.execute(text("UPDATE stops SET name = 'Rialto Mercato' WHERE id = 'B'"))
+    with engine.connect() as con:
+        con.execute(text('SELECT 1')).all()
+
+    records = read_log(tracer)
+    queries = [record for record in records if record['type'] == 'query']
+    assert [query['request_id'] for query in queries] == ['req-1', 'req-1', None]
+    assert queries[0]['statement'] == 'SELECT name FROM stops WHERE id = ?'
+    assert queries[0]['parameters'] == '["A"]'
+    assert queries[1]['rowcount'] == 1
+    assert all(query['elapsed'] >= 0 for query in queries)
+
+    # only the read-only statements are explained
+    explains = [record for record in records if record['type'] == 'explain']
+    assert [explain['statement'] for explain in explains] == ['SELECT name FROM stops WHERE id = ?', 'SELECT 1']
+    assert explains[0]['request_id'] == 'req-1'
+    assert 'USING INDEX' in str(explains[0]['plan'])
+
+    [request] = [record for record in records if record['type'] == 'request']
+    assert request == {**request, 'request_id': 'req-1', 'name': '/stops', 'queries': 2, 'over_budget': True}
+
+
+def test_explain_is_sampled(engine, tracer):
+    tracer.random = lambda: 0.5
+    tracer.explain_sample_rate = 0.1
+    with engine.connect() as con:
+        con.execute(text('SELECT 1')).all()
+    assert [record['type'] for record in read_log(tracer)] == ['query']
+
+
+def test_request_id_middleware(engine, tracer):
+    def stops(request):
+        with engine.connect() as con:
+            return PlainTextResponse(con.execute(text('SELECT name FROM stops')).scalars().first())
+
+    client = TestClient(Starlette(routes=[Route('/stops', stops)], middleware=[Middleware(tracing.RequestIdMiddleware)]))
+    response = client.get('/stops', headers={'X-Request-ID': 'from-proxy'})
+    assert response.headers['X-Request-ID'] == 'from-proxy'
+    generated = client.get('/stops').headers['X-Request-ID']
+    assert len(generated) == 16
+
+    request_ids = [record['request_id'] for record in read_log(tracer) if record['type'] == 'query']
+    assert request_ids == ['from-proxy', generated]
+
+
+def test_bot_handlers_are_traced_with_the_update_id(engine, tracer):
+    async def search_station(update, context):
+        await asyncio.to_thread(lambda: engine.connect().execute(text('SELECT 1')).all())
+        return tracing.get_request_id()
+
+    handler = tracing.traced_handler(search_station, 'entry.search_station')
+    assert handler.__name__ == 'search_station'
+    assert asyncio.run(handler(SimpleNamespace(update_id=42), None)) == 'tg-42'
+    assert tracing.get_request_id() is None
+
+    records = read_log(tracer)
+    assert [record['request_id'] for record in records if record['type'] == 'query'] == ['tg-42']
+    assert [record['name'] for record in records if record['type'] == 'request'] == ['entry.search_station']
@@ -0,0 +1,64 @@
+import gettext
+import timeit
+from types import SimpleNamespace
+
+import pytest
+from telegram import KeyboardButton, ReplyKeyboardMarkup
+
+from tgbot.translations import Translations, localedir
+
+
+@pytest.fixture(scope='module')
+def translations() -> Translations:
+    return Translations(['venezia-aut', 'venezia-nav', 'venezia-treni'])
+
+
+def fake_update(language_code):
+    return SimpleNamespace(effective_user=SimpleNamespace(language_code=language_code))
+
+
+def test_languages_are_preloaded(translations):
+    assert translations.langs == ['en', 'it']
+    for lang in translations.langs:
+        expected = gettext.translation('messages', localedir, languages=[lang]).gettext('home')
+        assert translations.gettext(lang)('home') == expected
+
+
+def test_for_update_falls_back_to_default_lang(translations):
+    assert translations.for_update(fake_update('it'))[0] == 'it'
+    assert translations.for_update(fake_update('de'))[0] == 'en'
+    assert translations.for_update(fake_update(None))[0] == 'en'
+
+
+def test_static_content(translations):
+    for lang in translations.langs:
+        _ = translations.gettext(lang)
+        static = translations.static[lang]
+        assert static['start_text'] == _('welcome') + "\n\n" + _('home') % (_('stop'), _('line'))
+        assert static['location_keyboard'].keyboard[0][0].text == _('send_location')
+        assert [button.callback_data for button in static['choose_service_keyboard'].inline_keyboard[0]] == \
+               ['T0venezia-aut', 'T0venezia-nav', 'T0venezia-treni']
+
+
+def test_handler_latency_benchmark(translations):
+    update = fake_update('it')
+
+    def reload_per_update():
+        lang = 'it' if update.effective_user.language_code == 'it' else 'en'
+        _ = gettext.translation('messages', localedir, languages=[lang]).gettext
+        ReplyKeyboardMarkup([[KeyboardButton(_('send_location'), request_location=True)]], resize_keyboard=True,
+                            is_persistent=True)
+        return _('insert_stop')
+
+    def preloaded():
+        lang, _ = translations.for_update(update)
+        translations.static[lang]['location_keyboard']
+        return _('insert_stop')
+
+    assert reload_per_update() == preloaded()
+
+    number = 2000
+    reload_time = min(timeit.repeat(reload_per_update, number=number, repeat=3))
+    preloaded_time = min(timeit.repeat(preloaded, number=number, repeat=3))
+    print(f'\nper update: reload {reload_time / number * 1e6:.1f}us, preloaded {preloaded_time / number * 1e6:.1f}us')
+    assert preloaded_time < reload_time
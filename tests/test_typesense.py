@@ -0,0 +1,170 @@
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import pytest
+
+from server.typesense.cache import TTLCache
+from server.typesense.helpers import diff_stations_documents, sync_stations_documents, ts_search_stations
+
+
+class FakeDocuments:
+    def __init__(self, documents: list[dict]):
+        self.documents = {document['id']: document for document in documents}
+        self.imported: list[list[dict]] = []
+        self.deleted_filters: list[str] = []
+
+    def export(self):
+        return '\n'.join(json.dumps(document) for document in self.documents.values())
+
+    def import_(self, documents, params=None, batch_size=None):
+        assert params == {'action': 'upsert'}
+        documents = list(documents)
+        for i in range(0, len(documents), batch_size or len(documents)):
+            self.imported.append(documents[i:i + (batch_size or len(documents))])
+        for document in documents:
+            self.documents[document['id']] = document
+        return [{'success': True} for _ in documents]
+
+    def delete(self, params=None):
+        filter_by = params['filter_by']
+        self.deleted_filters.append(filter_by)
+        ids = [id_.strip('`') for id_ in filter_by[len('id:['):-1].split('`,`')]
+        for id_ in ids:
+            self.documents.pop(id_)
+
+
+class FakeCollection:
+    def __init__(self, documents: list[dict]):
+        self.documents = FakeDocuments(documents)
+
+
+def document(id_, times_count=0.5, ids='1'):
+    return {'id': id_, 'name': id_, 'location': [45.4, 12.3], 'ids': ids, 'source': 'venezia-aut',
+            'times_count': times_count}
+
+
+@pytest.fixture
+def collection() -> FakeCollection:
+    return FakeCollection([document('P.le Roma'), document('Lido S.M.E.'), document('Ferrovia, Stazione')])
+
+
+def test_diff_stations_documents():
+    current = {'a': document('a'), 'b': document('b'), 'c': document('c')}
+    new = {'a': document('a'), 'b': document('b', times_count=0.7), 'd': document('d')}
+    to_upsert, to_delete = diff_stations_documents(current, new)
+    assert [d['id'] for d in to_upsert] == ['b', 'd']
+    assert to_delete == ['c']
+
+
+def test_sync_only_sends_changes(collection):
+    new_documents = {d['id']: d for d in [document('P.le Roma'), document('Lido S.M.E.', ids='1,2')]}
+    assert sync_stations_documents(collection, new_documents) == (1, 1)
+    assert collection.documents.imported == [[document('Lido S.M.E.', ids='1,2')]]
+    assert collection.documents.deleted_filters == ['id:[`Ferrovia, Stazione`]']
+    assert collection.documents.documents == new_documents
+
+    # a second sync with the same data does not touch the collection
+    assert sync_stations_documents(collection, new_documents) == (0, 0)
+    assert len(collection.documents.imported) == 1
+
+
+def test_sync_in_batches(collection, monkeypatch):
+    monkeypatch.setattr('server.typesense.helpers.SYNC_BATCH_SIZE', 2)
+    new_documents = {d['id']: d for d in [document(f'station {i}') for i in range(5)]}
+    assert sync_stations_documents(collection, new_documents) == (5, 3)
+    assert [len(batch) for batch in collection.documents.imported] == [2, 2, 1]
+    assert len(collection.documents.deleted_filters) == 2
+    assert collection.documents.documents == new_documents
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_ttl_cache_expiration():
+    clock = FakeClock()
+    cache = TTLCache(10, clock=clock)
+    calls = []
+
+    def compute():
+        calls.append(clock.now)
+        return len(calls)
+
+    assert cache.get_or_compute('key', compute) == 1
+    clock.now = 9
+    assert cache.get_or_compute('key', compute) == 1
+    clock.now = 10
+    assert cache.get_or_compute('key', compute) == 2
+    assert cache.stats() == {'hits': 1, 'misses': 2, 'coalesced': 0, 'hit_ratio': 1 / 3, 'size': 1}
+
+
+def test_ttl_cache_coalesces_concurrent_requests():
+    cache = TTLCache(10)
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def slow_compute():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return 'result'
+
+    with ThreadPoolExecutor(max_workers=5) as executor:
+        first = executor.submit(cache.get_or_compute, 'key', slow_compute)
+        started.wait(5)
+        others = [executor.submit(cache.get_or_compute, 'key', slow_compute) for _ in range(4)]
+        while cache.coalesced < 4:
+            time.sleep(0.001)
+        release.set()
+        assert first.result() == 'result'
+        assert [other.result() for other in others] == ['result'] * 4
+
+    assert len(calls) == 1
+    assert cache.stats()['coalesced'] == 4
+
+
+def test_ttl_cache_does_not_store_errors():
+    cache = TTLCache(10)
+
+    def failing():
+        raise ValueError
+
+    with pytest.raises(ValueError):
+        cache.get_or_compute('key', failing)
+    assert cache.get_or_compute('key', lambda: 'ok') == 'ok'
+
+
+class FakeSearchDocuments:
+    def __init__(self):
+        self.searches = []
+
+    def search(self, search_config):
+        self.searches.append(search_config)
+        return {'found': 1, 'hits': [{'document': document('P.le Roma')}]}
+
+
+def test_ts_search_stations_cache_key(monkeypatch):
+    monkeypatch.setattr('server.typesense.helpers.search_cache', TTLCache(10))
+    documents = FakeSearchDocuments()
+    typesense = SimpleNamespace(collections={'stations': SimpleNamespace(documents=documents)})
+
+    ts_search_stations(typesense, ['venezia-aut', 'venezia-nav'], 'P.le  Roma')
+    ts_search_stations(typesense, ['venezia-nav', 'venezia-aut'], 'p.le roma ')
+    assert len(documents.searches) == 1
+    assert documents.searches[0]['q'] == 'p.le roma'
+
+    ts_search_stations(typesense, [], lat=45.43801, lon=12.31852)
+    stations, _ = ts_search_stations(typesense, [], lat='45.43798', lon='12.31861')
+    assert len(documents.searches) == 2
+    assert documents.searches[1]['sort_by'] == 'location(45.438,12.319):asc'
+    assert stations[0].name == 'P.le Roma'
+
+    ts_search_stations(typesense, [], 'p.le roma', page=2)
+    assert len(documents.searches) == 3
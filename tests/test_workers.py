@@ -0,0 +1,123 @@
+import http.client
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, date, timedelta, timezone
+
+import pytest
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+
+from server import workers
+from server.base.models import StopTime
+
+N_CORES = os.cpu_count() or 1
+
+
+async def get_stop_times(request: Request) -> Response:
+    # stand-in for the /stop_times route without the database: the 15 rows of a response are built and serialized
+    # from the ORM objects, which is the CPU-bound part of the route
+    start_dt = datetime(2024, 1, 15, 8, tzinfo=timezone.utc)
+    rows = []
+    for _ in range(20):
+        stop_times = [StopTime(id=i, sched_arr_dt=start_dt + timedelta(minutes=i),
+                               sched_dep_dt=start_dt + timedelta(minutes=i), orig_dep_date=date(2024, 1, 15),
+                               platform='1', orig_id='1', dest_text='VENEZIA S. L.', number=1000 + i,
+                               route_name='RV', source='venezia-treni', stop_id='S02593') for i in range(15)]
+        rows = [[stop_time.as_dict()] for stop_time in stop_times]
+    return JSONResponse(rows, headers={'X-Worker-Pid': str(os.getpid())})
+
+
+async def run_test_worker(sock, updates_queue) -> None:
+    async def telegram(request: Request) -> Response:
+        updates_queue.put(await request.json())
+        return Response()
+
+    app = Starlette(routes=[Route('/stop_times', get_stop_times),
+                            Route('/tg_bot_webhook', telegram, methods=['POST'])])
+    await workers.serve(app, sock, log_level='warning')
+
+
+async def run_test_consumer(updates_queue, results_queue) -> None:
+    async def handle(update):
+        results_queue.put(update['update_id'])
+
+    await workers.consume_queue(updates_queue, handle)
+
+
+def start_server(n_workers: int, updates_queue=None):
+    sock = workers.bind_socket('127.0.0.1', 0)
+    processes = [workers.start_process(run_test_worker, sock, updates_queue, name=f'api-{i}')
+                 for i in range(n_workers)]
+    return sock, processes
+
+
+def stop_server(sock, processes):
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.join(10)
+    sock.close()
+
+
+def request(port: int, method='GET', path='/stop_times', body=None) -> http.client.HTTPResponse:
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    try:
+        connection.request(method, path, body=body)
+        response = connection.getresponse()
+        response.read()
+        return response
+    finally:
+        connection.close()
+
+
+def measure_throughput(n_workers: int, duration=2.0, concurrency=8) -> tuple[float, set[str]]:
+    sock, processes = start_server(n_workers)
+    port = sock.getsockname()[1]
+    try:
+        # the first requests wait for the workers to start
+        for _ in range(n_workers * 2):
+            assert request(port).status == 200
+
+        def load(deadline):
+            pids, count = set(), 0
+            while time.perf_counter() < deadline:
+                pids.add(request(port).getheader('X-Worker-Pid'))
+                count += 1
+            return count, pids
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = list(executor.map(load, [start + duration] * concurrency))
+        elapsed = time.perf_counter() - start
+    finally:
+        stop_server(sock, processes)
+    return sum(count for count, _ in results) / elapsed, set().union(*(pids for _, pids in results))
+
+
+def test_webhook_updates_reach_the_bot_process():
+    updates_queue, results_queue = workers.context.Queue(), workers.context.Queue()
+    consumer = workers.start_process(run_test_consumer, updates_queue, results_queue, name='bot')
+    sock, processes = start_server(2, updates_queue)
+    port = sock.getsockname()[1]
+    try:
+        for update_id in range(10):
+            assert request(port, 'POST', '/tg_bot_webhook', json.dumps({'update_id': update_id})).status == 200
+        assert sorted(results_queue.get(timeout=30) for _ in range(10)) == list(range(10))
+    finally:
+        stop_server(sock, processes + [consumer])
+
+
+def test_stop_times_throughput_scales_with_workers():
+    n_workers = max(2, min(N_CORES, 4))
+    single_throughput, _ = measure_throughput(1)
+    multi_throughput, pids = measure_throughput(n_workers)
+    print(f'\n/stop_times throughput: {single_throughput:.0f} req/s with 1 worker, {multi_throughput:.0f} req/s '
+          f'with {n_workers} workers on {N_CORES} cores ({multi_throughput / single_throughput:.2f}x)')
+    if N_CORES < 3:
+        pytest.skip('scaling is only measured with at least 3 cores, one is taken by the load generator')
+    assert len(pids) > 1
+    assert multi_throughput > single_throughput * (n_workers - 1) * 0.6
@@ -1,113 +1,134 @@
-from datetime import datetime
+from datetime import datetime, timezone, timedelta
+from functools import lru_cache
+
+from zoneinfo import ZoneInfo
 
 from server.base.models import StopTime
 
+rome_tz = ZoneInfo('Europe/Berlin')
 
-class Liner:
-    def format(self, number, _, source_name):
-        raise NotImplementedError
+FRAGMENTS_CACHE_SIZE = 4096
 
 
-class NamedStopTime(Liner):
-    def __init__(self, stop_time: StopTime, station_name: str):
-        self.stop_time = stop_time
-        self.station_name = station_name
+def bold(text, is_bold):
+    return f'<b>{text}</b>' if is_bold else text
 
-    def format(self, number, _, source_name, left_time_bold=True, right_time_bold=True):
-        # First line of text
-        time_format = ""
 
-        if left_time_bold:
-            time_format += "<b>"
+def delay_text(delay):
+    return f" <i>+{delay}'</i>" if delay else ''
 
-        time_format += self.stop_time.tz_sched_dep_dt().strftime('%H:%M')
 
-        if left_time_bold:
-            time_format += "</b>"
+# The static part of a line only depends on the fields of the stop time (its "version"), so it is rendered once and
+# then reused on every refresh. Only the departed state, which depends on the current time, is applied at render time.
+@lru_cache(maxsize=FRAGMENTS_CACHE_SIZE)
+def named_stop_time_fragment(sched_dep_dt: datetime, delay, route_name, dest_text, number, platform, platform_text,
+                             left_time_bold) -> str:
+    time_format = bold(sched_dep_dt.astimezone(rome_tz).strftime('%H:%M'), left_time_bold) + delay_text(delay)
 
-        headsign = self.stop_time.dest_text[:21]
-        route_name = f'{self.stop_time.route_name} ' if self.stop_time.route_name else ''
-        line = f'{time_format} {route_name}{headsign}'
+    # First line of text
+    headsign = dest_text[:21]
+    route_name = f'{route_name} ' if route_name else ''
+    line = f'{time_format} {route_name}{headsign}'
 
-        # Second line of text
-        trip_id = f'/{self.stop_time.number} ' if self.stop_time.number else ''
-        platform = self.stop_time.platform if self.stop_time.platform else '/'
-        platform_text = _(f'{source_name}_platform')
-        line += f'\n⎿ <i>{trip_id}{platform_text} {platform}</i>'
+    # Second line of text
+    trip_id = f'/{number} ' if number else ''
+    platform = platform if platform else '/'
+    line += f'\n⎿ <i>{trip_id}{platform_text} {platform}</i>'
+    return line
 
-        # Modifications for all lines of text
-        if self.stop_time.sched_dep_dt < datetime.now(tz=self.stop_time.sched_dep_dt.tzinfo):
-            line = f'<del>{line}</del>'
 
-        if number:
-            return f'\n{number}. {line}'
-        else:
-            return f'\n⎿ {line}'
+@lru_cache(maxsize=FRAGMENTS_CACHE_SIZE)
+def route_fragment(sched_dep_dt: datetime, delay, sched_arr_dt: datetime | None, route_name, dest_text, number,
+                   dep_platform, arr_platform, platform_text, left_time_bold, right_time_bold) -> str:
+    time_format = bold(sched_dep_dt.astimezone(rome_tz).strftime('%H:%M'), left_time_bold) + delay_text(delay)
 
+    if sched_arr_dt:
+        time_format += "->" + bold(sched_arr_dt.astimezone(rome_tz).strftime('%H:%M'), right_time_bold)
 
-class Route(Liner):
-    def __init__(self, dep_named_stop_time: NamedStopTime,
-                 arr_named_stop_time: NamedStopTime | None = None):
-        self.dep_stop_time = dep_named_stop_time.stop_time
-        self.dep_station_name = dep_named_stop_time.station_name
-        self.arr_stop_time = arr_named_stop_time.stop_time if arr_named_stop_time else None
-        self.arr_station_name = arr_named_stop_time.station_name if arr_named_stop_time else None
+    # First line of text
+    headsign = dest_text[:14]
+    route_name = f'{route_name} ' if route_name else ''
+    line = f'{time_format} {route_name}{headsign}'
 
-    def format(self, number, _, source_name, left_time_bold=True, right_time_bold=True):
-        # First line of text
-        time_format = ""
+    # Second line of text
+    dep_platform = dep_platform if dep_platform else '/'
+    arr_platform = arr_platform if arr_platform else '/'
+    line += f'\n⎿ <i>/{number} {platform_text} {dep_platform} -> {arr_platform}</i>'
+    return line
 
-        if left_time_bold:
-            time_format += "<b>"
 
-        time_format += self.dep_stop_time.tz_sched_dep_dt().strftime('%H:%M')
+def is_departed(stop_time: StopTime, now: datetime) -> bool:
+    # a delayed stop time is departed only once its delay has passed too
+    return stop_time.sched_dep_dt + timedelta(minutes=stop_time.delay or 0) < now
 
-        if left_time_bold:
-            time_format += "</b>"
 
-        if self.arr_stop_time:
-            arr_time = self.arr_stop_time.tz_sched_arr_dt().strftime('%H:%M')
+def render_line(line, number, departed):
+    if departed:
+        line = f'<del>{line}</del>'
 
-            time_format += "->"
+    if number:
+        return f'\n{number}. {line}'
+    else:
+        return f'\n⎿ {line}'
 
-            if right_time_bold:
-                time_format += "<b>"
 
-            time_format += arr_time
+class Liner:
+    def format(self, number, _, source_name, now: datetime = None):
+        raise NotImplementedError
 
-            if right_time_bold:
-                time_format += "</b>"
 
-        headsign = self.dep_stop_time.dest_text[:14]
-        route_name = f'{self.dep_stop_time.route_name} ' if self.dep_stop_time.route_name else ''
-        line = f'{time_format} {route_name}{headsign}'
+class NamedStopTime(Liner):
+    def __init__(self, stop_time: StopTime, station_name: str):
+        self.stop_time = stop_time
+        self.station_name = station_name
 
-        # Second line of text
-        platform_text = _(f'{source_name}_platform')
-        dep_platform = self.dep_stop_time.platform if self.dep_stop_time.platform else '/'
-        arr_platform = self.arr_stop_time.platform if self.arr_stop_time.platform else '/'
-        line += f'\n⎿ <i>/{self.dep_stop_time.number} {platform_text} {dep_platform} -> {arr_platform}</i>'
+    def format(self, number, _, source_name, left_time_bold=True, right_time_bold=True, now: datetime = None):
+        stop_time = self.stop_time
+        line = named_stop_time_fragment(stop_time.sched_dep_dt, stop_time.delay, stop_time.route_name,
+                                        stop_time.dest_text, stop_time.number, stop_time.current_platform(),
+                                        _(f'{source_name}_platform'), left_time_bold)
 
-        # Modifications for all lines of text
-        if self.dep_stop_time.sched_dep_dt < datetime.now(tz=self.dep_stop_time.sched_dep_dt.tzinfo):
-            line = f'<del>{line}</del>'
+        if now is None:
+            now = datetime.now(tz=timezone.utc)
 
-        if number:
-            return f'\n{number}. {line}'
-        else:
-            return f'\n⎿ {line}'
+        return render_line(line, number, is_departed(stop_time, now))
+
+
+class Route(Liner):
+    def __init__(self, dep_named_stop_time: NamedStopTime,
+                 arr_named_stop_time: NamedStopTime | None = None):
+        self.dep_stop_time = dep_named_stop_time.stop_time
+        self.dep_station_name = dep_named_stop_time.station_name
+        self.arr_stop_time = arr_named_stop_time.stop_time if arr_named_stop_time else None
+        self.arr_station_name = arr_named_stop_time.station_name if arr_named_stop_time else None
+
+    def format(self, number, _, source_name, left_time_bold=True, right_time_bold=True, now: datetime = None):
+        dep_stop_time, arr_stop_time = self.dep_stop_time, self.arr_stop_time
+        line = route_fragment(dep_stop_time.sched_dep_dt, dep_stop_time.delay,
+                              arr_stop_time.sched_arr_dt if arr_stop_time else None, dep_stop_time.route_name,
+                              dep_stop_time.dest_text, dep_stop_time.number, dep_stop_time.current_platform(),
+                              arr_stop_time.current_platform(), _(f'{source_name}_platform'), left_time_bold,
+                              right_time_bold)
+
+        if now is None:
+            now = datetime.now(tz=timezone.utc)
+
+        return render_line(line, number, is_departed(dep_stop_time, now))
 
 
 class Direction(Liner):
     def __init__(self, routes: list[Route]):
         self.routes = routes
 
-    def format(self, number, _, source_name):
+    def format(self, number, _, source_name, now: datetime = None):
+        if now is None:
+            now = datetime.now(tz=timezone.utc)
+
         text = ""
         for i, route in enumerate(self.routes):
             number = number if i == 0 else None
             text += route.format(number, _, source_name, left_time_bold=i == 0,
-                                 right_time_bold=i == len(self.routes) - 1)
+                                 right_time_bold=i == len(self.routes) - 1, now=now)
 
             if route.arr_station_name and i != len(self.routes) - 1:
                 next_route = self.routes[i + 1]
@@ -116,3 +137,9 @@ class Direction(Liner):
                 text += f'\n⎿ <i>cambio a {route.arr_station_name} ({duration_in_minutes}min)</i>'
 
         return text
+
+
+def format_board(results: list[Liner], _, source_name, now: datetime = None) -> str:
+    if now is None:
+        now = datetime.now(tz=timezone.utc)
+    return ''.join(result.format(i + 1, _, source_name, now=now) for i, result in enumerate(results))
@@ -1,4 +1,3 @@
-import gettext
 import logging
 import os
 import sys
@@ -6,7 +5,7 @@ from datetime import timedelta, datetime, date
 
 import requests
 from babel.dates import format_date
-from telegram import Update, KeyboardButton, ReplyKeyboardMarkup, InlineKeyboardButton, InlineKeyboardMarkup, \
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, \
     ReplyKeyboardRemove, Bot
 from telegram.ext import (
     Application,
@@ -17,10 +16,12 @@ from telegram.ext import (
 from telegram.ext import ContextTypes
 
 from config import config
+from server import metrics, tracing
 from server.base import Source
 from server.sources import sources as defined_sources
 from .persistence import SQLitePersistence
 from .stop_times_filter import StopTimesFilter
+from .translations import Translations, DEFAULT_LANG
 
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
@@ -32,10 +33,23 @@ parent_dir = os.path.abspath(current_dir + "/../")
 thismodule = sys.modules[__name__]
 thismodule.sources = {}
 thismodule.persistence = None
+thismodule.translations = None
 
 SEARCH_STOP, SPECIFY_LINE, SEARCH_LINE, SHOW_LINE, SHOW_STOP = range(5)
+STATE_NAMES = {SEARCH_STOP: 'search_stop', SPECIFY_LINE: 'specify_line', SEARCH_LINE: 'search_line',
+               SHOW_LINE: 'show_line', SHOW_STOP: 'show_stop'}
 
-localedir = os.path.join(parent_dir, 'locales')
+HANDLER_SECONDS = metrics.histogram('muoversi_bot_handler_seconds',
+                                    'Duration of the bot handlers, by conversation state', ['state', 'handler'])
+
+
+def measure_handlers(handlers: list, state: str):
+    # the callbacks are replaced in place, the handlers keep their filters and patterns; the queries they run are
+    # traced with the id of the update
+    for handler in handlers:
+        name = handler.callback.__name__
+        callback = metrics.timed(HANDLER_SECONDS, state, name)(handler.callback)
+        handler.callback = tracing.traced_handler(callback, f'{state}.{name}')
 
 
 def clean_user_data(context, keep_transport_type=True):
@@ -50,12 +64,9 @@ def clean_user_data(context, keep_transport_type=True):
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    lang = 'it' if update.effective_user.language_code == 'it' else 'en'
-    trans = gettext.translation('messages', localedir, languages=[lang])
-    _ = trans.gettext
+    lang, _ = thismodule.translations.for_update(update)
     clean_user_data(context, False)
-    await update.message.reply_text(_('welcome') + "\n\n" + _('home') % (_('stop'), _('line')),
-                                    disable_notification=True)
+    await update.message.reply_text(thismodule.translations.static[lang]['start_text'], disable_notification=True)
 
 
 async def announce(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -73,9 +84,7 @@ async def announce(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
 
 async def choose_service(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    lang = 'it' if update.effective_user.language_code == 'it' else 'en'
-    trans = gettext.translation('messages', localedir, languages=[lang])
-    _ = trans.gettext
+    lang, _ = thismodule.translations.for_update(update)
 
     command_text = update.message.text[1:]
 
@@ -89,10 +98,7 @@ async def choose_service(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     clean_user_data(context)
 
     if command == 'fermata':
-        reply_keyboard = [[KeyboardButton(_('send_location'), request_location=True)]]
-        reply_keyboard_markup = ReplyKeyboardMarkup(
-            reply_keyboard, resize_keyboard=True, is_persistent=True
-        )
+        reply_keyboard_markup = thismodule.translations.static[lang]['location_keyboard']
         await update.message.reply_text(_('insert_stop'), reply_markup=reply_keyboard_markup, parse_mode='HTML',
                                         disable_notification=True)
         return SEARCH_STOP
@@ -100,14 +106,9 @@ async def choose_service(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     if context.user_data.get('transport_type'):
         return await specify_line(update, context)
 
-    inline_keyboard = [[]]
-
-    for source in thismodule.sources:
-        inline_keyboard[0].append(InlineKeyboardButton(_(source), callback_data="T0" + source))
-
     await update.message.reply_text(
         _('choose_service'),
-        reply_markup=InlineKeyboardMarkup(inline_keyboard),
+        reply_markup=thismodule.translations.static[lang]['choose_service_keyboard'],
         disable_notification=True
     )
 
@@ -130,9 +131,7 @@ async def specify_line(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
         bot = update.message.get_bot()
         chat_id = update.message.chat_id
 
-    lang = 'it' if update.effective_user.language_code == 'it' else 'en'
-    trans = gettext.translation('messages', localedir, languages=[lang])
-    _ = trans.gettext
+    lang, _ = thismodule.translations.for_update(update)
 
     others_sources = [source for source in thismodule.sources if source != short_transport_type]
 
@@ -159,9 +158,7 @@ async def specify_line(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
 
 
 async def search_stop(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    lang = 'it' if update.effective_user.language_code == 'it' else 'en'
-    trans = gettext.translation('messages', localedir, languages=[lang])
-    _ = trans.gettext
+    lang, _ = thismodule.translations.for_update(update)
 
     db_file: Source = thismodule.sources[context.user_data.get('transport_type', 'venezia-aut')]
 
@@ -251,15 +248,13 @@ async def send_stop_times(_, lang, db_file: Source, stop_times_filter: StopTimes
                                disable_notification=True)
 
     if stop_times_filter.first_time:
+        static = thismodule.translations.static[lang]
         if stop_times_filter.arr_stop_ids:
-            text = '<i>' + _('send_new_arr_stop') + '</i>'
+            text = static['send_new_arr_stop_text']
         else:
-            text = '<i>' + _('send_arr_stop') + '</i>'
+            text = static['send_arr_stop_text']
 
-        reply_keyboard = [[KeyboardButton(_('send_location'), request_location=True)]]
-        reply_keyboard_markup = ReplyKeyboardMarkup(
-            reply_keyboard, resize_keyboard=True, is_persistent=True
-        )
+        reply_keyboard_markup = static['location_keyboard']
 
         await bot.send_message(chat_id, text, disable_notification=True,
                                reply_markup=reply_keyboard_markup, parse_mode='HTML')
@@ -270,9 +265,7 @@ async def send_stop_times(_, lang, db_file: Source, stop_times_filter: StopTimes
 async def change_day_show_stop(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     db_file = thismodule.sources[context.user_data['transport_type']]
 
-    lang = 'it' if update.effective_user.language_code == 'it' else 'en'
-    trans = gettext.translation('messages', localedir, languages=[lang])
-    _ = trans.gettext
+    lang, _ = thismodule.translations.for_update(update)
 
     del context.user_data['lines']
     dep_stop_ids = context.user_data.get('dep_stop_ids')
@@ -295,9 +288,7 @@ async def change_day_show_stop(update: Update, context: ContextTypes.DEFAULT_TYP
 
 
 async def show_stop_from_id(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    lang = 'it' if update.effective_user.language_code == 'it' else 'en'
-    trans = gettext.translation('messages', localedir, languages=[lang])
-    _ = trans.gettext
+    lang, _ = thismodule.translations.for_update(update)
 
     now = datetime.now()
 
@@ -348,9 +339,7 @@ async def show_stop_from_id(update: Update, context: ContextTypes.DEFAULT_TYPE)
 async def filter_show_stop(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     db_file = thismodule.sources[context.user_data['transport_type']]
 
-    lang = 'it' if update.effective_user.language_code == 'it' else 'en'
-    trans = gettext.translation('messages', localedir, languages=[lang])
-    _ = trans.gettext
+    lang, _ = thismodule.translations.for_update(update)
 
     query = update.callback_query
     logger.info("Query data %s", query.data)
@@ -375,9 +364,7 @@ async def filter_show_stop(update: Update, context: ContextTypes.DEFAULT_TYPE) -
 
 async def trip_view(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     source: Source = thismodule.sources[context.user_data['transport_type']]
-    lang = 'it' if update.effective_user.language_code == 'it' else 'en'
-    trans = gettext.translation('messages', localedir, languages=[lang])
-    _ = trans.gettext
+    lang, _ = thismodule.translations.for_update(update)
     query_data = context.user_data['query_data']
     dep_stop_ids = context.user_data['dep_stop_ids']
     dep_cluster_name = context.user_data['dep_cluster_name']
@@ -456,9 +443,7 @@ async def trip_view(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 async def search_line(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     db_file: Source = thismodule.sources[context.user_data['transport_type']]
 
-    lang = 'it' if update.effective_user.language_code == 'it' else 'en'
-    trans = gettext.translation('messages', localedir, languages=[lang])
-    _ = trans.gettext
+    lang, _ = thismodule.translations.for_update(update)
 
     try:
         lines = db_file.search_lines(update.message.text)
@@ -476,9 +461,7 @@ async def search_line(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
 
 async def show_line(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     source: Source = thismodule.sources[context.user_data['transport_type']]
-    lang = 'it' if update.effective_user.language_code == 'it' else 'en'
-    trans = gettext.translation('messages', localedir, languages=[lang])
-    _ = trans.gettext
+    lang, _ = thismodule.translations.for_update(update)
 
     query = update.callback_query
 
@@ -506,11 +489,9 @@ async def show_line(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     clean_user_data(context)
 
-    lang = 'it' if update.effective_user.language_code == 'it' else 'en'
-    trans = gettext.translation('messages', localedir, languages=[lang])
-    _ = trans.gettext
+    lang, _ = thismodule.translations.for_update(update)
 
-    await update.message.reply_text(_('cancel') + "\n\n" + _('home') % (_('stop'), _('line')),
+    await update.message.reply_text(thismodule.translations.static[lang]['cancel_text'],
                                     reply_markup=ReplyKeyboardRemove(), disable_notification=True)
 
     return ConversationHandler.END
@@ -518,18 +499,20 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 
 async def set_up_application():
     persistence = SQLitePersistence()
-    application = Application.builder().token(config['TG_TOKEN']).persistence(persistence=persistence).build()
+    builder = Application.builder().token(config['TG_TOKEN']).persistence(persistence=persistence)
+    # the Bot API can be replaced by a local stub, e.g. the one of replay.py, served over plain HTTP/1.1
+    api_base_url = config.get('TG_API_BASE_URL') or 'https://api.telegram.org/bot'
+    if config.get('TG_API_BASE_URL'):
+        builder = builder.base_url(api_base_url).http_version('1.1').get_updates_http_version('1.1')
+    application = builder.build()
     thismodule.sources = defined_sources
     thismodule.persistence = persistence
+    thismodule.translations = Translations(list(defined_sources))
 
-    langs = [f for f in os.listdir(localedir) if os.path.isdir(os.path.join(localedir, f))]
-    default_lang = 'en'
-
-    for lang in langs:
-        trans = gettext.translation('messages', localedir, languages=[lang])
-        _ = trans.gettext
-        language_code = lang if lang != default_lang else ''
-        r = requests.post(f'https://api.telegram.org/bot{config["TG_TOKEN"]}/setMyCommands', json={
+    for lang in thismodule.translations.langs:
+        _ = thismodule.translations.gettext(lang)
+        language_code = lang if lang != DEFAULT_LANG else ''
+        r = requests.post(f'{api_base_url}{config["TG_TOKEN"]}/setMyCommands', json={
             'commands': [
                 {'command': _('stop'), 'description': _('search_by_stop')},
                 {'command': _('line'), 'description': _('search_by_line')}
@@ -564,6 +547,11 @@ async def set_up_application():
         persistent=True
     )
 
+    measure_handlers(conv_handler.entry_points, 'entry')
+    for state, handlers in conv_handler.states.items():
+        measure_handlers(handlers, STATE_NAMES[state])
+    measure_handlers(conv_handler.fallbacks, 'fallback')
+
     application.add_handler(CommandHandler("start", start))
     application.add_handler(MessageHandler(filters.Regex(r'^\/announce '), announce))
     application.add_handler(conv_handler)
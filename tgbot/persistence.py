@@ -20,7 +20,7 @@ class SQLitePersistence(BasePersistence):
         parent_dir = os.path.abspath(current_dir + "/../")
         self.con = sqlite3.connect(os.path.join(parent_dir, 'data.db'))
         self.con.row_factory = sqlite3.Row
-        self.con.set_trace_callback(logger.info)
+        self.con.set_trace_callback(logger.debug)
         self.con.execute('CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY, data TEXT)')
         self.con.execute('CREATE TABLE IF NOT EXISTS chats (chat_id INTEGER PRIMARY KEY, data TEXT)')
         self.con.execute('CREATE TABLE IF NOT EXISTS bot (id INTEGER PRIMARY KEY, data TEXT)')
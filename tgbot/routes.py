@@ -1,3 +1,5 @@
+from typing import Callable, Coroutine
+
 from starlette.requests import Request
 from starlette.responses import Response
 from starlette.routing import Route
@@ -6,13 +8,28 @@ from telegram import Update
 from config import config
 
 
-def get_routes(application):
+def application_put_update(application) -> Callable[[dict], Coroutine]:
+    # updates are handled by the application running in the current process
+    async def put_update(data: dict):
+        await application.update_queue.put(Update.de_json(data=data, bot=application.bot))
+
+    return put_update
+
+
+def queue_put_update(updates_queue) -> Callable[[dict], Coroutine]:
+    # updates are forwarded to the application running in the bot process (see run.py), which reads them from
+    # `updates_queue` with `application_put_update`
+    async def put_update(data: dict):
+        updates_queue.put(data)
+
+    return put_update
+
+
+def get_routes(put_update: Callable[[dict], Coroutine]):
     async def telegram(request: Request) -> Response:
         if request.headers['X-Telegram-Bot-Api-Secret-Token'] != config['TG_SECRET_TOKEN']:
             return Response(status_code=403)
-        await application.update_queue.put(
-            Update.de_json(data=await request.json(), bot=application.bot)
-        )
+        await put_update(await request.json())
         return Response()
 
     routes = [
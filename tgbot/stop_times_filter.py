@@ -8,7 +8,7 @@ from telegram.ext import ContextTypes
 
 from server.base import Source, Station
 from server.base.models import StopTime
-from tgbot.formatting import Liner, NamedStopTime, Route, Direction
+from tgbot.formatting import Liner, NamedStopTime, Route, Direction, format_board
 import arrow
 
 logging.basicConfig(
@@ -140,8 +140,7 @@ class StopTimesFilter:
         if results_len == 0 and self.offset_times == 0:
             text += '\n' + _('no_times')
 
-        for i, result in enumerate(results):
-            text += result.format(i + 1, _, self.source.name)
+        text += format_board(results, _, self.source.name)
 
         keyboard = []
 
@@ -0,0 +1,64 @@
+import gettext
+import logging
+import os
+from typing import Callable
+
+from telegram import KeyboardButton, ReplyKeyboardMarkup, InlineKeyboardButton, InlineKeyboardMarkup, Update
+
+logging.basicConfig(
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+current_dir = os.path.abspath(os.path.dirname(__file__))
+parent_dir = os.path.abspath(current_dir + "/../")
+localedir = os.path.join(parent_dir, 'locales')
+
+DEFAULT_LANG = 'en'
+
+
+def get_lang(update: Update) -> str:
+    return 'it' if update.effective_user.language_code == 'it' else DEFAULT_LANG
+
+
+class Translations:
+    """Translations and static bot content of every language, loaded once at start-up.
+
+    `gettext.translation` looks up the .mo file on disk and copies the catalog on every call, so handlers get the
+    already loaded catalog from here instead. Strings and keyboards that do not depend on the update are rendered
+    once per language and kept in `static`.
+    """
+
+    def __init__(self, sources_names: list[str] = None, localedir_=localedir):
+        if sources_names is None:
+            sources_names = []
+
+        self.langs = sorted(f for f in os.listdir(localedir_) if os.path.isdir(os.path.join(localedir_, f)))
+        self.catalogs: dict[str, gettext.NullTranslations] = {
+            lang: gettext.translation('messages', localedir_, languages=[lang]) for lang in self.langs
+        }
+        self.static: dict[str, dict] = {lang: self.render_static(lang, sources_names) for lang in self.langs}
+        logger.info('loaded translations for languages: %s', ', '.join(self.langs))
+
+    def render_static(self, lang, sources_names: list[str]) -> dict:
+        _ = self.catalogs[lang].gettext
+        return {
+            'start_text': _('welcome') + "\n\n" + _('home') % (_('stop'), _('line')),
+            'cancel_text': _('cancel') + "\n\n" + _('home') % (_('stop'), _('line')),
+            'location_keyboard': ReplyKeyboardMarkup(
+                [[KeyboardButton(_('send_location'), request_location=True)]], resize_keyboard=True,
+                is_persistent=True
+            ),
+            'choose_service_keyboard': InlineKeyboardMarkup(
+                [[InlineKeyboardButton(_(source), callback_data="T0" + source) for source in sources_names]]
+            ),
+            'send_arr_stop_text': '<i>' + _('send_arr_stop') + '</i>',
+            'send_new_arr_stop_text': '<i>' + _('send_new_arr_stop') + '</i>'
+        }
+
+    def gettext(self, lang) -> Callable[[str], str]:
+        return self.catalogs.get(lang, self.catalogs[DEFAULT_LANG]).gettext
+
+    def for_update(self, update: Update) -> tuple[str, Callable[[str], str]]:
+        lang = get_lang(update)
+        return lang, self.gettext(lang)